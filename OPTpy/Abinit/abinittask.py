@@ -77,14 +77,33 @@ class AbinitTask(DFTTask, IOTask):
         self.runscript.append('$MPIRUN $ABINIT < {} &> {}'.format(
                               self.filesfile_basename, self.log_basename))
 
+    # Directory modification time and output file name found then.
+    _output_fname_cache = None
+
     @property
     def output_fname(self):
+        """
+        The output file of the last run: Abinit appends a letter
+        to the name of the output when the file already exists.
+        The directory is listed again only if it was modified.
+        """
         first = pjoin(self.dirname, self.output_basename)
+        try:
+            mtime = os.stat(self.dirname).st_mtime
+        except OSError:
+            return first
+        cache = self._output_fname_cache
+        if cache is not None and cache[:2] == (self.dirname, mtime):
+            return cache[2]
+
+        fname = first
+        names = set(os.listdir(self.dirname))
         for s in reversed('ABCDEFGHIJKLMNOPQRSTUVWXYZ'):
-            last = first + s
-            if os.path.exists(last):
-                return last
-        return first
+            if self.output_basename + s in names:
+                fname = first + s
+                break
+        self._output_fname_cache = (self.dirname, mtime, fname)
+        return fname
 
     @property
     def filesfile_basename(self):
@@ -2,6 +2,7 @@ from __future__ import print_function
 import os
 from numpy import dot,round
 from .abinittask import AbinitTask
+from ..utils import empty_chunk_test
 
 __all__ = ['AbinitWfnTask']
 
@@ -48,6 +49,9 @@ class AbinitWfnTask(AbinitTask):
         input_wavefunction_fname: str, optional
             Name of previously compute wavefunction file, in case you want
             to restart from there.
+        kreciprocal_fname: str, optional
+            List of k-points in reduced coordinates.
+            Default: prefix.klist_kgrid in the current directory.
         input_variables : dict
             Any other input variables for the Abinit input file.
         nspinor : Number of spinorial components, int, optional
@@ -65,7 +69,7 @@ class AbinitWfnTask(AbinitTask):
         self.kgrid="{}x{}x{}".format(self.kgrid_response[0],self.kgrid_response[1],self.kgrid_response[2])
 
 #       Make changes to run.sh to make a kpt.in file:
-        self.mk_kpt_in(ntask,task)
+        self.mk_kpt_in(ntask,task,kwargs.get('kreciprocal_fname'))
 
         super(AbinitWfnTask, self).__init__(dirname, **kwargs)
 
@@ -145,17 +149,34 @@ class AbinitWfnTask(AbinitTask):
 
     vxc_fname = exchange_correlation_potential_fname
 
-    def mk_kpt_in(self,ntask,task):
+    def mk_kpt_in(self,ntask,task,kreciprocal_fname=None):
 
         # Get path of kpt file:
         # To do: add relative path
-        cwd=os.getcwd()
-        kptfile='{0}.klist_{1}'.format(self.prefix,self.kgrid)
+        if not kreciprocal_fname:
+            kreciprocal_fname=os.path.join(os.getcwd(),
+                '{0}.klist_{1}'.format(self.prefix,self.kgrid))
+        cwd,kptfile=os.path.split(kreciprocal_fname)
+
+        # Nothing to compute when the chunk has no k-point, e.g. when
+        # all the k-points are in the store: no WFK, and an output
+        # reporting the calculation as completed.
+        skiplines="\
+#Nothing to compute without k-points:\n\
+if {0}\n\
+then\n\
+   echo No k-point for this task\n\
+   rm -f out_data/odat_WFK {1}.out*\n\
+   echo \"{2}: no k-point for this task.\" > {1}.out\n\
+   exit 0\n\
+fi\n".format(empty_chunk_test(kptfile,ntask,task),self.prefix,
+              self._TAG_JOB_COMPLETED)
 
         if ( ntask != 1 ):
             # Extra lines for run.sh contained in self.runlines:
             self.runlines="\
 ln -nfs {0}/{1}\n\
+{4}\
 #k-points read from kpt.in file:\n\
 #Basic algebra to get the k-points for this task:\n\
 ntask={2}\n\
@@ -178,16 +199,17 @@ echo kptopt 0 > kpt.in\n\
 echo nkpt $me_nk >>kpt.in\n\
 echo kpt >>kpt.in\n\
 sed -n \" ${{ik_start}},${{ik_end}}p \" {1} >>kpt.in\n"\
-.format(cwd,kptfile,ntask,task)
+.format(cwd,kptfile,ntask,task,skiplines)
         else:
             self.runlines=\
 "#k-points read from kpt.in file:\n\
 ln -nfs {0}/{1}\n\
+{2}\
 echo kptopt 0 > kpt.in\n\
 echo nkpt >>kpt.in\n\
 cat {1} | wc -l >> kpt.in\n\
 echo kpt >>kpt.in\n\
-cat {1} >>kpt.in\n".format(cwd,kptfile)
+cat {1} >>kpt.in\n".format(cwd,kptfile,skiplines)
         
 
     def kpts_from_file(self,**kwargs):
@@ -0,0 +1,381 @@
+"""
+Command line tools called from the run scripts written by OPTpy.
+
+    python -m OPTpy <command> [arguments]
+
+Use 'python -m OPTpy <command> -h' for the arguments of each command.
+"""
+from __future__ import print_function
+import sys
+import argparse
+
+
+def reuse_split(args):
+    from .utils import split_kpoints
+    split_kpoints(args.klist, args.previous_klist, args.output)
+
+
+def reuse_assemble(args):
+    from .utils import assemble_kdata
+    assemble_kdata(args.klist, args.previous_klist, args.new_klist,
+                   args.previous, args.new, args.output,
+                   index=args.index)
+
+
+def kstore_import(args):
+    from .utils import KStore, chunk_range, read_klist
+    kslice = slice(None)
+    if args.ntask > 1:
+        nkpt = len(read_klist(args.klist))
+        kslice = chunk_range(nkpt, args.ntask, args.task)
+    n = KStore(args.kstore).import_files(args.klist, args.eigen, args.pmn,
+                                         args.pnn, kslice)
+    print('{} k-points added to {}'.format(n, args.kstore))
+
+
+def kstore_missing(args):
+    from .utils import KStore, read_klist
+    import numpy as np
+    kpts = read_klist(args.klist)
+    missing = KStore(args.kstore).missing(kpts)
+    np.savetxt(args.output, kpts[missing], fmt='%.10f')
+    print('{} k-points found in {}, {} to compute.'.format(
+          len(kpts) - missing.sum(), args.kstore, missing.sum()))
+
+
+def kstore_export(args):
+    from .utils import KStore
+    KStore(args.kstore).export_files(args.klist, args.eigen, args.pmn,
+                                     args.pnn)
+
+
+def interpolate(args):
+    from .utils import interpolate_kdata
+    interpolate_kdata(args.klist, args.eigen, args.dense_klist, args.symd,
+                      args.pvectors, args.dense_eigen,
+                      pmn_fname=args.pmn[0] if args.pmn else None,
+                      dense_pmn_fname=args.pmn[1] if args.pmn else None,
+                      dense_pnn_fname=args.pnn, ratio=args.ratio)
+
+
+def band_range(value):
+    """Range of bands 'first-last', or a single band."""
+    bands = [int(b) for b in value.split('-')]
+    if len(bands) not in (1, 2):
+        raise argparse.ArgumentTypeError(
+            'invalid band range: {}'.format(value))
+    return (bands[0], bands[-1])
+
+
+def integrate(args):
+    from .utils import integrate_response
+    if args.window and not args.contributions:
+        raise Exception('--window requires --contributions.')
+    integrate_response(args.klist, args.symd, args.energies, args.integrand,
+                       args.spectrum, energy_min=args.energy_min,
+                       energy_max=args.energy_max,
+                       energy_steps=args.energy_steps, sigma=args.sigma,
+                       method=args.method, pnn_fname=args.pnn,
+                       pvectors_fname=args.pvectors, nval=args.nval,
+                       factor=args.factor,
+                       tetrahedra_fname=args.tetrahedra,
+                       triangles_fname=args.triangles,
+                       memory=args.memory, nproc=args.nproc,
+                       groups_fname=args.groups,
+                       valence_groups=args.valence_groups,
+                       conduction_groups=args.conduction_groups,
+                       windows=args.window,
+                       contributions_fname=args.contributions)
+
+
+def integrand(args):
+    from .utils import read_klist, write_integrands
+    write_integrands(args.eigen, args.pmn, len(read_klist(args.klist)),
+                     args.nval, args.ncond, args.response, args.components,
+                     suffix=args.suffix, pnn_fname=args.pnn,
+                     block=args.block, tol=args.tol, memory=args.memory)
+
+
+def window(args):
+    from .utils import window_bands, slice_band_window
+    bands = window_bands(args.nval_total, args.valence, args.conduction)
+    if args.kstore:
+        source = dict(klist=args.klist, kstore=args.kstore)
+    elif args.eigen:
+        source = dict(klist=args.klist, eigen=args.eigen, pmn=args.pmn,
+                      pnn=args.pnn)
+    else:
+        raise Exception('Give either --eigen or --kstore.')
+    target = dict(eigen=args.out_eigen, pmn=args.out_pmn, pnn=args.out_pnn)
+    slice_band_window(source, target, bands, block=args.block)
+
+
+def dos(args):
+    from .utils import compute_dos
+    if not (args.eigen or args.eig):
+        raise Exception('Give either --eigen or --eig.')
+    compute_dos(args.klist, args.tetrahedra, args.nval, args.dos, args.jdos,
+                eigen_fname=args.eigen, eig_fnames=args.eig,
+                ncond=args.ncond, triangles_fname=args.triangles,
+                energy_min=args.energy_min, energy_max=args.energy_max,
+                energy_steps=args.energy_steps, jdos_max=args.jdos_max,
+                nspin=args.nspin, gap_min=args.gap_min, gap_max=args.gap_max)
+
+
+def triangles(args):
+    from .utils import read_klist, read_symd, make_triangles, write_triangles
+    corners, weights = make_triangles(read_klist(args.klist),
+                                      read_symd(args.symd), args.kgrid)
+    write_triangles(args.output, corners, weights)
+    print('{} triangles written to {}'.format(len(corners), args.output))
+
+
+def timeit(args):
+    from .utils import timeit as run_timed
+    command = args.cmd
+    if command and command[0] == '--':
+        command = command[1:]
+    if not command:
+        raise Exception('No command to time.')
+    return run_timed(command, args.output)
+
+
+def trace(args):
+    from .utils import find_timings, write_trace
+    timings = find_timings(args.dirname)
+    write_trace(args.output, timings)
+    print('{} commands of {} tasks written to {}'.format(
+          sum(len(records) for records in timings.values()), len(timings),
+          args.output))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m OPTpy',
+        description='Command line tools used by the OPTpy run scripts.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    # ==== reuse ==== #
+    p = subparsers.add_parser('reuse-split',
+        help='List the k-points missing from a previous calculation.')
+    p.add_argument('klist', help='Full list of k-points.')
+    p.add_argument('previous_klist', help='K-points already computed.')
+    p.add_argument('output', help='K-points left to compute.')
+    p.set_defaults(func=reuse_split)
+
+    p = subparsers.add_parser('reuse-assemble',
+        help='Gather previous and new records in the order of a k-list.')
+    p.add_argument('klist', help='Full list of k-points.')
+    p.add_argument('previous_klist', help='K-points already computed.')
+    p.add_argument('new_klist', help='K-points computed in this run.')
+    p.add_argument('previous', help='Records of the previous k-points.')
+    p.add_argument('new', help='Records of the new k-points.')
+    p.add_argument('output', help='Output file.')
+    p.add_argument('--no-index', dest='index', action='store_false',
+                   help='Records have no leading k-point index.')
+    p.set_defaults(func=reuse_assemble)
+
+    # ==== k-point store ==== #
+    p = subparsers.add_parser('kstore-import',
+        help='Append eigen, pmn and pnn files to a k-point store.')
+    p.add_argument('kstore', help='K-point store.')
+    p.add_argument('klist', help='List of k-points.')
+    p.add_argument('eigen', help='Eigenvalues, with a k-point index.')
+    p.add_argument('pmn', help='Momentum matrix elements.')
+    p.add_argument('pnn', help='Diagonal momentum matrix elements.')
+    p.add_argument('--task', type=int, default=1,
+                   help='Index of the task that computed the files.')
+    p.add_argument('--ntask', type=int, default=1,
+                   help='Number of tasks sharing the k-point list.')
+    p.set_defaults(func=kstore_import)
+
+    p = subparsers.add_parser('kstore-missing',
+        help='List the k-points missing from a k-point store.')
+    p.add_argument('kstore', help='K-point store.')
+    p.add_argument('klist', help='List of k-points.')
+    p.add_argument('output', help='K-points left to compute.')
+    p.set_defaults(func=kstore_missing)
+
+    p = subparsers.add_parser('kstore-export',
+        help='Write eigen, pmn and pnn files in the order of a k-list.')
+    p.add_argument('kstore', help='K-point store.')
+    p.add_argument('klist', help='List of k-points.')
+    p.add_argument('eigen', help='Eigenvalues.')
+    p.add_argument('pmn', help='Momentum matrix elements.')
+    p.add_argument('pnn', help='Diagonal momentum matrix elements.')
+    p.set_defaults(func=kstore_export)
+
+    # ==== interpolation ==== #
+    p = subparsers.add_parser('interpolate',
+        help='Interpolate eigenvalues and matrix elements onto a k-list.')
+    p.add_argument('klist', help='Computed k-points.')
+    p.add_argument('eigen', help='Eigenvalues, with a k-point index.')
+    p.add_argument('dense_klist', help='K-points to interpolate onto.')
+    p.add_argument('symd', help='Symmetry operations (sym.d).')
+    p.add_argument('pvectors', help='Primitive vectors (pvectors).')
+    p.add_argument('dense_eigen', help='Interpolated eigenvalues.')
+    p.add_argument('--pmn', nargs=2, metavar=('PMN', 'DENSE_PMN'),
+                   help='Momentum matrix elements and their interpolation.')
+    p.add_argument('--pnn', metavar='DENSE_PNN',
+                   help='Band velocities from the interpolated bands.')
+    p.add_argument('--ratio', type=float, default=5,
+                   help='Number of star functions per k-point.')
+    p.set_defaults(func=interpolate)
+
+    # ==== integration ==== #
+    p = subparsers.add_parser('integrate',
+        help='Integrate a response over the Brillouin zone.')
+    p.add_argument('klist', help='Irreducible k-points.')
+    p.add_argument('symd', help='Symmetry operations (sym.d).')
+    p.add_argument('energies', help='Transition energies (energys.d).')
+    p.add_argument('integrand', help='Integrand from set_input_all.')
+    p.add_argument('spectrum', help='Output spectrum.')
+    p.add_argument('--energy-min', type=float, default=0.)
+    p.add_argument('--energy-max', type=float, default=10.)
+    p.add_argument('--energy-steps', type=int, default=2001)
+    p.add_argument('--sigma', type=float, default=0.15,
+                   help='Smearing (eV).')
+    p.add_argument('--method', default='histogram',
+                   choices=['histogram', 'gaussian', 'lorentzian',
+                            'adaptive', 'linear_tetrahedra', 'blochl'],
+                   help='Integration method.')
+    p.add_argument('--pnn', help='Band velocities (adaptive).')
+    p.add_argument('--pvectors', help='Primitive vectors (adaptive).')
+    p.add_argument('--nval', type=int,
+                   help='Number of valence bands in the transitions '
+                        '(adaptive, groups).')
+    p.add_argument('--factor', type=float, default=0.3,
+                   help='Scale of the adaptive broadening.')
+    p.add_argument('--tetrahedra',
+                   help='Tetrahedra (linear_tetrahedra, blochl).')
+    p.add_argument('--triangles',
+                   help='Triangles of a 2D grid, used instead of the '
+                        'tetrahedra.')
+    p.add_argument('--memory', type=float,
+                   help='Memory budget (MB); files are read by blocks.')
+    p.add_argument('--nproc', type=int, default=1,
+                   help='Number of processes.')
+    p.add_argument('--groups', metavar='FNAME',
+                   help='Also write the spectra of band groups, by default '
+                        'of each pair of bands.')
+    p.add_argument('--valence-groups', type=band_range, nargs='+',
+                   metavar='V1-V2', help='Valence band groups.')
+    p.add_argument('--conduction-groups', type=band_range, nargs='+',
+                   metavar='C1-C2', help='Conduction band groups.')
+    p.add_argument('--window', type=float, nargs=2, action='append',
+                   metavar=('EMIN', 'EMAX'),
+                   help='Energy window for the contributions of the '
+                        'k-points (may be repeated).')
+    p.add_argument('--contributions', metavar='FNAME',
+                   help='Output of the contributions of the k-points.')
+    p.set_defaults(func=integrate)
+
+    p = subparsers.add_parser('integrand',
+        help='Write the integrand of a response from eigen and pmn.')
+    p.add_argument('klist', help='K-points.')
+    p.add_argument('eigen', help='Eigenvalues (eV), with a k-point index.')
+    p.add_argument('pmn', help='Momentum matrix elements.')
+    p.add_argument('--pnn', help='Diagonal momentum matrix elements.')
+    p.add_argument('--nval', type=int, required=True,
+                   help='Number of valence bands.')
+    p.add_argument('--ncond', type=int, required=True,
+                   help='Number of conduction bands.')
+    p.add_argument('--response', choices=['chi1', 'shg'], default='chi1')
+    p.add_argument('--components', nargs='+', default=['xx'],
+                   help='Tensor components, e.g. xx yy or xyz.')
+    p.add_argument('--suffix', default='',
+                   help='Suffix of the output files.')
+    p.add_argument('--block', type=int, default=16,
+                   help='Number of k-points per block.')
+    p.add_argument('--memory', type=float,
+                   help='Memory budget (MB); sets the number of k-points '
+                        'per block.')
+    p.add_argument('--tol', type=float, default=1e-4,
+                   help='Degeneracy tolerance (eV).')
+    p.set_defaults(func=integrand)
+
+    # ==== band window ==== #
+    p = subparsers.add_parser('window',
+        help='Write the eigen, pmn and pnn files of a band window.')
+    p.add_argument('klist', help='List of k-points.')
+    p.add_argument('nval_total', type=int, help='Number of valence bands.')
+    p.add_argument('valence', type=int, nargs=2, metavar=('V1', 'V2'),
+                   help='Valence bands of the window (from 1).')
+    p.add_argument('conduction', type=int, nargs=2, metavar=('C1', 'C2'),
+                   help='Conduction bands of the window.')
+    p.add_argument('out_eigen', help='Output eigenvalues.')
+    p.add_argument('out_pmn', nargs='?', help='Output pmn.')
+    p.add_argument('out_pnn', nargs='?', help='Output pnn.')
+    p.add_argument('--eigen', help='Eigenvalues of all the bands.')
+    p.add_argument('--pmn', help='Momentum matrix elements of all the bands.')
+    p.add_argument('--pnn', help='Diagonal elements of all the bands.')
+    p.add_argument('--kstore', help='K-point store read instead of files.')
+    p.add_argument('--block', type=int, default=64,
+                   help='Number of k-points per block.')
+    p.set_defaults(func=window)
+
+    # ==== density of states ==== #
+    p = subparsers.add_parser('dos',
+        help='Density of states, joint density of states and gap.')
+    p.add_argument('klist', help='Irreducible k-points.')
+    p.add_argument('tetrahedra', help='Tetrahedra.')
+    p.add_argument('nval', type=int, help='Number of valence bands.')
+    p.add_argument('dos', help='Output density of states.')
+    p.add_argument('jdos', help='Output joint density of states.')
+    p.add_argument('--eigen', help='Eigenvalues (eV), with a k-point index.')
+    p.add_argument('--eig', nargs='+', help='_EIG files of Abinit.')
+    p.add_argument('--ncond', type=int,
+                   help='Number of conduction bands in the JDOS.')
+    p.add_argument('--triangles',
+                   help='Triangles of a 2D grid, used instead of the '
+                        'tetrahedra.')
+    p.add_argument('--energy-min', type=float)
+    p.add_argument('--energy-max', type=float)
+    p.add_argument('--energy-steps', type=int, default=2001)
+    p.add_argument('--jdos-max', type=float, default=10.,
+                   help='Largest transition energy of the JDOS.')
+    p.add_argument('--nspin', type=int, default=2,
+                   help='Spin degeneracy (1 for spinors).')
+    p.add_argument('--gap-min', type=float,
+                   help='Fail if the gap (eV) is smaller.')
+    p.add_argument('--gap-max', type=float,
+                   help='Fail if the gap (eV) is larger.')
+    p.set_defaults(func=dos)
+
+    # ==== triangles ==== #
+    p = subparsers.add_parser('triangles',
+        help='Split a two-dimensional k-point grid into triangles.')
+    p.add_argument('klist', help='Irreducible k-points.')
+    p.add_argument('symd', help='Symmetry operations (sym.d).')
+    p.add_argument('output', help='Output triangles.')
+    p.add_argument('kgrid', type=int, nargs=3, help='K-point grid.')
+    p.set_defaults(func=triangles)
+
+    # ==== timing ==== #
+    p = subparsers.add_parser('timeit',
+        help='Run a command and append its timing to a file.')
+    p.add_argument('output', help='Timing records (JSON lines).')
+    p.add_argument('cmd', nargs=argparse.REMAINDER,
+                   help='Command, after --.')
+    p.set_defaults(func=timeit)
+
+    p = subparsers.add_parser('trace',
+        help='Write the timeline of the instrumented tasks of a directory '
+             '(Chrome / Perfetto trace events).')
+    p.add_argument('dirname', help='Directory of the workflow.')
+    p.add_argument('output', help='Output trace (JSON).')
+    p.set_defaults(func=trace)
+
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if 'func' not in args:
+        get_parser().print_help()
+        return 1
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
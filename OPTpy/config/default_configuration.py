@@ -17,5 +17,7 @@ default_runscript = dict(
     first_line = '#!/bin/bash',
     header = [],
     footer = [],
+    instrument = False,
+    timeit = 'python -m OPTpy timeit',
     )
 
@@ -2,4 +2,5 @@ from .writable import *
 from .task import *
 from .workflow import *
 from .runscript import *
+from .executor import *
 from .F90io import *
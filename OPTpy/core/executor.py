@@ -0,0 +1,535 @@
+from __future__ import print_function, division
+import os
+import sys
+import time
+import shutil
+import signal
+import subprocess
+from collections import OrderedDict
+
+from .task import IOTask
+
+# Public
+__all__ = ['LocalExecutor']
+
+
+class LocalExecutor(object):
+    """
+    Execute the tasks of a workflow on the local machine, running
+    concurrently the tasks that the run script would run in background,
+    within a number of workers and a memory budget.
+
+        >>> flow = OPTflow(...)
+        >>> flow.write()
+        >>> LocalExecutor(flow, nworkers=8, memory=64).run()
+
+    A task is started when the tasks it depends on are completed
+    (see Workflow.get_dependencies), when enough workers are free
+    (one per MPI process), and when its predicted memory fits in the
+    memory left by the running tasks.
+    A task predicted above the whole budget, or with more processes
+    than workers, is run alone.
+    The tasks depending on a failed task are not started.
+
+    The ready tasks are started by priority: the predicted duration of
+    the longest path from the task to the end of the flow, so that the
+    tasks on the critical path go first. When the first ready task does
+    not fit, it is reserved the time at which the running tasks will
+    have freed enough resources, and shorter tasks that end before then
+    fill the idle workers (backfilling).
+
+    Optionally, a chunk that straggles behind its peers (e.g. on a slow
+    core or disk) is duplicated in a scratch directory when workers are
+    free, and the copy that ends first is kept.
+
+    A task fails when it exits with an error, or when it has an output
+    file (e.g. Abinit tasks) that is missing or lacks the completion
+    tag. A failed task is executed again after a delay, doubled at each
+    attempt. A completed task is marked (see Task.mark_completed), so that
+    a new execution of the flow only runs the tasks that did not
+    complete, and the tasks that depend on them.
+    """
+
+    _STATUS_SKIPPED = 'Skipped'
+
+    def __init__(self, workflow, nworkers=None, memory=None, db=None,
+                 model=None, speculate=False, straggler_factor=2.,
+                 straggler_fraction=0.5, retries=2, retry_delay=10.,
+                 resume=True, poll=1., file=None):
+        """
+        Arguments
+        ---------
+
+        workflow : Workflow
+            Flow whose tasks are executed, already written.
+
+        Keyword arguments
+        -----------------
+
+        nworkers : int (number of CPUs)
+            Number of processes running at once, counting nproc
+            for the tasks run with MPI.
+        memory : float, optional
+            Memory available to the running tasks, in GB.
+        db : TimingDB, optional
+            Timing of previous runs. The largest memory used by a task
+            with the same timing_key, per process and times the number
+            of processes, is preferred to its memory_estimate if larger.
+        model : CostModel, optional
+            Predicts the duration of the tasks from their timing_key.
+            Without prediction, every task counts as one unit of time
+            in the priorities, and is not restricted when backfilling.
+        speculate : bool (False)
+            Start a copy of the chunks that straggle behind their peers
+            (see is_straggler) in a scratch directory next to theirs,
+            with the workers left free. The copy that ends first is kept
+            in the directory of the task, the other one is stopped.
+        straggler_factor : float (2.)
+            A chunk straggles when it has run longer than this factor
+            times the median duration of its completed peers,
+        straggler_fraction : float (0.5)
+            once at least this fraction of its peers completed.
+        retries : int (2)
+            Number of times a failed task is executed again.
+        retry_delay : float (10.)
+            Delay before the first new attempt (s), doubled at each attempt.
+        resume : bool (True)
+            Do not execute again the tasks marked as completed,
+            unless a task they depend on is executed.
+        poll : float (1.)
+            Interval between the checks of the running tasks, in s.
+        file : (sys.stdout)
+            Where the start and the end of the tasks are reported.
+        """
+        if workflow is None or not workflow.tasks:
+            raise Exception('No tasks to execute.')
+        for task in workflow.tasks:
+            if workflow.is_merged(task):
+                raise Exception(
+                    'Task {} is merged into the run script of the flow '
+                    'and cannot be executed separately.'.format(task.dirname))
+
+        if nworkers is None:
+            import multiprocessing
+            nworkers = multiprocessing.cpu_count()
+        self.workflow = workflow
+        self.nworkers = max(1, int(nworkers))
+        self.memory = memory * 1024.**3 if memory else None
+        self.db = db
+        self.model = model
+        self.poll = poll
+        self.file = file if file is not None else sys.stdout
+
+        self.dependencies = workflow.get_dependencies()
+        self.returncodes = OrderedDict()
+        self.started = dict()
+        self.priorities = self.get_priorities()
+
+        self.speculate = speculate
+        self.straggler_factor = straggler_factor
+        self.straggler_fraction = straggler_fraction
+        # Files of the tasks before they start, duration and size of the
+        # files of the completed tasks, and copies of the stragglers.
+        self.files = dict()
+        self.durations = dict()
+        self.sizes = dict()
+        self.speculative = dict()
+        self.promoted = dict()
+
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.resume = resume
+        self.attempts = dict()
+        self.retry_time = dict()
+        self.failures = OrderedDict()
+
+    def get_duration(self, task):
+        """Predicted duration of a task (s), or None."""
+        if self.model is not None and getattr(task, 'timing_key', None):
+            return self.model.predict(task.timing_key)
+        return None
+
+    def get_priorities(self):
+        """
+        Return {task : priority}, the predicted duration of the longest
+        path from the start of the task to the end of the flow.
+        """
+        dependents = dict((task, list()) for task in self.dependencies)
+        for task, dependencies in self.dependencies.items():
+            for dependency in dependencies:
+                dependents[dependency].append(task)
+
+        # The dependencies of a task are always before it in the flow.
+        priorities = dict()
+        for task in reversed(list(self.dependencies)):
+            duration = self.get_duration(task)
+            if duration is None:
+                duration = 1.
+            priorities[task] = duration + max(
+                [priorities[t] for t in dependents[task]] or [0.])
+        return priorities
+
+    def get_memory(self, task):
+        """
+        Predicted memory of a task (bytes): the larger of its
+        memory_estimate and of the memory of the previous runs, if any,
+        otherwise 0. The recorded peak memory is that of the largest
+        process, counted once for each MPI process.
+        """
+        memory = getattr(task, 'memory_estimate', None) or 0
+        if self.db is not None and getattr(task, 'timing_key', None):
+            maxrss = self.db.max_rss(task.timing_key)
+            if maxrss:
+                memory = max(memory, maxrss * 1024 * self.get_nproc(task))
+        return memory
+
+    @staticmethod
+    def get_nproc(task):
+        """Number of workers used by a task."""
+        if getattr(task, 'mpirun', None):
+            return max(1, int(task.nproc))
+        return 1
+
+    def get_ready(self, pending, now=None):
+        """
+        Pending tasks whose dependencies completed, by decreasing
+        priority, then in the flow order. If now is given, the tasks
+        waiting to be executed again later are excluded.
+        """
+        ready = [task for task in pending
+                 if all(self.returncodes.get(dep) == 0
+                        for dep in self.dependencies[task]) and
+                    (now is None or self.retry_time.get(task, 0) <= now)]
+        ready.sort(key=lambda task: -self.priorities[task])
+        return ready
+
+    def fits(self, task, running):
+        """Whether a task can start next to the running tasks."""
+        if not running:
+            return True
+        nproc = sum(self.get_nproc(t) for t in running)
+        if nproc + self.get_nproc(task) > self.nworkers:
+            return False
+        if self.memory is None:
+            return True
+        used = sum(self.get_memory(t) for t in running)
+        return used + self.get_memory(task) <= self.memory
+
+    def get_busy(self, running):
+        """
+        Return the (task, start time) of the running tasks
+        and of their speculative copies.
+        """
+        busy = [(task, self.started[task]) for task in running]
+        busy.extend((task, copy[2]) for task, copy in self.speculative.items())
+        return busy
+
+    def get_reservation(self, task, busy, now):
+        """
+        Predicted time at which enough running tasks will have ended
+        for a task to start, or None if a duration is unknown.
+        """
+        ends = list()
+        for i, (t, start) in enumerate(busy):
+            duration = self.get_duration(t)
+            if duration is None:
+                return None
+            ends.append((max(now, start + duration), i))
+        ends.sort()
+        remaining = dict(enumerate(t for t, start in busy))
+        for end, i in ends:
+            del remaining[i]
+            if self.fits(task, list(remaining.values())):
+                return end
+        return now
+
+    def schedule(self, pending, running):
+        """Start the ready tasks that fit, by priority, with backfilling."""
+        now = time.time()
+        reservation = blocked = None
+        for task in self.get_ready(pending, now):
+            busy = self.get_busy(running)
+            if not self.fits(task, [t for t, start in busy]):
+                if blocked is None:
+                    blocked = task
+                    reservation = self.get_reservation(task, busy, now)
+                continue
+            if blocked is not None and reservation is not None:
+                # Backfill only if the task ends before the reservation.
+                duration = self.get_duration(task)
+                if duration is None or now + duration > reservation:
+                    continue
+            task.clear_completed()
+            self.files[task] = os.listdir(task.dirname)
+            running[task] = self.start(task)
+            self.started[task] = now
+            pending.remove(task)
+
+    def start(self, task, dirname=None):
+        dirname = dirname or task.dirname
+        print('   Start  {}'.format(dirname), file=self.file)
+        # In its own process group, to be stopped with its children.
+        return subprocess.Popen(['bash', task.runscript.fname],
+                                cwd=dirname, preexec_fn=os.setsid)
+
+    @staticmethod
+    def stop(process):
+        """Stop a process and its children."""
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        process.wait()
+
+    # =================== Speculative execution =================== #
+
+    @staticmethod
+    def get_size(dirname):
+        """Size of the files of a directory, as a measure of progress."""
+        size = 0
+        for name in os.listdir(dirname):
+            fname = os.path.join(dirname, name)
+            if os.path.isfile(fname) and not os.path.islink(fname):
+                size += os.path.getsize(fname)
+        return size
+
+    def get_peers(self, task):
+        """
+        Tasks executed as chunks of the same stage as a task:
+        same dependencies and same parent directory.
+        """
+        parent = os.path.dirname(os.path.normpath(task.dirname))
+        return [t for t in self.dependencies
+                if t is not task and
+                   self.dependencies[t] == self.dependencies[task] and
+                   os.path.dirname(os.path.normpath(t.dirname)) == parent]
+
+    def is_straggler(self, task, now):
+        """
+        Whether a running task is so late compared to its completed
+        peers that a fresh copy is expected to end first: it has run
+        longer than straggler_factor times their median duration, and
+        the time left at its rate of progress (size of its files
+        compared to theirs) is longer than their median duration.
+        """
+        peers = self.get_peers(task)
+        done = [t for t in peers if self.returncodes.get(t) == 0]
+        if not done or len(done) < self.straggler_fraction * len(peers):
+            return False
+
+        median = sorted(self.durations[t] for t in done)[len(done) // 2]
+        elapsed = now - self.started[task]
+        if elapsed < self.straggler_factor * median:
+            return False
+
+        sizes = sorted(self.sizes[t] for t in done)
+        size = sizes[len(sizes) // 2]
+        if size > 0:
+            progress = min(1., max(0.01, self.get_size(task.dirname) / size))
+            if elapsed * (1. - progress) / progress < median:
+                return False
+        return True
+
+    def get_copy_dirname(self, task):
+        # A sibling directory, so that the relative links remain valid.
+        return os.path.normpath(task.dirname) + '.spec'
+
+    def copy_task(self, task):
+        """
+        Copy the files present in the directory of a task before it
+        started into a scratch directory. Return the scratch directory.
+        """
+        source = os.path.normpath(task.dirname)
+        dest = self.get_copy_dirname(task)
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        os.mkdir(dest)
+        for name in self.files[task]:
+            src = os.path.join(source, name)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), os.path.join(dest, name))
+            elif os.path.isdir(src):
+                shutil.copytree(src, os.path.join(dest, name), symlinks=True)
+            elif os.path.exists(src):
+                shutil.copy2(src, os.path.join(dest, name))
+        return dest
+
+    def speculate_stragglers(self, running):
+        """Start a copy of the stragglers, with the workers left free."""
+        now = time.time()
+        for task in running:
+            if task in self.speculative or task in self.promoted:
+                continue
+            if not self.is_straggler(task, now):
+                continue
+            if not self.fits(task, [t for t, start in self.get_busy(running)]):
+                continue
+            dirname = self.copy_task(task)
+            self.speculative[task] = (self.start(task, dirname), dirname, now)
+
+    def promote(self, task, dirname):
+        """Replace the directory of a task by the one of its copy."""
+        original = os.path.normpath(task.dirname)
+        straggler = original + '.straggler'
+        if os.path.exists(straggler):
+            shutil.rmtree(straggler)
+        os.rename(original, straggler)
+        os.rename(dirname, original)
+        shutil.rmtree(straggler)
+
+    def poll_speculative(self, task, running):
+        """
+        Check the copy of a running task. Return the exit code of the
+        task if it is decided, otherwise None.
+        """
+        process, dirname, start = self.speculative[task]
+        original = running[task]
+        returncode = original.poll()
+        copy_returncode = process.poll()
+
+        if returncode == 0 or (returncode is None and copy_returncode
+                               not in (None, 0)):
+            # The original wins, or the copy failed.
+            if copy_returncode is None:
+                self.stop(process)
+            del self.speculative[task]
+            shutil.rmtree(dirname)
+            return returncode
+
+        if copy_returncode == 0:
+            if returncode is None:
+                self.stop(original)
+            del self.speculative[task]
+            self.promote(task, dirname)
+            print('   Copy   {} ended first'.format(dirname), file=self.file)
+            return 0
+
+        if returncode is not None and copy_returncode is None:
+            # The original failed: wait for the copy.
+            running[task] = process
+            self.promoted[task] = dirname
+            del self.speculative[task]
+            return None
+
+        if returncode is not None:
+            # Both failed.
+            del self.speculative[task]
+            shutil.rmtree(dirname)
+        return returncode
+
+    # ======================= Failures ======================== #
+
+    def classify(self, task, returncode):
+        """
+        Return the reason why a task failed, or None if it completed:
+        its exit code, a missing output file, or an output file without
+        the completion tag.
+        """
+        if returncode != 0:
+            return 'exit code {}'.format(returncode)
+        if not isinstance(task, IOTask):
+            return None
+        output_fname = task.output_fname
+        if not os.path.basename(output_fname):
+            return None
+        status = task.get_status()
+        if status == task._STATUS_UNSTARTED:
+            return 'missing output {}'.format(output_fname)
+        if status == task._STATUS_UNFINISHED:
+            return "no '{}' in {}".format(task._TAG_JOB_COMPLETED,
+                                          output_fname)
+        return None
+
+    def resume_completed(self, pending):
+        """
+        Count as completed the tasks marked as completed, whose
+        dependencies are all marked as completed too.
+        """
+        for task in list(pending):
+            if ( task.is_marked_completed() and
+                 all(dep in self.returncodes and dep not in pending
+                     for dep in self.dependencies[task]) ):
+                self.returncodes[task] = 0
+                pending.remove(task)
+                print('   Done   {} (marked as completed)'.format(task.dirname),
+                      file=self.file)
+
+    def end(self, task, returncode, pending):
+        """Mark a task that ended as completed, failed, or to retry."""
+        self.retry_time.pop(task, None)
+        reason = self.classify(task, returncode)
+        if reason is None:
+            task.mark_completed()
+            self.returncodes[task] = 0
+            self.durations[task] = time.time() - self.started[task]
+            self.sizes[task] = self.get_size(task.dirname)
+            print('   Done   {}'.format(task.dirname), file=self.file)
+            return
+
+        attempt = self.attempts.get(task, 0)
+        if attempt < self.retries:
+            delay = self.retry_delay * 2 ** attempt
+            self.attempts[task] = attempt + 1
+            self.retry_time[task] = time.time() + delay
+            pending.append(task)
+            print('   Retry  {} ({}) in {:.1f} s'.format(
+                  task.dirname, reason, delay), file=self.file)
+            return
+
+        self.failures[task] = reason
+        self.returncodes[task] = returncode or 1
+        print('   Failed {} ({})'.format(task.dirname, reason),
+              file=self.file)
+
+    # ============================================================= #
+
+    def skip_failed(self, pending):
+        """Mark the pending tasks that depend on a failed task."""
+        for task in list(pending):
+            if any(self.returncodes.get(dep) not in (None, 0)
+                   for dep in self.dependencies[task]):
+                self.returncodes[task] = self._STATUS_SKIPPED
+                pending.remove(task)
+                print('   Skip   {}'.format(task.dirname), file=self.file)
+
+    def run(self):
+        """
+        Execute the tasks. Return an OrderedDict {task : exit code},
+        with 'Skipped' for the tasks depending on a failed task.
+        The reasons of the failures are kept in the failures attribute.
+        """
+        pending = list(self.dependencies)
+        running = OrderedDict()
+        if self.resume:
+            self.resume_completed(pending)
+
+        while pending or running:
+            self.schedule(pending, running)
+            if self.speculate:
+                self.speculate_stragglers(running)
+
+            time.sleep(self.poll if running or self.retry_time else 0)
+
+            for task, process in list(running.items()):
+                if task in self.speculative:
+                    returncode = self.poll_speculative(task, running)
+                else:
+                    returncode = process.poll()
+                if returncode is None:
+                    continue
+
+                del running[task]
+                if task in self.promoted:
+                    dirname = self.promoted.pop(task)
+                    if returncode == 0:
+                        self.promote(task, dirname)
+                    else:
+                        shutil.rmtree(dirname)
+                self.end(task, returncode, pending)
+
+            self.skip_failed(pending)
+            if pending and not running and not self.get_ready(pending):
+                raise Exception('Tasks cannot start: circular dependencies.')
+
+        return OrderedDict((task, self.returncodes[task])
+                           for task in self.dependencies)
@@ -1,7 +1,9 @@
 from collections import OrderedDict
+import re
 import subprocess
 
 from ..config import default_runscript
+from ..utils.timing import get_timing_fname
 from .writable import Writable
 
 # Public
@@ -46,8 +48,19 @@ class RunScript(Writable):
         first_line :
             The first line of the script, e.g. '#!/bin/bash'.
 
+        instrument : bool (False)
+            Call the commands of 'main' through 'timeit', which records
+            their wall time, CPU time, peak memory and exit code
+            in timing_<script>.jsonl, e.g. timing_run.jsonl for run.sh
+            (see get_timing_fname). Shell constructs (conditions, loops,
+            pipes, assignments, ...) are left as they are.
+
+        timeit :
+            Command recording the timing, e.g. 'python -m OPTpy timeit'.
+
         """
 
+        self.fname = 'run.sh'
         self.first_line = str()
         self.header = list()
         self.variables = OrderedDict()
@@ -81,6 +94,10 @@ class RunScript(Writable):
         self.first_line = kwargs.get('first_line',
                                      default_runscript['first_line'])
 
+        self.instrument = kwargs.get('instrument',
+                                     default_runscript['instrument'])
+        self.timeit = kwargs.get('timeit', default_runscript['timeit'])
+
         header = kwargs.get('header', default_runscript['header'])
         if isinstance(header, str):
             self.header.append(header)
@@ -138,6 +155,30 @@ class RunScript(Writable):
         """Delete a variable."""
         del self.variables[key]
 
+    # Lines that are not a simple command are not timed.
+    _untimed_words = ('if', 'then', 'else', 'elif', 'fi', 'for', 'do',
+                      'done', 'while', 'until', 'case', 'esac', 'function',
+                      'cd', 'wait', 'export', 'source', '.', 'eval', 'exit',
+                      'echo', 'ln', 'rm', 'mv', 'cp', 'mkdir', 'touch',
+                      'cat', 'bash', 'sh', 'module', 'set', 'unset')
+    _untimed_tokens = ('|', '`', '$(', '{', '}', '(', ')')
+
+    def _is_timed(self, line):
+        """
+        Whether a line of main starts with a simple command that can be
+        timed, e.g. 'cmd args > out' or 'cmd args || { ...; exit 1; }'.
+        """
+        line = line.strip()
+        if not line or line.startswith('#') or '\n' in line:
+            return False
+        line = re.split(r'\|\||&&|;', line)[0].strip()
+        if not line or any(token in line for token in self._untimed_tokens):
+            return False
+        first = line.split()[0]
+        if '=' in first or first in self._untimed_words:
+            return False
+        return True
+
     def _get_quoted_string(self, value):
 
         # Strip the value of single or double quotes
@@ -171,7 +212,12 @@ class RunScript(Writable):
         for line in self.header:
             S += line + '\n'
 
-        for name, value in self.variables.iteritems():
+        variables = OrderedDict(self.variables)
+        if self.instrument:
+            variables['TIMEIT'] = '{} {} --'.format(
+                self.timeit, get_timing_fname(self.fname))
+
+        for name, value in variables.iteritems():
             value = self._get_quoted_string(value)
             S += '{}={}\n'.format(name, value)
 
@@ -190,6 +236,8 @@ class RunScript(Writable):
 
         S += '\n'
         for line in self.main:
+            if self.instrument and self._is_timed(line):
+                line = '$TIMEIT ' + line.lstrip()
             S += line + '\n'
 
         S += '\n'
@@ -4,9 +4,13 @@ import os
 import subprocess
 import pickle
 import contextlib
+import json
+import time
+import hashlib
 
 from ..config import default_mpi
-from ..utils import exec_from_dir, last_lines_contain
+from ..utils import (exec_from_dir, last_lines_contain, file_stat,
+                     get_timing_fname, read_timings, summarize_timings)
 from .runscript import RunScript
 
 # Public
@@ -32,6 +36,13 @@ class Task(object):
         }
     _end_color = '\033[0m'
 
+    # Stage and parameters of the task, used to record its timing
+    # in a TimingDB (set by the flows).
+    timing_key = None
+
+    # Predicted peak memory of the task in bytes (see LocalExecutor).
+    memory_estimate = None
+
     def __init__(self, dirname='./', runscript_fname='run.sh', store_variables=False, *args, **kwargs):
         """
         Keyword arguments
@@ -45,6 +56,12 @@ class Task(object):
             Write all the initialization variables in a pkl file
             at writing time. Must be set at initialization
             in order to be effective.
+        instrument : bool (False)
+            Record the wall time, CPU time and peak memory of the
+            commands of the run script in timing_<script>.jsonl,
+            e.g. timing_run.jsonl for run.sh (see RunScript).
+        OPTPY : str ('python -m OPTpy')
+            Command to call the OPTpy tools, used to record the timing.
 
         """
 
@@ -53,6 +70,11 @@ class Task(object):
         self.runscript.fname = runscript_fname
         self.variables = kwargs if store_variables else dict()
 
+        if 'instrument' in kwargs:
+            self.runscript.instrument = kwargs['instrument']
+        if 'OPTPY' in kwargs:
+            self.runscript.timeit = '{} timeit'.format(kwargs['OPTPY'])
+
     @property
     def dirname(self):
         return self._dirname
@@ -149,6 +171,60 @@ class Task(object):
         Completed, Unstarted, Unfinished, Unknown.
         """
         return self._STATUS_UNKNOWN
+
+    @property
+    def completed_fname(self):
+        """
+        Marker written when the task completed (see LocalExecutor),
+        named after the run script, e.g. .run.sh.completed, since
+        several tasks may run in the same directory.
+        """
+        return os.path.join(self.dirname,
+                            '.{}.completed'.format(self.runscript.fname))
+
+    def _get_runscript_checksum(self):
+        with open(self.runscript_fname, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def mark_completed(self):
+        """
+        Write the completion marker, with the checksum of the run script,
+        so that the task is not executed again while its script is the same,
+        even if the script is written again.
+        """
+        with open(self.completed_fname, 'w') as f:
+            json.dump(dict(time=time.time(),
+                           runscript=self._get_runscript_checksum()), f)
+
+    def is_marked_completed(self):
+        """Whether the task completed with its current run script."""
+        try:
+            with open(self.completed_fname, 'r') as f:
+                marker = json.load(f)
+            return marker['runscript'] == self._get_runscript_checksum()
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+
+    def clear_completed(self):
+        """Remove the completion marker."""
+        if os.path.exists(self.completed_fname):
+            os.remove(self.completed_fname)
+
+    @property
+    def timing_fname(self):
+        """File holding the timing of the instrumented commands."""
+        return os.path.join(self.dirname,
+                            get_timing_fname(self.runscript.fname))
+
+    def get_timings(self):
+        """
+        Return the totals of the timing records of the task
+        (see summarize_timings), or None if nothing was recorded.
+        """
+        records = read_timings(self.timing_fname)
+        if not records:
+            return None
+        return summarize_timings(records)
         
     def report(self, file=None, color=True, **kwargs):
         """
@@ -173,6 +249,12 @@ class Task(object):
 
         s = '   {:<40}  -  Status :  {}'.format(self._TASK_NAME, status)
 
+        timings = self.get_timings()
+        if timings is not None:
+            s += '  ({:.1f} s, cpu {:.1f} s, {:.0f} MB)'.format(
+                timings['elapsed'], timings['user'] + timings['system'],
+                timings['maxrss'] / 1024.)
+
         file = file if file is not None else sys.stdout
         print(s, file=file)
 
@@ -349,30 +431,46 @@ class IOTask(Task):
     _output_fname = ''
     _TAG_JOB_COMPLETED = 'JOB COMPLETED'
 
+    # Whether the output files contain the completion tag, shared by all
+    # tasks: {(path, tag) : (size, mtime, completed)}
+    _status_cache = dict()
+
     # It is important that this task has no __init__ function,
     # because it is mostly used with multiple-inheritance classes.
 
     def get_status(self, check_time=False):
 
-        if not self.input_fname or not self.output_fname:
+        input_fname = self.input_fname
+        output_fname = self.output_fname
+        if not input_fname or not output_fname:
             return self._STATUS_UNKNOWN
 
-        if not os.path.exists(self.input_fname):
+        input_stat = file_stat(input_fname)
+        if input_stat is None:
             return self._STATUS_UNSTARTED
 
-        if not os.path.exists(self.output_fname):
+        output_stat = file_stat(output_fname)
+        if output_stat is None:
             return self._STATUS_UNSTARTED
 
-        input_creation_time = os.path.getmtime(self.input_fname)
-        output_creation_time = os.path.getmtime(self.output_fname)
-
-        if check_time and input_creation_time > output_creation_time:
+        if check_time and input_stat.st_mtime > output_stat.st_mtime:
             return self._STATUS_UNSTARTED
 
         if not self._TAG_JOB_COMPLETED:
             return self._STATUS_UNKNOWN
 
-        if last_lines_contain(self.output_fname, self._TAG_JOB_COMPLETED):
+        # The output is read again only if it changed since the last check.
+        key = (os.path.abspath(output_fname), self._TAG_JOB_COMPLETED)
+        signature = (output_stat.st_size, output_stat.st_mtime)
+        cached = self._status_cache.get(key)
+        if cached is not None and cached[:2] == signature:
+            completed = cached[2]
+        else:
+            completed = last_lines_contain(output_fname,
+                                           self._TAG_JOB_COMPLETED)
+            self._status_cache[key] = signature + (completed,)
+
+        if completed:
             return self._STATUS_COMPLETED
 
         return self._STATUS_UNFINISHED
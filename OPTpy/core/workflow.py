@@ -1,7 +1,13 @@
 from __future__ import print_function
 import os
+import sys
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from .task import Task
+from ..utils import (file_stat, read_timings, summarize_timings,
+                     write_trace)
 
 __all__ = ['Workflow']
 
@@ -29,8 +35,15 @@ class Workflow(Task):
     def __init__(self, tasks=None, *args, **kwargs):
         super(Workflow, self).__init__(*args, **kwargs)
         self.tasks = list()
+        # How each task is executed, and the 'wait' barriers,
+        # given by the index of the task that follows them.
+        self._task_background = list()
+        self._task_merged = list()
+        self._waits = set()
         if tasks is not None:
             self.tasks.extend(tasks)
+            self._task_background.extend(False for task in tasks)
+            self._task_merged.extend(False for task in tasks)
 
     def add_task(self, task, background=False,merge=False):
         """
@@ -84,6 +97,38 @@ class Workflow(Task):
                     self.runscript.append('bash {}'.format(task.runscript.fname))
 
         self.tasks.append(task)
+        self._task_background.append(bool(background) and not merge)
+        self._task_merged.append(bool(merge))
+
+    def add_wait(self):
+        """Wait for the tasks running in background."""
+        self.runscript.append("wait\n")
+        self._waits.add(len(self.tasks))
+
+    def get_dependencies(self):
+        """
+        Return the tasks that must be completed before each task starts,
+        following the execution of the run script, as an OrderedDict
+        {task : list of tasks}. A task waits for the previous task run
+        in foreground, and for the tasks run in background before
+        the last 'wait' (see add_wait).
+        """
+        dependencies = OrderedDict()
+        barrier = list()
+        running = list()
+        for i, task in enumerate(self.tasks):
+            if i in self._waits:
+                barrier, running = barrier + running, list()
+            dependencies[task] = list(barrier)
+            if self._task_background[i]:
+                running.append(task)
+            else:
+                barrier = [task]
+        return dependencies
+
+    def is_merged(self, task):
+        """Whether a task is executed within the run script of the flow."""
+        return self._task_merged[self.tasks.index(task)]
 
     def add_tasks(self, tasks, *args, **kwargs):
         for task in tasks:
@@ -97,6 +142,7 @@ class Workflow(Task):
         # The user is expected to modify the runscript (e.g. to restart
         # the calculation and skip the first steps that completed normally).
         # Therefore, the syntax must remain as simple as possible...
+        # LocalExecutor restarts a flow from the tasks that did not complete.
         if ( self.background ) :
             background="&"
         else:
@@ -157,5 +203,174 @@ class Workflow(Task):
         for task in self.tasks:
             task.report(*args, **kwargs)
 
+    def iter_tasks(self):
+        """
+        Iterate over the tasks that are not made of other tasks,
+        through the nested workflows.
+        """
+        for task in self.tasks:
+            if isinstance(task, Workflow) and task.tasks:
+                for subtask in task.iter_tasks():
+                    yield subtask
+            else:
+                yield task
+
+    def get_stage(self, task):
+        """Stage of a task: its top directory within the workflow."""
+        relpath = os.path.relpath(task.dirname, self.dirname)
+        return relpath.split(os.sep)[0]
+
+    def get_statuses(self, nthreads=16, **kwargs):
+        """
+        Return the list of (task, status) of all the tasks
+        (see iter_tasks). The statuses are checked concurrently
+        by nthreads threads, since the checks are bound by file access.
+        """
+        tasks = list(self.iter_tasks())
+        if nthreads <= 1 or len(tasks) <= 1:
+            return [(task, task.get_status(**kwargs)) for task in tasks]
+        pool = ThreadPool(min(nthreads, len(tasks)))
+        try:
+            statuses = pool.map(lambda task: task.get_status(**kwargs), tasks)
+        finally:
+            pool.close()
+            pool.join()
+        return list(zip(tasks, statuses))
+
+    @staticmethod
+    def _get_elapsed(task, now):
+        """
+        Time spent by a task, from its input to its output
+        (or to now if it is not completed), or None without input.
+        """
+        input_fname = getattr(task, 'input_fname', None)
+        input_stat = file_stat(input_fname) if input_fname else None
+        if input_stat is None:
+            return None
+        output_stat = file_stat(task.output_fname)
+        end = output_stat.st_mtime if output_stat is not None else now
+        return max(0., end - input_stat.st_mtime)
+
+    def summary(self, nthreads=16, nslowest=5, **kwargs):
+        """
+        Return a summary of the status of all the tasks, as a dict:
+
+            counts : {status : number of tasks}
+            stages : {stage : {'counts' : {status : number},
+                               'total' : number of tasks,
+                               'progress' : fraction completed}}
+            slowest : list of (dirname, status, elapsed time in s)
+                of the nslowest started tasks, from their recorded
+                timing or else from the modification times of their
+                input and output.
+            timings : {stage : totals of the timing records}
+                for the stages with instrumented tasks
+                (see Task.get_timings and summarize_timings).
+
+        Keyword arguments
+        -----------------
+        nthreads : int (16)
+            Number of threads checking the statuses.
+        nslowest : int (5)
+            Number of slowest tasks listed.
+        check_time: bool (False)
+            See Task.report.
+        """
+        statuses = self.get_statuses(nthreads, **kwargs)
+        now = time.time()
+
+        counts = OrderedDict()
+        stages = OrderedDict()
+        records = OrderedDict()
+        elapsed = list()
+        for task, status in statuses:
+            name = self.get_stage(task)
+            counts[status] = counts.get(status, 0) + 1
+            stage = stages.setdefault(name,
+                                      dict(counts=OrderedDict(), total=0))
+            stage['counts'][status] = stage['counts'].get(status, 0) + 1
+            stage['total'] += 1
+
+            task_records = read_timings(task.timing_fname)
+            if task_records:
+                records.setdefault(name, list()).extend(task_records)
+                seconds = summarize_timings(task_records)['elapsed']
+            elif status == self._STATUS_UNSTARTED:
+                continue
+            else:
+                seconds = self._get_elapsed(task, now)
+            if seconds is not None:
+                elapsed.append((task.dirname, status, seconds))
+
+        for stage in stages.values():
+            stage['progress'] = (
+                stage['counts'].get(self._STATUS_COMPLETED, 0) /
+                float(stage['total']))
+        elapsed.sort(key=lambda item: item[2], reverse=True)
+
+        timings = OrderedDict((name, summarize_timings(stage_records))
+                              for name, stage_records in records.items())
+
+        return dict(counts=counts, stages=stages, slowest=elapsed[:nslowest],
+                    timings=timings)
+
+    def report_summary(self, file=None, **kwargs):
+        """
+        Print the summary of the status of all the tasks:
+        progress of each stage, timing of the instrumented stages,
+        and the slowest tasks.
+        See summary for the keyword arguments.
+        """
+        summary = self.summary(**kwargs)
+        file = file if file is not None else sys.stdout
+
+        print('   {:<40}  -  {}'.format('Stage', 'Completed'), file=file)
+        for name, stage in summary['stages'].items():
+            others = ', '.join('{} {}'.format(n, status)
+                               for status, n in stage['counts'].items()
+                               if status != self._STATUS_COMPLETED)
+            print('   {:<40}  -  {:>4}/{:<4} {}'.format(
+                  name, stage['counts'].get(self._STATUS_COMPLETED, 0),
+                  stage['total'], others), file=file)
+
+        if summary['timings']:
+            print('   {:<40}  -  {:>10} {:>10} {:>8} {:>7}'.format(
+                  'Timing', 'wall (s)', 'cpu (s)', 'MB', 'failed'),
+                  file=file)
+            for name, timing in summary['timings'].items():
+                print('   {:<40}  -  {:>10.1f} {:>10.1f} {:>8.0f} {:>7}'.format(
+                      name, timing['elapsed'],
+                      timing['user'] + timing['system'],
+                      timing['maxrss'] / 1024., timing['failed']), file=file)
+
+        if summary['slowest']:
+            print('   Slowest tasks:', file=file)
+            for dirname, status, seconds in summary['slowest']:
+                print('   {:<40}  -  {:>10.1f} s  {}'.format(
+                      dirname, seconds, status), file=file)
+
+    def get_task_timings(self):
+        """
+        Return the timing records of the instrumented tasks,
+        as an OrderedDict {task directory relative to dirname : records}.
+        """
+        timings = OrderedDict()
+        for task in self.iter_tasks():
+            records = read_timings(task.timing_fname)
+            if records:
+                name = os.path.relpath(task.dirname, self.dirname)
+                timings.setdefault(name, list()).extend(records)
+        return timings
+
+    def write_trace(self, fname):
+        """
+        Write the timeline of the instrumented tasks as trace events
+        (Chrome / Perfetto format), with one track per worker slot.
+        """
+        write_trace(fname, self.get_task_timings())
+
     def clear_tasks(self):
         del self.tasks[:]
+        del self._task_background[:]
+        del self._task_merged[:]
+        self._waits.clear()
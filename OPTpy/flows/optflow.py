@@ -5,6 +5,8 @@ from __future__ import print_function
 #from os.path import dirname
 #from os import getcwd
 import os
+import sys
+import numpy as np
 from ..external import Structure
 from ..core import Workflow
 from ..Abinit import AbinitScfTask, AbinitWfnTask
@@ -50,8 +52,63 @@ class OPTflow(Workflow):
         split_by_proc : logic, optional
             Default = False
             Split WFN/RPMS tasks by number of processors.
+        ntask : int, optional
+            Number of chunks of the split WFN/RPMNS tasks, a divisor of
+            nproc, each chunk running on nproc/ntask processes.
+            Default: nproc, or chosen with cost_model.
+        cost_model : CostModel, optional
+            Choose ntask among the divisors of nproc by the lowest wall
+            time predicted from the previous runs (see choose_ntask).
         structure : pymatgen.Structure
             Structure object containing information on the unit cell.
+        reuse_dirname : str, optional
+            Directory holding the k-point list, eigenvalues and matrix
+            elements of a previous calculation on a coarser k-point grid.
+            If the grids are nested, WFN and RPMNS are done only for the
+            k-points missing in the previous calculation.
+        reuse_kgrid : list(3), int, optional
+            K-point grid of the previous calculation.
+            Default: the finest nested grid found in reuse_dirname.
+        kstore_fname : str, optional
+            K-point store in which the RPMNS tasks append their results.
+            Only the k-points missing from the store are computed,
+            so that an interrupted calculation can be completed.
+        kgrid_interpolation : list(3), int, optional
+            Denser k-point grid onto which the eigenvalues and matrix
+            elements computed on kgrid_response are interpolated with
+            star functions before the response is computed.
+            The interpolated matrix elements have no phase, so that only
+            the linear response (response = 1) with diagonal components
+            (e.g. 'xx') can be computed (see INTERPflow).
+        preview : bool, optional
+            Default = False
+            Quick approximate calculation to check the parameters before
+            a production run: the k-point grid and the number of conduction
+            bands are reduced, and the response is integrated with a
+            Gaussian smearing instead of tetrahedra.
+        preview_kgrid : list(3), int, optional
+            K-point grid of the preview.
+            Default: kgrid_response divided by 2 along each direction.
+        preview_ncond : int, optional
+            Number of conduction bands of the preview.
+            Default: half of ncond.
+        dos : bool, optional
+            Default = False
+            Compute the density of states, the joint density of states
+            and the gap from the eigenvalues of the WFN tasks (or of RPMNS
+            when k-points are reused), and stop the calculation before
+            the matrix elements if the gap is outside [gap_min, gap_max].
+        gap_min, gap_max : float, optional
+            Bounds of the gap (eV), see DOSflow. Default: 0 and None.
+        instrument : bool, optional
+            Default = False
+            Record the wall time, CPU time, peak memory and exit code
+            of the commands of every task in its timing file,
+            reported by report and report_summary.
+        max_memory, max_disk : float, optional
+            Memory available to the concurrent tasks and disk space
+            available to the flow, in GB. The flow is refused if the
+            estimate exceeds them (see estimate).
 
         """
 
@@ -67,6 +124,39 @@ class OPTflow(Workflow):
         self.kshift = kwargs.pop('kshift', [.0,.0,.0])
         self.split_by_proc = kwargs.pop('split_by_proc',False)
         self.nproc = kwargs.pop('nproc',1)
+        self.ntask = kwargs.pop('ntask',None)
+        cost_model = kwargs.pop('cost_model',None)
+        self.reuse_dirname = kwargs.pop('reuse_dirname',None)
+        self.reuse_kgrid = kwargs.pop('reuse_kgrid',None)
+        self.kstore_fname = kwargs.get('kstore_fname',None)
+        self.kgrid_interpolation = kwargs.pop('kgrid_interpolation',None)
+        self.dos = kwargs.pop('dos',False)
+        self.preview = kwargs.pop('preview',False)
+        preview_kgrid = kwargs.pop('preview_kgrid',None)
+        preview_ncond = kwargs.pop('preview_ncond',None)
+        max_memory = kwargs.pop('max_memory',None)
+        max_disk = kwargs.pop('max_disk',None)
+        if ( self.kgrid_interpolation ):
+            self.check_interpolation(**kwargs)
+        if ( self.preview ):
+            kwargs.update(self.get_preview_parameters(
+                preview_kgrid,preview_ncond,**kwargs))
+
+        # Parameters of the resource estimate
+        self.structure = kwargs['structure']
+        self.nband = kwargs['nband']
+        self.ecut = kwargs['ecut']
+        self.nspinor = kwargs.get('nspinor',1)
+        self.kgrid_response = kwargs['kgrid_response']
+        if ( self.ntask is None ):
+            self.ntask = self.nproc
+            if ( self.split_by_proc and cost_model is not None ):
+                self.ntask = self.choose_ntask(cost_model,**kwargs)
+        if ( self.nproc % self.ntask ):
+            raise Exception("ntask ({0}) must divide nproc ({1})."
+                            .format(self.ntask,self.nproc))
+        if ( max_memory or max_disk ):
+            self.check_resources(max_memory,max_disk)
 
         # ==== KK task ==== #
         tetrahedra_fname,symmetries_fname,kreciprocal_fname=self.make_kk_task(**kwargs)
@@ -74,10 +164,20 @@ class OPTflow(Workflow):
                       symmetries_fname=symmetries_fname,
                       kreciprocal_fname=kreciprocal_fname)
 
+        # ==== Reuse k-points already computed ==== #
+        self.make_reuse_task(**kwargs)
+        if ( self.topup ):
+            kwargs.update(
+                kreciprocal_fname=self.reusetask.new_kreciprocal_fname)
+
         # ==== DFT calculations ==== #
         wfn_fnames=self.make_dft_tasks_abinit(**kwargs)
         kwargs.update(wfn_fname=wfn_fnames)
 
+        # === Check the gap before the matrix elements === #
+        if ( self.dos and not self.topup ):
+            self.make_dos_task(**kwargs)
+
         # === RPMNS calculation === #
         (eigen_fname,pmn_fname,pnn_fname)=self.make_rpmns_task(**kwargs)  
         kwargs.update(
@@ -88,9 +188,295 @@ class OPTflow(Workflow):
         # === MERGE files === #
         self.make_merge_task(**kwargs)  
 
+        if ( self.topup ):
+            kwargs.update(kreciprocal_fname=kreciprocal_fname)
+            (eigen_fname,pmn_fname,pnn_fname)=self.make_assemble_task(**kwargs)
+            kwargs.update(
+                eigen_fname=eigen_fname,
+                pmn_fname=pmn_fname,
+                pnn_fname=pnn_fname)
+            if ( self.dos ):
+                self.make_dos_task(**kwargs)
+
+        # === Interpolation onto a denser grid === #
+        if ( self.kgrid_interpolation ):
+            kwargs.update(self.make_interpolation_task(**kwargs))
+
         # === Optical response === #
         self.make_response_task(**kwargs) 
 
+        self.set_timing_keys(**kwargs)
+        self.set_memory_estimates()
+
+    def check_interpolation(self,response,components,**kwargs):
+        """
+        Refuse the responses that cannot be computed from interpolated
+        matrix elements: only |p^a_mn| is interpolated, without its phase,
+        which leaves the non-linear responses and the off-diagonal
+        components undefined.
+        """
+        if ( response != 1 ):
+            raise Exception(
+                "kgrid_interpolation is only valid for the linear response "
+                "(response = 1), not for response = {0}.".format(response))
+        offdiagonal = [c for c in components if len(set(c)) != 1]
+        if ( offdiagonal ):
+            raise Exception(
+                "kgrid_interpolation is only valid for the diagonal "
+                "components of the linear response, not for {0}."
+                .format(', '.join(offdiagonal)))
+
+    def get_preview_parameters(self,kgrid=None,ncond=None,**kwargs):
+        """ Return the parameters overridden in preview mode. """
+        if kgrid is None:
+            kgrid = [max(1,n//2) for n in kwargs['kgrid_response']]
+        if ncond is None:
+            ncond = max(1,kwargs['ncond']//2)
+        ncond = min(ncond,kwargs['ncond'])
+        nband = min(kwargs['nband'],kwargs['nval_total']+ncond)
+        print("Preview on a {0}x{1}x{2} grid with {3} conduction bands\n"
+              .format(kgrid[0],kgrid[1],kgrid[2],ncond))
+        return dict(
+            kgrid_response = kgrid,
+            ncond = ncond,
+            nband = nband,
+            integrator = 'histogram')
+
+    def estimate(self):
+        """ Estimate the disk and memory needs of each stage from
+        the structure, ecut, nband, nspinor and the k-point grids,
+        without running anything. The k-points are counted on the full
+        grids, so that the estimates are upper bounds. Sizes are in bytes.
+
+        Returns a dict with
+            npw, nfft : plane waves and FFT points of the density
+            nkpt : k-points of the response grid
+            ntetrahedra : tetrahedra (or triangles) of the response grid
+            wfk : size of the wavefunctions of the response grid
+            pmn : size of the momentum matrix elements in memory
+            stages : {stage : {'memory' : peak memory of the concurrent
+                               tasks, 'disk' : size of the files}}
+            memory : largest memory of the stages
+            disk : total size of the files
+        """
+        from collections import OrderedDict
+        from ..utils import (count_planewaves, count_fft_points,
+                             count_tetrahedra, band_pair_count, wfk_size,
+                             pmn_size, text_size)
+
+        nband, nspinor = self.nband, self.nspinor
+        npw = count_planewaves(self.structure.lattice.matrix, self.ecut)
+        nfft = count_fft_points(npw)
+        # Density, potentials and work arrays of Abinit.
+        fft_memory = 10*8*nfft
+        nkgrid = lambda kgrid: int(kgrid[0])*int(kgrid[1])*int(kgrid[2])
+        nkpt = nkgrid(self.kgrid_response)
+        ntet = count_tetrahedra(self.kgrid_response)
+        npair = band_pair_count(nband)
+        ntask = self.ntask if self.split_by_proc else 1
+        nkpt_chunk = -(-nkpt//ntask)
+
+        # Eigenvalues, pmn and pnn written by RPMNS.
+        tiniba_disk = lambda nk: (text_size(nk,nband+1) +
+                                  text_size(nk,6*npair) +
+                                  text_size(nk,3*nband))
+
+        stages = OrderedDict()
+        stages['KK'] = dict(
+            memory = 5*8*ntet,
+            disk = text_size(nkpt,4) + text_size(ntet,5))
+
+        nshift = len(self.kshift) if np.ndim(self.kshift) > 1 else 1
+        nkpt_scf = nkgrid(self.ngkpt)*nshift
+        stages['SCF'] = dict(
+            memory = wfk_size(nkpt_scf,nband,npw,nspinor) + fft_memory,
+            disk = wfk_size(nkpt_scf,nband,npw,nspinor) + 8*nfft)
+
+        # Abinit holds the wavefunctions of all the k-points of a chunk.
+        stages['WFN'] = dict(
+            memory = ntask*(wfk_size(nkpt_chunk,nband,npw,nspinor) +
+                            fft_memory),
+            disk = wfk_size(nkpt,nband,npw,nspinor))
+
+        # RPMNS reads the wavefunctions of one k-point at a time,
+        # the merged files are a copy of the files of the chunks.
+        nmerge = 2 if ( self.split_by_proc and not self.kstore_fname ) else 1
+        stages['RPMNS'] = dict(
+            memory = ntask*(wfk_size(2,nband,npw,nspinor) +
+                            pmn_size(1,nband)),
+            disk = nmerge*tiniba_disk(nkpt))
+
+        nkpt_resp = nkpt
+        if ( self.kgrid_interpolation ):
+            nkpt_resp = nkgrid(self.kgrid_interpolation)
+            ntet = count_tetrahedra(self.kgrid_interpolation)
+            stages['INTERP'] = dict(
+                memory = pmn_size(nkpt,nband) + pmn_size(nkpt_resp,nband),
+                disk = tiniba_disk(nkpt_resp) + text_size(ntet,5))
+
+        # The response reads the matrix elements of all the k-points.
+        stages['RESP'] = dict(
+            memory = pmn_size(nkpt_resp,nband) + 5*8*ntet,
+            disk = 0)
+
+        return dict(
+            npw = npw,
+            nfft = nfft,
+            nkpt = nkpt,
+            ntetrahedra = count_tetrahedra(self.kgrid_response),
+            wfk = wfk_size(nkpt,nband,npw,nspinor),
+            pmn = pmn_size(nkpt,nband),
+            stages = stages,
+            memory = max(stage['memory'] for stage in stages.values()),
+            disk = sum(stage['disk'] for stage in stages.values()))
+
+    def check_resources(self,max_memory=None,max_disk=None):
+        """ Raise an exception if the estimate of the flow exceeds
+        the memory or the disk space available, in GB. """
+        from ..utils import format_size
+
+        estimate = self.estimate()
+        GB = 1024.**3
+        for name, available in (('memory',max_memory),('disk',max_disk)):
+            if available and estimate[name] > available*GB:
+                stage = max(estimate['stages'].items(),
+                            key=lambda item: item[1][name])[0]
+                raise Exception(
+                    "The flow needs {0} of {1} ({2}), more than the {3} GB "
+                    "available.\n Use fewer bands, a coarser k-point grid "
+                    "or fewer concurrent tasks.".format(
+                    format_size(estimate[name]),name,stage,available))
+
+    def report_estimate(self,file=None):
+        """ Print the estimate of the disk and memory needs. """
+        from ..utils import format_size
+
+        estimate = self.estimate()
+        file = file if file is not None else sys.stdout
+        print('   {0} plane waves, {1} k-points, {2} tetrahedra'.format(
+              estimate['npw'],estimate['nkpt'],estimate['ntetrahedra']),
+              file=file)
+        print('   {:<40}  -  {:>10} {:>10}'.format('Stage','Memory','Disk'),
+              file=file)
+        for name, stage in estimate['stages'].items():
+            print('   {:<40}  -  {:>10} {:>10}'.format(
+                  name,format_size(stage['memory']),
+                  format_size(stage['disk'])),file=file)
+        print('   {:<40}  -  {:>10} {:>10}'.format(
+              'Total',format_size(estimate['memory']),
+              format_size(estimate['disk'])),file=file)
+
+    def get_timing_key(self,stage,kgrid,ntask=1,nproc=1,**kwargs):
+        """ Return the parameters determining the cost of a task
+        of a stage (see TimingDB), with the k-points of kgrid
+        divided in ntask chunks. """
+        nkpt = int(kgrid[0])*int(kgrid[1])*int(kgrid[2])
+        return dict(
+            stage = stage,
+            natom = kwargs['structure'].num_sites,
+            nband = kwargs['nband'],
+            ecut = kwargs['ecut'],
+            nkpt = max(1,nkpt//ntask),
+            nspinor = kwargs.get('nspinor',1),
+            nproc = nproc)
+
+    def set_timing_keys(self,**kwargs):
+        """ Set the timing_key of each task, so that its timing
+        can be recorded with TimingDB.add_workflow. """
+        from ..utils import (KKflow, REUSEflow, KSTOREflow, DOSflow,
+                             RPMNSflow, MERGEflow, INTERPflow, RESPONSEflow)
+
+        stages = ((KKflow,'KK'), (REUSEflow,'REUSE'), (KSTOREflow,'KSTORE'),
+                  (AbinitScfTask,'SCF'), (AbinitWfnTask,'WFN'),
+                  (DOSflow,'DOS'), (RPMNSflow,'RPMNS'), (MERGEflow,'MERGE'),
+                  (INTERPflow,'INTERP'), (RESPONSEflow,'RESP'))
+        for task in self.iter_tasks():
+            for cls, stage in stages:
+                if isinstance(task, cls):
+                    break
+            else:
+                continue
+            if ( stage == 'SCF' ):
+                kgrid = self.ngkpt
+            else:
+                kgrid = getattr(task,'kgrid_response',kwargs['kgrid_response'])
+            ntask = 1
+            if ( self.split_by_proc and stage in ('WFN','RPMNS') ):
+                ntask = self.ntask
+            nproc = 1
+            if getattr(task,'mpirun',None):
+                nproc = task.nproc
+            task.timing_key = self.get_timing_key(
+                stage,kgrid,ntask=ntask,nproc=nproc,**kwargs)
+
+    def set_memory_estimates(self):
+        """ Set the memory_estimate (bytes) of each task from estimate,
+        used by LocalExecutor to run concurrent tasks within a memory
+        budget. The tasks of the stages without estimate are ignored. """
+        stages = self.estimate()['stages']
+        for task in self.iter_tasks():
+            key = getattr(task,'timing_key',None)
+            if not key or key['stage'] not in stages:
+                continue
+            memory = stages[key['stage']]['memory']
+            if ( self.split_by_proc and key['stage'] in ('WFN','RPMNS') ):
+                memory = memory//self.ntask
+            task.memory_estimate = memory
+
+    def choose_ntask(self,model,**kwargs):
+        """ Return the number of chunks of the split WFN and RPMNS
+        stages, among the divisors of nproc, for which the CostModel
+        predicts the shortest time, each chunk running on nproc/ntask
+        processes. The merge does not depend on the number of chunks.
+        Return nproc if WFN or RPMNS has no previous runs. """
+        kgrid = kwargs['kgrid_response']
+        best = None
+        for ntask in range(1,self.nproc+1):
+            if ( self.nproc % ntask ):
+                continue
+            seconds = 0.
+            for stage in ('WFN','RPMNS'):
+                key = self.get_timing_key(stage,kgrid,ntask=ntask,
+                                          nproc=self.nproc//ntask,**kwargs)
+                predicted = model.predict(key)
+                if predicted is None:
+                    return self.nproc
+                seconds += predicted
+            if ( best is None or seconds < best[0] ):
+                best = (seconds,ntask)
+        return best[1]
+
+    def get_chunk_mpi(self):
+        """ MPI parameters of the chunks of the split tasks:
+        serial chunks, unless there are fewer chunks than nproc. """
+        nproc = self.nproc//self.ntask
+        if ( nproc > 1 ):
+            return dict(nproc=nproc)
+        return dict(mpirun='')
+
+    def predict_times(self,model):
+        """ Predict the wall time (s) of each stage with a CostModel,
+        from the previous runs recorded in its TimingDB.
+        The chunks of a split stage run concurrently.
+        Stages without previous runs are predicted as None. """
+        from collections import OrderedDict
+
+        times = OrderedDict()
+        for task in self.iter_tasks():
+            key = getattr(task,'timing_key',None)
+            if not key:
+                continue
+            seconds = model.predict(key)
+            stage = key['stage']
+            if ( seconds is None or
+                 (stage in times and times[stage] is None) ):
+                times[stage] = None
+            elif ( self.split_by_proc and stage in ('WFN','RPMNS') ):
+                times[stage] = max(times.get(stage,0.),seconds)
+            else:
+                times[stage] = times.get(stage,0.)+seconds
+        return times
+
     @property
     def has_kshift(self):
         return any([i!=0 for i in self.kshift])
@@ -116,12 +502,143 @@ class OPTflow(Workflow):
        
         return tetrahedra_fname,symmetries_fname, kreciprocal_fname
            
+    def make_reuse_task(self,**kwargs):
+        """ Run reuse task:
+        find the k-points already computed, either on a coarser nested grid
+        or in the k-point store. """
+        from ..utils import (REUSEflow, KSTOREflow, find_reusable_kgrid,
+                             is_nested_kgrid)
+
+        self.reuse = False
+        self.topup = False
+
+        if ( self.reuse_dirname ):
+            nspinor = kwargs.get('nspinor',1)
+            if self.reuse_kgrid is None:
+                self.reuse_kgrid = find_reusable_kgrid(self.reuse_dirname,
+                    kwargs['prefix'], kwargs['kgrid_response'],
+                    kwargs['ecut'], nspinor)
+                if self.reuse_kgrid is None:
+                    print("No nested k-point grid found in {0}\n".format(
+                          self.reuse_dirname))
+            elif not is_nested_kgrid(kwargs['kgrid_response'],
+                                     self.reuse_kgrid):
+                raise Exception(
+                    "The k-point grid {0} is not nested in {1}".format(
+                    self.reuse_kgrid, kwargs['kgrid_response']))
+            self.reuse = self.reuse_kgrid is not None
+
+        if ( self.kstore_fname ):
+            self.reusetask = KSTOREflow(
+                step = 'split',
+                dirname = os.path.join(self.dirname, '00-KK'),
+                reuse_dirname = self.reuse_dirname,
+                reuse_kgrid = self.reuse_kgrid if self.reuse else None,
+                **kwargs)
+        elif ( self.reuse ):
+            self.reusetask = REUSEflow(
+                step = 'split',
+                dirname = os.path.join(self.dirname, '00-KK'),
+                reuse_dirname = self.reuse_dirname,
+                reuse_kgrid = self.reuse_kgrid,
+                **kwargs)
+        else:
+            return
+
+        self.topup = True
+        self.add_task(self.reusetask)
+
+    def make_assemble_task(self,**kwargs):
+        """ Run assemble task:
+        gather the previous and the new k-points in a single set of files. """
+        from ..utils import REUSEflow, KSTOREflow
+
+        if ( self.kstore_fname ):
+            self.assembletask = KSTOREflow(
+                step = 'export',
+                dirname = os.path.join(self.dirname, '03-RPMNS'),
+                **kwargs)
+        else:
+            self.assembletask = REUSEflow(
+                step = 'assemble',
+                dirname = os.path.join(self.dirname, '03-RPMNS'),
+                reuse_dirname = self.reuse_dirname,
+                reuse_kgrid = self.reuse_kgrid,
+                **kwargs)
+        self.add_task(self.assembletask)
+
+        return (self.assembletask.eigen_fname,
+                self.assembletask.pmn_fname,
+                self.assembletask.pnn_fname)
+
+    def make_interpolation_task(self,**kwargs):
+        """ Run interpolation task:
+        interpolate eigenvalues and matrix elements onto kgrid_interpolation.
+        Return the arguments of the response task on the dense grid. """
+        from ..utils import KKflow, INTERPflow
+
+        kgrid="{}x{}x{}".format(*self.kgrid_interpolation)
+        dense_kwargs = dict(kwargs)
+        dense_kwargs.update(kgrid_response=self.kgrid_interpolation)
+        self.densekktask = KKflow(
+            dirname = os.path.join(self.dirname, '00-KK-'+kgrid),
+            **dense_kwargs)
+        self.add_task(self.densekktask)
+
+        self.interptask = INTERPflow(
+            dirname = os.path.join(self.dirname, '03-INTERP'),
+            kgrid_interpolation = self.kgrid_interpolation,
+            dense_kreciprocal_fname = self.densekktask.kreciprocal_fname,
+            symd_fname = self.kktask.symd_fname,
+            pvectors_fname = self.kktask.pvectors_fname,
+            **kwargs)
+        self.add_task(self.interptask)
+
+        return dict(
+            kgrid_response = self.kgrid_interpolation,
+            tetrahedra_fname = self.densekktask.tetrahedra_fname,
+            symmetries_fname = self.densekktask.symmetries_fname,
+            kreciprocal_fname = self.densekktask.kreciprocal_fname,
+            eigen_fname = self.interptask.eigen_fname,
+            pmn_fname = self.interptask.pmn_fname,
+            pnn_fname = self.interptask.pnn_fname)
+
+    def make_dos_task(self,**kwargs):
+        """ Run DOS task:
+        density of states and gap, from the _EIG files of the WFN tasks
+        or from the eigenvalues of RPMNS if eigen_fname is given.
+        The flow stops if the gap is not as expected. """
+        from ..utils import DOSflow
+
+        if ( self.kktask.is_2d ):
+            kwargs.setdefault('triangles_fname',self.kktask.triangles_fname)
+        if 'eigen_fname' not in kwargs:
+            wfntasks = [task for task in self.tasks
+                        if isinstance(task, AbinitWfnTask)]
+            kwargs.update(eig_fnames=[task.get_odat('EIG')
+                                      for task in wfntasks])
+        self.dostask = DOSflow(
+            dirname = os.path.join(self.dirname, '02-DOS'),
+            **kwargs)
+        self.add_task(self.dostask)
+
+        failed = os.path.join(
+            os.path.relpath(self.dostask.dirname, self.dirname),
+            self.dostask.failed_fname)
+        self.runscript.append("if [ -e {0} ]".format(failed))
+        self.runscript.append("then")
+        self.runscript.append("   echo Unexpected gap, see {0}".format(
+                              os.path.dirname(failed)))
+        self.runscript.append("   exit 1")
+        self.runscript.append("fi")
+
     def make_merge_task(self,**kwargs):
         """ Run merge task: 
         when calculation is split, it merges the output files """
         from ..utils import MERGEflow
 
-        if ( self.split_by_proc == True ):
+        # The k-point store replaces the merged files.
+        if ( self.split_by_proc == True and not self.kstore_fname ):
             dirname='03-RPMNS/'
             self.mergetask = MERGEflow(
                 dirname = os.path.join(self.dirname, dirname),
@@ -135,14 +652,18 @@ class OPTflow(Workflow):
         Compute momentum matrix elements. """
         from ..utils import RPMNSflow
 
+        # Files on the new k-points only are reassembled afterwards.
+        tag = '_new' if self.topup else ''
+
         if ( self.split_by_proc == False ):
             self.rpmnstask = RPMNSflow(
                 dirname = os.path.join(self.dirname, '03-RPMNS'),
+                tag=tag,
                 **kwargs)
             self.add_task(self.rpmnstask)
         else:
-            # Divide calculation by nproc:
-            kwargs.update(mpirun='')
+            # Divide calculation in ntask chunks:
+            kwargs.update(self.get_chunk_mpi())
             for self.task in range(self.ntask):
                 dirname='03-RPMNS/'+str(self.task+1)
                 self.rpmnstask = RPMNSflow(
@@ -150,9 +671,10 @@ class OPTflow(Workflow):
                     task=self.task+1,
                     ntask=self.ntask,
                     rename=False,
+                    tag=tag,
                     **kwargs)
                 self.add_task(self.rpmnstask,background=True)
-            self.runscript.append("wait\n")
+            self.add_wait()
 
         eigen_fname=self.rpmnstask.eigen_fname
         pmn_fname=self.rpmnstask.pmn_fname
@@ -168,6 +690,11 @@ class OPTflow(Workflow):
         Compute responses with Tiniba. """
         from ..utils import RESPONSEflow
 
+        kwargs.setdefault('symd_fname',self.kktask.symd_fname)
+        kwargs.setdefault('pvectors_fname',self.kktask.pvectors_fname)
+        kktask = getattr(self,'densekktask',self.kktask)
+        if ( kktask.is_2d ):
+            kwargs.setdefault('triangles_fname',kktask.triangles_fname)
         self.responsetask = RESPONSEflow(
             dirname = os.path.join(self.dirname,'04-RESP'),
             **kwargs)
@@ -217,11 +744,10 @@ class OPTflow(Workflow):
             #fnames = dict(wfn_fname = os.path.join('../',self.wfntask.wfn_fname))
             return wfn_fnames
         else : 
-            # Divide calculation by nproc:
-            self.ntask=self.nproc
+            # Divide calculation in ntask chunks:
+            kwargs.update(self.get_chunk_mpi())
             # split tasks: 
             for self.task in range(self.ntask):
-                kwargs.update(mpirun='')
                 dirname='02-WFN/'+str(self.task+1)
                 self.wfntask = AbinitWfnTask(
                     dirname = os.path.join(self.dirname, dirname),
@@ -232,7 +758,7 @@ class OPTflow(Workflow):
                 self.add_task(self.wfntask,background=True)
                 wfn_fname=self.wfntask.wfn_fname
                 wfn_fnames.append(wfn_fname)
-            self.runscript.append("wait\n")
+            self.add_wait()
 
         kwargs.update(
             wfn_fname=wfn_fnames ) 
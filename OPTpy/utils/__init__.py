@@ -1,8 +1,19 @@
 from .formatting import *
 from .units import *
 from .various import *
+from .timing import *
+from .costmodel import *
+from .estimate import *
 from .kk import *
 from .rpmns import *
 from .response import *
 from .merge import *
 from .jobs_lrc import *
+from .kdata import *
+from .reuse import *
+from .kstore import *
+from .interpolate import *
+from .integrate import *
+from .integrand import *
+from .window import *
+from .dos import *
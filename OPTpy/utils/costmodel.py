@@ -0,0 +1,208 @@
+"""
+Historical timing of the tasks and cost model of the stages.
+
+The timing of the instrumented tasks (see timing.py) is recorded in a
+SQLite database with the parameters that determine the cost of a task:
+
+    stage : KK, SCF, WFN, DOS, RPMNS, MERGE, INTERP, RESP, ...
+    natom, nband, ecut, nspinor
+    nkpt : number of k-points of the task (of its chunk when the
+        calculation is split), counted on the full grid
+    nproc : number of MPI processes
+
+The wall time of a stage is then predicted from the previous runs with
+a log-linear (power law) fit of the parameters,
+
+    log(t) = a + sum_i b_i log(x_i).
+"""
+from __future__ import print_function, division
+import os
+import socket
+import sqlite3
+from collections import OrderedDict
+
+import numpy as np
+
+from .timing import read_timings, summarize_timings
+
+__all__ = ['TIMING_PARAMETERS', 'TimingDB', 'CostModel']
+
+# In the order in which they enter the fit when there are few samples.
+TIMING_PARAMETERS = ('nkpt', 'nband', 'natom', 'ecut', 'nproc', 'nspinor')
+
+
+class TimingDB(object):
+    """
+    SQLite store of the timing of the tasks.
+
+        >>> db = TimingDB('timings.db')
+        >>> db.add_workflow(flow)
+        >>> model = CostModel(db)
+    """
+
+    _columns = (('stage', 'TEXT'), ('natom', 'INTEGER'),
+                ('nband', 'INTEGER'), ('ecut', 'REAL'),
+                ('nkpt', 'INTEGER'), ('nspinor', 'INTEGER'),
+                ('nproc', 'INTEGER'), ('elapsed', 'REAL'), ('cpu', 'REAL'),
+                ('maxrss', 'INTEGER'), ('start', 'REAL'), ('host', 'TEXT'),
+                ('task', 'TEXT'))
+
+    def __init__(self, fname):
+        self.fname = fname
+        with self.connect() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS timings ({}, '
+                'UNIQUE (task, start))'.format(
+                ', '.join('{} {}'.format(*c) for c in self._columns)))
+
+    def connect(self):
+        return sqlite3.connect(self.fname)
+
+    def add(self, key, timing, task='', host=None):
+        """
+        Record the timing of a task.
+
+        Arguments
+        ---------
+
+        key : dict
+            Stage and parameters of the task (see TIMING_PARAMETERS).
+        timing : dict
+            Totals of the timing records (see summarize_timings),
+            with the time stamp of the first command as 'start'.
+        task : str
+            Directory of the task. A task is recorded once per run.
+        """
+        row = dict((name, key.get(name)) for name in TIMING_PARAMETERS)
+        row.update(
+            stage = key['stage'],
+            elapsed = timing['elapsed'],
+            cpu = timing['user'] + timing['system'],
+            maxrss = timing['maxrss'],
+            start = timing.get('start'),
+            host = host if host is not None else socket.gethostname(),
+            task = os.path.abspath(task) if task else '',
+            )
+        names = [c[0] for c in self._columns]
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO timings ({}) VALUES ({})'.format(
+                       ', '.join(names), ', '.join('?' * len(names))),
+                       [row[name] for name in names])
+
+    def add_task(self, task):
+        """
+        Record the timing of a task with a timing_key.
+        Return True if there was a complete timing to record.
+        """
+        key = getattr(task, 'timing_key', None)
+        records = read_timings(task.timing_fname)
+        if not key or not records:
+            return False
+        # Unfinished or failed runs would bias the model.
+        if any(r['returncode'] != 0 for r in records):
+            return False
+        timing = summarize_timings(records)
+        timing['start'] = min(r['start'] for r in records)
+        self.add(key, timing, task.dirname, records[0].get('host'))
+        return True
+
+    def add_workflow(self, workflow):
+        """
+        Record the timing of all the tasks of a workflow.
+        Return the number of tasks recorded.
+        """
+        return sum(self.add_task(task) for task in workflow.iter_tasks())
+
+    def query(self, stage, host=None):
+        """
+        Return the timings of a stage as a list of dict,
+        optionally restricted to a host.
+        """
+        sql = 'SELECT * FROM timings WHERE stage = ?'
+        args = [stage]
+        if host is not None:
+            sql += ' AND host = ?'
+            args.append(host)
+        with self.connect() as db:
+            cursor = db.execute(sql, args)
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def max_rss(self, key, host=None):
+        """
+        Return the largest peak memory (kB) of the previous runs of tasks
+        with the same stage and parameters, or None.
+        """
+        names = ('stage',) + TIMING_PARAMETERS
+        sql = 'SELECT MAX(maxrss) FROM timings WHERE {}'.format(
+              ' AND '.join('{} = ?'.format(name) for name in names))
+        args = [key.get(name) for name in names]
+        if host is not None:
+            sql += ' AND host = ?'
+            args.append(host)
+        with self.connect() as db:
+            return db.execute(sql, args).fetchone()[0]
+
+
+class CostModel(object):
+    """
+    Power law fit of the wall time of each stage, from a TimingDB.
+
+    Only the parameters that vary among the samples of a stage enter
+    the fit, at most one less than the number of samples, in the order
+    of TIMING_PARAMETERS. When the number of k-points does not vary,
+    as with a single sample, the time is scaled linearly with it.
+    """
+
+    def __init__(self, db, host=None):
+        self.db = db
+        self.host = host
+        self._fits = dict()
+
+    def fit(self, stage):
+        """
+        Return the fit of a stage as (intercept, {parameter : exponent}),
+        or None without samples.
+        """
+        if stage in self._fits:
+            return self._fits[stage]
+
+        rows = [row for row in self.db.query(stage, self.host)
+                if row['elapsed'] > 0 and
+                   all(row[name] for name in TIMING_PARAMETERS)]
+        if not rows:
+            self._fits[stage] = None
+            return None
+
+        x = np.log([[float(row[name]) for name in TIMING_PARAMETERS]
+                    for row in rows])
+        y = np.log([row['elapsed'] for row in rows])
+
+        varying = [i for i in range(x.shape[1])
+                   if np.ptp(x[:, i]) > 1e-8][:len(rows) - 1]
+        exponents = OrderedDict()
+        if 0 not in varying:
+            # Linear in the number of k-points, which the samples
+            # cannot tell: fit the other parameters to time / nkpt.
+            exponents['nkpt'] = 1.
+            y = y - x[:, 0]
+        a = np.column_stack([np.ones(len(rows))] + [x[:, i] for i in varying])
+        coefs = np.linalg.lstsq(a, y, rcond=-1)[0]
+        intercept = coefs[0]
+        exponents.update((TIMING_PARAMETERS[i], c)
+                         for i, c in zip(varying, coefs[1:]))
+
+        self._fits[stage] = (intercept, exponents)
+        return self._fits[stage]
+
+    def predict(self, key):
+        """
+        Predict the wall time (s) of a task from its timing_key,
+        or return None if the stage has no samples.
+        """
+        fit = self.fit(key['stage'])
+        if fit is None:
+            return None
+        intercept, exponents = fit
+        return float(np.exp(intercept + sum(
+            b * np.log(float(key[name])) for name, b in exponents.items())))
@@ -0,0 +1,255 @@
+"""
+Density of states and joint density of states, integrated with the
+tetrahedra of KKflow from the eigenvalues alone. They are cheap checks
+of the band structure and of the gap before the response is computed.
+"""
+from __future__ import print_function, division
+from os import path
+
+import numpy as np
+
+from ..core import Workflow, Task
+from .units import Ha_to_eV
+from .kdata import read_klist, read_rows, kdata_suffix
+from .integrate import (read_tetrahedra, read_triangles, energy_grid,
+                        tetrahedron_spectrum, write_spectrum)
+from .integrand import transition_energies
+
+__all__ = ['read_abinit_eig', 'band_gap', 'dos_spectrum', 'jdos_spectrum',
+           'compute_dos', 'DOSflow']
+
+
+def read_abinit_eig(fname):
+    """
+    Read the eigenvalues written by Abinit in the _EIG file.
+
+    Returns
+    -------
+
+    kpts : array(nk, 3), reduced coordinates
+    eigen : array(nk, nband), in eV
+    """
+    kpts, eigen = list(), list()
+    with open(fname, 'r') as f:
+        for line in f:
+            if 'kpt#' in line:
+                values = line.split('kpt=')[1].split()[:3]
+                kpts.append([float(v) for v in values])
+                eigen.append(list())
+            elif eigen:
+                try:
+                    eigen[-1].extend(float(v) for v in line.split())
+                except ValueError:
+                    # Headers, e.g. of the spin channels.
+                    continue
+    if not eigen or len(set(len(e) for e in eigen)) != 1:
+        raise Exception('Cannot read the eigenvalues of {}.'.format(fname))
+    return np.array(kpts), np.array(eigen) * Ha_to_eV
+
+
+def band_gap(eigen, nval):
+    """
+    Return the indirect and direct gaps (eV), from the highest valence
+    band (nval) to the lowest conduction band.
+    """
+    if not 0 < nval < eigen.shape[1]:
+        raise Exception('{} valence bands do not leave conduction bands '
+                        'among {} bands.'.format(nval, eigen.shape[1]))
+    indirect = eigen[:, nval].min() - eigen[:, nval-1].max()
+    direct = (eigen[:, nval] - eigen[:, nval-1]).min()
+    return indirect, direct
+
+
+def dos_spectrum(eigen, corners, weights, grid, nspin=2):
+    """
+    Density of states per unit cell and per eV.
+
+    Arguments
+    ---------
+
+    eigen : array(nk, nband), eigenvalues of the irreducible k-points
+    corners, weights : tetrahedra (or triangles), see read_tetrahedra
+    grid : array(nw), evenly spaced energies
+    nspin : int (2), spin degeneracy (1 for spinors)
+    """
+    return nspin * tetrahedron_spectrum(eigen, np.ones(eigen.shape),
+                                        corners, weights, grid)
+
+
+def jdos_spectrum(eigen, nval, ncond, corners, weights, grid, nspin=2):
+    """
+    Joint density of states of the transitions from the nval valence
+    bands to the ncond lowest conduction bands, per unit cell and per eV.
+    """
+    energies = transition_energies(eigen, nval, ncond)
+    return nspin * tetrahedron_spectrum(energies, np.ones(energies.shape),
+                                        corners, weights, grid)
+
+
+def compute_dos(klist_fname, tetrahedra_fname, nval, dos_fname, jdos_fname,
+                eigen_fname=None, eig_fnames=None, ncond=None,
+                triangles_fname=None, energy_min=None, energy_max=None,
+                energy_steps=2001, jdos_max=10., nspin=2, gap_min=None,
+                gap_max=None):
+    """
+    Write the density of states and the joint density of states,
+    and check the gap.
+
+    Arguments
+    ---------
+
+    klist_fname : str
+        Irreducible k-points, in the order of the tetrahedra.
+    tetrahedra_fname : str
+        Tetrahedra (from KKflow).
+    nval : int
+        Number of valence bands.
+    dos_fname, jdos_fname : str
+        Output spectra.
+    eigen_fname : str
+        Eigenvalues written by RPMNS (eV, with a k-point index), or
+    eig_fnames : list of str
+        _EIG files of Abinit, holding the k-points of the k-list in order.
+    ncond : int, optional
+        Number of conduction bands in the JDOS (default: all).
+    triangles_fname : str, optional
+        Triangles of a two-dimensional grid, used instead of the
+        tetrahedra.
+    energy_min, energy_max, energy_steps :
+        Energy grid of the DOS (default: the range of the eigenvalues).
+    jdos_max : float (10.)
+        Largest transition energy of the JDOS, from zero.
+    nspin : int (2), spin degeneracy (1 for spinors)
+    gap_min, gap_max : float, optional
+        Bounds of the indirect gap (eV); an exception is raised, after
+        the spectra are written, if the gap is outside.
+
+    Returns
+    -------
+
+    (indirect, direct) gaps in eV.
+    """
+    nk = len(read_klist(klist_fname))
+    if eig_fnames:
+        eigen = np.concatenate([read_abinit_eig(fname)[1]
+                                for fname in eig_fnames])
+        if len(eigen) != nk:
+            raise Exception('{} k-points in the _EIG files instead of {}.'
+                            .format(len(eigen), nk))
+    else:
+        eigen = read_rows(eigen_fname, nk, index=True)
+
+    if triangles_fname:
+        corners, weights = read_triangles(triangles_fname)
+    else:
+        corners, weights = read_tetrahedra(tetrahedra_fname)
+
+    if energy_min is None:
+        energy_min = np.floor(eigen.min()) - 1.
+    if energy_max is None:
+        energy_max = np.ceil(eigen.max()) + 1.
+    grid = energy_grid(energy_min, energy_max, energy_steps)
+    write_spectrum(dos_fname, grid,
+                   dos_spectrum(eigen, corners, weights, grid, nspin))
+
+    if ncond is None:
+        ncond = eigen.shape[1] - nval
+    grid = energy_grid(0., jdos_max, energy_steps)
+    write_spectrum(jdos_fname, grid,
+                   jdos_spectrum(eigen, nval, ncond, corners, weights,
+                                 grid, nspin))
+
+    indirect, direct = band_gap(eigen, nval)
+    print('Indirect gap: {:.4f} eV, direct gap: {:.4f} eV'.format(
+          indirect, direct))
+    if ( (gap_min is not None and indirect < gap_min) or
+         (gap_max is not None and indirect > gap_max) ):
+        raise Exception(
+            'The gap of {:.4f} eV is outside the expected range {} - {} eV.'
+            .format(indirect, gap_min, gap_max))
+    return indirect, direct
+
+
+class DOSflow(Workflow, Task):
+    def __init__(self, **kwargs):
+        """
+        Density of states, joint density of states and gap, computed
+        from the eigenvalues and the tetrahedra before the matrix elements
+        or the response. If the gap falls outside [gap_min, gap_max],
+        the script exits with an error and writes failed_fname,
+        so that the calculation can be stopped early.
+
+        Keyword arguments
+        -----------------
+        dirname : str, directory from which the script is executed.
+        runscript_fname : str, name of the script (default: dos.sh)
+        kgrid_response : int, array(3), k-point grid for response
+        kreciprocal_fname : list of k-points (from KKflow)
+        tetrahedra_fname : tetrahedra (from KKflow)
+        triangles_fname : optional, triangles of a two-dimensional grid
+        eigen_fname : eigenvalues written by RPMNS, or
+        eig_fnames : list of _EIG files written by the WFN tasks
+        nval_total : Number of valence bands
+        ncond : Number of conduction bands in the JDOS
+        ecut : Kinetic energy cutoff
+        nspinor=1 : Number of spinorial components
+        gap_min=0., gap_max : bounds of the gap (eV), None to skip
+        energy_max : largest transition energy of the JDOS (default 10)
+        energy_steps : number of energies (default 2001)
+        OPTPY : command to call the OPTpy tools
+        """
+        kwargs.setdefault('runscript_fname', 'dos.sh')
+        super(DOSflow, self).__init__(**kwargs)
+        self.kgrid_response = kwargs['kgrid_response']
+        self.kgrid="{}x{}x{}".format(self.kgrid_response[0],self.kgrid_response[1],self.kgrid_response[2])
+        self.ecut = kwargs['ecut']
+        self.nspinor = kwargs.get('nspinor', 1)
+        self.gap_min = kwargs.pop('gap_min', 0.)
+        self.gap_max = kwargs.pop('gap_max', None)
+        self.optpy = kwargs.pop('OPTPY', 'python -m OPTpy')
+
+        # Names relative to the directory from which the script is run.
+        relpath = lambda fname: path.relpath(path.abspath(fname),
+                                             path.abspath(self.dirname))
+        if kwargs.get('eig_fnames'):
+            source = "--eig {0}".format(" ".join(
+                relpath(fname) for fname in kwargs['eig_fnames']))
+        else:
+            source = "--eigen {0}".format(relpath(kwargs['eigen_fname']))
+        line = ("$OPTPY dos {0} {1} {2} {3} {4} {5} --ncond {6} "
+                "--jdos-max {7} --energy-steps {8} --nspin {9}".format(
+                kwargs['kreciprocal_fname'], kwargs['tetrahedra_fname'],
+                kwargs['nval_total'], self.dos_fname, self.jdos_fname,
+                source, kwargs['ncond'], kwargs.get('energy_max', 10),
+                kwargs.get('energy_steps', 2001),
+                1 if self.nspinor > 1 else 2))
+        if kwargs.get('triangles_fname'):
+            line += " --triangles {0}".format(kwargs['triangles_fname'])
+        if self.gap_min is not None:
+            line += " --gap-min {0}".format(self.gap_min)
+        if self.gap_max is not None:
+            line += " --gap-max {0}".format(self.gap_max)
+
+        self.runscript.variables={
+            'OPTPY' : self.optpy}
+        self.runscript.append("rm -f {0}".format(self.failed_fname))
+        self.runscript.append("# Density of states and gap")
+        self.runscript.append(
+            "{0} || {{ touch {1}; exit 1; }}".format(line, self.failed_fname))
+
+    @property
+    def suffix(self):
+        return kdata_suffix(self.kgrid, self.ecut, self.nspinor)
+
+    @property
+    def dos_fname(self):
+        return 'dos{0}'.format(self.suffix)
+
+    @property
+    def jdos_fname(self):
+        return 'jdos{0}'.format(self.suffix)
+
+    @property
+    def failed_fname(self):
+        """ File written in dirname when the gap is not as expected """
+        return 'gap.failed'
@@ -0,0 +1,84 @@
+"""
+Estimates of the disk and memory needs of an optical-response flow,
+from the structure and the parameters alone, before anything runs.
+
+The estimates are upper bounds on the k-points, counted on the full
+grid, since the irreducible k-points are only known after KK.
+Sizes are in bytes.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+from .units import angstrom_to_bohr
+
+__all__ = ['count_planewaves', 'count_fft_points', 'count_tetrahedra',
+           'band_pair_count', 'wfk_size', 'pmn_size', 'text_size',
+           'format_size']
+
+# Bytes of a complex number in double precision.
+COMPLEX_SIZE = 16
+
+# Bytes of a value written in the text files of Tiniba and OPTpy,
+# e.g. ' 1.234567890123E+00'.
+TEXT_VALUE_SIZE = 20
+
+
+def count_planewaves(lattice, ecut):
+    """
+    Average number of plane waves of a wavefunction.
+
+    Arguments
+    ---------
+
+    lattice : array(3, 3), lattice vectors in Angstrom
+    ecut : float, kinetic energy cutoff in Ha
+    """
+    volume = abs(np.linalg.det(np.asarray(lattice) * angstrom_to_bohr))
+    kcut = np.sqrt(2. * ecut)
+    return int(np.ceil(volume * kcut ** 3 / (6. * np.pi ** 2)))
+
+
+def count_fft_points(npw):
+    """
+    Number of points of the FFT box of the density, which holds
+    a sphere of twice the radius of the wavefunction sphere.
+    """
+    return int(np.ceil(48. / np.pi * npw))
+
+
+def count_tetrahedra(kgrid):
+    """Number of tetrahedra (or triangles for a 2D grid) of a k-point grid."""
+    nk1, nk2, nk3 = [int(n) for n in kgrid]
+    if nk3 == 1:
+        return 2 * nk1 * nk2
+    return 6 * nk1 * nk2 * nk3
+
+
+def band_pair_count(nband, diagonal=True):
+    """Number of band pairs n <= m (n < m without diagonal)."""
+    return nband * (nband + 1) // 2 if diagonal else nband * (nband - 1) // 2
+
+
+def wfk_size(nkpt, nband, npw, nspinor=1):
+    """Size of the wavefunctions of nkpt k-points."""
+    return nkpt * nband * npw * nspinor * COMPLEX_SIZE
+
+
+def pmn_size(nkpt, nband):
+    """Size of the momentum matrix elements (3 complex per pair) in memory."""
+    return nkpt * band_pair_count(nband) * 3 * COMPLEX_SIZE
+
+
+def text_size(nrow, ncolumn):
+    """Size of a text file of nrow rows of ncolumn values."""
+    return nrow * (ncolumn * TEXT_VALUE_SIZE + 1)
+
+
+def format_size(size):
+    """Human-readable size, e.g. '1.5 GB'."""
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if abs(size) < 1024.:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024.
+    return '{:.1f} TB'.format(size)
@@ -0,0 +1,338 @@
+"""
+Integrands of the linear and second-harmonic responses
+computed from the eigenvalues and momentum matrix elements,
+as an alternative to set_input_all.
+
+All quantities are in atomic units (e = hbar = m = 1), except for the
+eigenvalues and transition energies, in eV as in the eigen files.
+Transitions (v, c) are ordered with the valence band v as the slowest
+index, as in energys.d. For a resonance at the transition energy
+w_cv, the integrand I is the weight of the delta function in the
+absorptive part of the response:
+
+    Im chi(w) = 1/Omega sum_k w_k sum_vc I_vc(k) delta(w - w_cv(k))
+
+where Omega is the volume of the unit cell (not included) and w_k are
+the weights of the k-points, normalized to one.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+from .units import eV_to_Ha
+from .kdata import iter_rows, band_pairs, pmn_to_complex
+from .integrate import block_size
+
+__all__ = ['momentum_matrix', 'position_matrix', 'generalized_derivative',
+           'transition_energies', 'chi1_integrand', 'shg_integrands',
+           'write_integrands']
+
+
+def momentum_matrix(pmn, nband, pnn=None):
+    """
+    Build the full momentum matrix p^a_nm from pmn records.
+
+    Arguments
+    ---------
+
+    pmn : array(nk, ncol)
+        Records of the pmn file: pairs n <= m, 6 values per pair.
+    nband : int
+        Number of bands.
+    pnn : array(nk, nband * 3), optional
+        Diagonal elements, used when the pmn records have no diagonal.
+
+    Returns
+    -------
+
+    p : array(nk, nband, nband, 3), complex, hermitian in (n, m).
+    """
+    values = pmn_to_complex(pmn, nband)
+    diagonal = values.shape[1] == nband * (nband + 1) // 2
+    n, m = band_pairs(nband, diagonal)
+    p = np.zeros((len(values), nband, nband, 3), dtype=complex)
+    p[:, n, m] = values
+    p[:, m, n] = values.conj()
+    if not diagonal and pnn is not None:
+        bands = np.arange(nband)
+        p[:, bands, bands] = np.asarray(pnn).reshape(len(values), nband, 3)
+    return p
+
+
+def position_matrix(eigen, p, tol=1e-4):
+    """
+    Interband position matrix elements r_nm = p_nm / (i w_nm).
+
+    Arguments
+    ---------
+
+    eigen : array(nk, nband), eigenvalues in eV.
+    p : array(nk, nband, nband, 3), momentum matrix.
+    tol : float (1e-4)
+        Energy (eV) below which bands are considered degenerate;
+        r_nm is set to zero between degenerate bands.
+    """
+    w = (eigen[:, :, None] - eigen[:, None, :]) * eV_to_Ha
+    degenerate = np.abs(w) < tol * eV_to_Ha
+    w = np.where(degenerate, 1., w)
+    r = p / (1j * w[..., None])
+    r[degenerate] = 0.
+    return r
+
+
+def _velocity_differences(p):
+    """Delta^a_nm = v^a_nn - v^a_mm, array(nk, nband, nband, 3)."""
+    v = np.real(np.einsum('knna->kna', p))
+    return v[:, :, None, :] - v[:, None, :, :]
+
+
+def _safe_inverse(x, tol):
+    small = np.abs(x) < tol
+    return np.where(small, 0., 1. / np.where(small, 1., x))
+
+
+def generalized_derivative(eigen, p, r, tol=1e-4):
+    """
+    Generalized derivative r^b_{nm;a} of the position matrix elements
+    [Sipe and Ghahramani, Phys. Rev. B 48, 11705 (1993)]:
+
+        r^b_{nm;a} = (r^a_nm Delta^b_mn + r^b_nm Delta^a_mn) / w_nm
+                   + i / w_nm sum_l (w_lm r^a_nl r^b_lm - w_nl r^b_nl r^a_lm)
+
+    Arguments
+    ---------
+
+    eigen : array(nk, nband), eigenvalues in eV.
+    p, r : array(nk, nband, nband, 3), momentum and position matrices.
+    tol : float, degeneracy tolerance in eV.
+
+    Returns
+    -------
+
+    rd : array(nk, nband, nband, 3, 3), rd[k, n, m, b, a] = r^b_{nm;a}
+    """
+    w = (eigen[:, :, None] - eigen[:, None, :]) * eV_to_Ha
+    inv = _safe_inverse(w, tol * eV_to_Ha)
+    delta = _velocity_differences(p)
+    # Delta_mn = -Delta_nm
+    two_band = (np.einsum('knma,knmb->knmba', r, -delta) +
+                np.einsum('knmb,knma->knmba', r, -delta))
+    three_band = (np.einsum('klm,knla,klmb->knmba', w, r, r) -
+                  np.einsum('knl,knlb,klma->knmba', w, r, r))
+    return (two_band + 1j * three_band) * inv[..., None, None]
+
+
+def transition_energies(eigen, nval, ncond):
+    """Transition energies w_cv (eV), array(nk, nval * ncond)."""
+    w = eigen[:, None, nval:nval+ncond] - eigen[:, :nval, None]
+    return w.reshape(len(eigen), -1)
+
+
+def _transitions(matrix, nval, ncond):
+    """Elements [v, c] of an array(nk, nband, nband) as (nk, nval*ncond)."""
+    return matrix[:, :nval, nval:nval+ncond].reshape(len(matrix), -1)
+
+
+def chi1_integrand(r, nval, ncond, a, b):
+    """
+    Integrand of Im chi1^{ab}: pi Re(r^a_vc r^b_cv).
+
+    Arguments
+    ---------
+
+    r : array(nk, nband, nband, 3), position matrix.
+    nval, ncond : int, number of valence and conduction bands.
+    a, b : int, Cartesian directions (0, 1, 2).
+    """
+    values = r[..., a] * np.transpose(r[..., b], (0, 2, 1))
+    return np.pi * _transitions(values.real, nval, ncond)
+
+
+def shg_integrands(eigen, p, r, nval, ncond, a, b, c, tol=1e-4, rd=None):
+    """
+    Integrands of Im chi2^{abc}(-2w; w, w) in the length gauge,
+    for the resonances at w = w_cv (1w) and at 2w = w_cv (2w),
+    from the interband, intraband and modulation terms of
+    Rashkeev, Lambrecht and Segall [Phys. Rev. B 57, 3905 (1998)].
+    The 2w intraband term is written with the generalized derivative
+    r^a_nm (r^b_{mn;c} + r^c_{mn;b}), as by Sipe and Ghahramani.
+    The sums over intermediate bands run over all the bands of p.
+
+    Arguments
+    ---------
+
+    eigen : array(nk, nband), eigenvalues in eV.
+    p, r : array(nk, nband, nband, 3), momentum and position matrices.
+    nval, ncond : int, number of valence and conduction bands;
+        the nval lowest bands are occupied.
+    a, b, c : int, Cartesian directions (0, 1, 2).
+    tol : float, degeneracy tolerance in eV.
+    rd : array(nk, nband, nband, 3, 3), optional
+        Generalized derivative of r (see generalized_derivative),
+        computed if not given.
+
+    Returns
+    -------
+
+    I1, I2 : array(nk, nval * ncond)
+        Integrands of the 1w and 2w resonances. The 2w integrand is
+        to be integrated with the energies w_cv / 2 (halfenergys.d);
+        it includes the factor 1/2 of delta(w_cv - 2w).
+    """
+    nk, nband = eigen.shape
+    if rd is None:
+        rd = generalized_derivative(eigen, p, r, tol)
+    tol = tol * eV_to_Ha
+    E = eigen * eV_to_Ha
+    w = E[:, :, None] - E[:, None, :]                        # w_nm
+    inv = _safe_inverse(w, tol)                              # 1 / w_nm
+    inv2 = inv ** 2                                          # 1 / w_nm^2
+    f = (np.arange(nband) < nval).astype(float)
+    fnm = (f[:, None] - f[None, :])[None]                    # f_nm
+    delta = _velocity_differences(p)                         # Delta_nm
+    ra, rb, rc = r[..., a], r[..., b], r[..., c]
+
+    def T(x):
+        return np.transpose(x, (0, 2, 1))
+
+    # Three-band products, indexed [k, n, m, l]:
+    # R = r^a_nm {r^b_ml r^c_ln} and w_ln - w_ml = 2 E_l - E_n - E_m.
+    R = ra[..., None] * 0.5 * (np.einsum('kml,kln->knml', rb, rc) +
+                               np.einsum('kml,kln->knml', rc, rb))
+    wlnml = (2 * E[:, None, None, :] - E[:, :, None, None] -
+             E[:, None, :, None])
+    Q = R * _safe_inverse(wlnml, tol)
+
+    # C[n, m] is the coefficient of 1 / (w_mn - w) (C1)
+    # or of 1 / (w_mn - 2w) (C2).
+
+    # Interband terms.
+    C2 = 2 * fnm * Q.sum(axis=3)
+    C1 = T(fnm * Q.sum(axis=1)) - fnm * Q.sum(axis=2)
+
+    # Intraband terms, prefactor i/2.
+    P = -w[..., None] * R                                   # w_mn R
+    C1 = C1 + 0.5j * fnm * inv2 * (P.sum(axis=2) - T(P.sum(axis=1)))
+    dr = T(rd[..., b, c] + rd[..., c, b])            # r^b_{mn;c} + r^c_{mn;b}
+    C2 = C2 + fnm * inv * ra * dr
+    C2 = C2 + 1j * fnm * inv2 * (R * wlnml).sum(axis=3)
+
+    # Modulation terms, prefactor 1/2.
+    bc_mnl = 0.5 * (np.einsum('kmn,knl->knml', rb, rc) +
+                    np.einsum('kmn,knl->knml', rc, rb))
+    bc_lmn = 0.5 * (np.einsum('klm,kmn->knml', rb, rc) +
+                    np.einsum('klm,kmn->knml', rc, rb))
+    mod = (np.einsum('knl,klm,knml->knm', w, ra, bc_mnl) -
+           np.einsum('klm,knl,knml->knm', w, ra, bc_lmn))
+    C1 = C1 + 0.5 * fnm * inv2 * mod
+    rd = -0.5 * (T(rb) * delta[..., c] + T(rc) * delta[..., b])
+    C1 = C1 - 0.5j * fnm * inv2 * ra * rd
+
+    # Absorptive parts at the resonances w_cv > 0, i.e. C[v, c].
+    I1 = np.pi * _transitions(C1.real, nval, ncond)
+    I2 = 0.5 * np.pi * _transitions(C2.real, nval, ncond)
+    return I1, I2
+
+
+_directions = {'x' : 0, 'y' : 1, 'z' : 2}
+
+
+def _append_rows(f, rows):
+    for row in rows:
+        f.write(' '.join('{:.12E}'.format(x) for x in row) + '\n')
+
+
+def _kpoint_values(nband, response):
+    """
+    Approximate number of float64 values held per k-point while the
+    integrands are computed: the momentum and position matrices, and
+    for 'shg' the generalized derivative and the three-band products.
+    """
+    if ( response == 'shg' ):
+        return 16 * nband ** 3 + 100 * nband ** 2
+    return 20 * nband ** 2
+
+
+def _count_bands(eigen_fname, nk):
+    """Number of bands of an eigen file with a k-point index."""
+    with open(eigen_fname, 'r') as f:
+        return sum(len(line.split()) for line in f) // nk - 1
+
+
+def write_integrands(eigen_fname, pmn_fname, nk, nval, ncond, response,
+                     components, suffix='', pnn_fname=None, block=16,
+                     tol=1e-4, memory=None):
+    """
+    Write the transition energies and the integrands of a response
+    in the format read by the integrators of utils.integrate,
+    processing the k-points by blocks.
+
+    Files written (one line per k-point):
+        energys.d<suffix>, halfenergys.d<suffix> : w_cv and w_cv / 2
+        chi1.<component>.dat<suffix> : for response 'chi1'
+        shg1L.<component>.dat<suffix>, shg2L.<component>.dat<suffix> :
+            1w and 2w terms for response 'shg'
+
+    Arguments
+    ---------
+
+    eigen_fname, pmn_fname : str
+        Eigenvalues (eV, with a k-point index) and momentum matrix
+        elements, for the same bands.
+    nk : int
+        Number of k-points.
+    nval, ncond : int
+        Number of valence (occupied) and conduction bands in the
+        transitions.
+    response : 'chi1' | 'shg'
+    components : list of str, e.g. ['xx', 'yy'] or ['xyz']
+    suffix : str, appended to the file names, e.g. '_10x10x10_15'
+    pnn_fname : str, optional
+        Diagonal momentum matrix elements, if not in pmn.
+    block : int (16), number of k-points per block.
+    tol : float, degeneracy tolerance in eV.
+    memory : float, optional
+        Memory budget in MB. The number of k-points per block is then
+        the largest that fits in the budget, instead of block.
+    """
+    if response not in ('chi1', 'shg'):
+        raise Exception('Unknown response: {}'.format(response))
+    if memory is not None:
+        nband = _count_bands(eigen_fname, nk)
+        block = block_size(memory, _kpoint_values(nband, response), 1)
+    names = ['chi1'] if response == 'chi1' else ['shg1L', 'shg2L']
+    files = dict()
+    try:
+        for name in ('energys.d', 'halfenergys.d'):
+            files[name] = open(name + suffix, 'w')
+        for name in names:
+            for component in components:
+                key = '{}.{}.dat'.format(name, component)
+                files[key] = open(key + suffix, 'w')
+
+        eigen_blocks = iter_rows(eigen_fname, nk, block, index=True)
+        pmn_blocks = iter_rows(pmn_fname, nk, block)
+        pnn_blocks = iter_rows(pnn_fname, nk, block) if pnn_fname else None
+        for eigen in eigen_blocks:
+            pmn = next(pmn_blocks)
+            pnn = next(pnn_blocks) if pnn_blocks else None
+            p = momentum_matrix(pmn, eigen.shape[1], pnn)
+            r = position_matrix(eigen, p, tol)
+            if ( response == 'shg' ):
+                rd = generalized_derivative(eigen, p, r, tol)
+            energies = transition_energies(eigen, nval, ncond)
+            _append_rows(files['energys.d'], energies)
+            _append_rows(files['halfenergys.d'], 0.5 * energies)
+            for component in components:
+                axes = [_directions[x] for x in component]
+                if ( response == 'chi1' ):
+                    values = [chi1_integrand(r, nval, ncond, *axes)]
+                else:
+                    values = shg_integrands(eigen, p, r, nval, ncond, *axes,
+                                            tol=tol, rd=rd)
+                for name, value in zip(names, values):
+                    _append_rows(files['{}.{}.dat'.format(name, component)],
+                                 value)
+    finally:
+        for f in files.values():
+            f.close()
@@ -0,0 +1,1211 @@
+"""
+Brillouin zone integration of the response integrands written by
+set_input_all, as an alternative to tetra_method_all.
+
+The spectrum is
+
+    S(w) = sum_k w_k sum_t I_t(k) delta(w - e_t(k))
+
+where t runs over the transitions (pairs of bands), e_t(k) are the
+transition energies (energys.d or halfenergys.d), I_t(k) the integrand
+and w_k the weights of the irreducible k-points, normalized to one.
+"""
+from __future__ import print_function, division
+import os
+import shutil
+import tempfile
+import contextlib
+import multiprocessing
+
+import numpy as np
+
+from .units import eV_to_Ha
+from .kdata import (read_klist, read_rows, iter_rows, kpoint_keys,
+                    read_symd, read_pvectors)
+
+__all__ = ['kpoint_weights', 'read_transitions', 'energy_grid',
+           'histogram_spectrum', 'smearing_spectrum', 'adaptive_widths',
+           'adaptive_spectrum', 'read_tetrahedra', 'blochl_weights',
+           'make_triangles', 'read_triangles', 'write_triangles',
+           'triangle_weights',
+           'tetrahedron_spectrum', 'iter_kpoint_blocks',
+           'iter_transition_blocks', 'block_size', 'SharedArrays',
+           'parallel_spectrum', 'spectrum_workers', 'write_spectrum',
+           'transition_groups', 'write_group_spectra', 'window_fractions',
+           'kpoint_contributions', 'tetrahedron_contributions',
+           'write_contributions', 'integrate_response']
+
+
+def kpoint_weights(kpts, symops, normalize=True):
+    """
+    Weights of irreducible k-points, proportional to the number of
+    k-points in their star, normalized to one.
+    Time reversal is included.
+    With normalize=False, return the number of k-points in each star.
+    """
+    kpts = np.asarray(kpts, dtype=float)
+    symops = np.asarray(symops, dtype=int)
+    symops = np.concatenate([symops, -symops])
+    stars = [set() for k in kpts]
+    for M in symops:
+        for star, key in zip(stars, kpoint_keys(np.dot(kpts, M.T))):
+            star.add(key)
+    weights = np.array([len(star) for star in stars], dtype=float)
+    if not normalize:
+        return weights
+    return weights / weights.sum()
+
+
+def _drop_index(rows):
+    """Drop a leading column holding the k-point index, if any."""
+    nk = len(rows)
+    if rows.shape[1] > 1 and np.allclose(rows[:, 0], np.arange(1, nk + 1)):
+        return rows[:, 1:]
+    return rows
+
+
+def read_transitions(energies_fname, integrand_fname, nk):
+    """
+    Read the transition energies and the integrand, with one record
+    per k-point, as arrays of shape (nk, ntransition).
+    """
+    energies = _drop_index(read_rows(energies_fname, nk))
+    integrand = _drop_index(read_rows(integrand_fname, nk))
+    if energies.shape != integrand.shape:
+        raise Exception(
+            '{} and {} hold different numbers of transitions ({} and {}).'
+            .format(energies_fname, integrand_fname,
+                    energies.shape[1], integrand.shape[1]))
+    return energies, integrand
+
+
+def _has_index(fname, nk):
+    """True if the records of a transition file start with an index."""
+    # Look for the index on enough records to tell it from data.
+    head = next(iter_rows(fname, nk, min(nk, 100)))
+    return _drop_index(head) is not head
+
+
+def _iter_transitions(fname, nk, block):
+    """
+    Iterate over blocks of records of a transition file,
+    dropping the k-point index if there is one.
+    """
+    index = _has_index(fname, nk)
+    for rows in iter_rows(fname, nk, block):
+        yield rows[:, 1:] if index else rows
+
+
+def iter_kpoint_blocks(energies_fname, integrand_fname, nk, block):
+    """
+    Iterate over blocks of k-points of the transition energies and of
+    the integrand. Yield the slice of k-points and the two arrays of
+    shape (nkblock, ntransition).
+    """
+    start = 0
+    # Under Python 2, zip would read all the blocks at once.
+    integrands = _iter_transitions(integrand_fname, nk, block)
+    for energies in _iter_transitions(energies_fname, nk, block):
+        integrand = next(integrands)
+        if energies.shape != integrand.shape:
+            raise Exception(
+                '{} and {} hold different numbers of transitions '
+                '({} and {}).'.format(energies_fname, integrand_fname,
+                                      energies.shape[1], integrand.shape[1]))
+        yield slice(start, start + len(energies)), energies, integrand
+        start += len(energies)
+
+
+def iter_transition_blocks(energies_fname, integrand_fname, nk, block,
+                           kblock=None):
+    """
+    Iterate over blocks of transitions, for all the k-points.
+    The files are read once per block, by blocks of kblock k-points,
+    so that only the block of transitions is held in memory.
+    Yield the slice of transitions and the two arrays of shape
+    (nk, ntransitionblock).
+    """
+    ntransition = None
+    start = 0
+    while ntransition is None or start < ntransition:
+        columns = list()
+        for fname in (energies_fname, integrand_fname):
+            chunks = list()
+            for rows in _iter_transitions(fname, nk, kblock or nk):
+                ntransition = rows.shape[1]
+                chunks.append(rows[:, start:start+block].copy())
+                del rows
+            columns.append(np.concatenate(chunks))
+        yield slice(start, start + block), columns[0], columns[1]
+        start += block
+
+
+def block_size(memory, nvalues, ncopies=8):
+    """
+    Number of records of nvalues float64 that fit in memory (in MB),
+    accounting for ncopies temporary arrays of the same size.
+    Return None (no limit) if memory is None.
+    """
+    if memory is None:
+        return None
+    return max(1, int(memory * 2 ** 20) // (8 * ncopies * max(1, nvalues)))
+
+
+def _count_columns(fname, nk):
+    """Number of values per k-point in a file."""
+    with open(fname, 'r') as f:
+        return sum(len(line.split()) for line in f) // nk
+
+
+def energy_grid(energy_min, energy_max, energy_steps):
+    """Energy grid of the spectra, as in the input of tetra_method_all."""
+    return np.linspace(energy_min, energy_max, int(energy_steps))
+
+
+def transition_groups(nval, ncond, valence=None, conduction=None):
+    """
+    Assign the transitions to groups, for spectra resolved by band.
+    Transitions are ordered with the valence band as the slowest index,
+    as in energys.d.
+
+    Arguments
+    ---------
+
+    nval, ncond : int
+        Number of valence and conduction bands in the transitions.
+    valence, conduction : list of (first, last), optional
+        Ranges of bands, counted from 1 (conduction bands from nval + 1),
+        forming the valence and conduction groups. Without ranges,
+        each band is a group of its own; a side without ranges is
+        a single group if the other side has ranges.
+
+    Returns
+    -------
+
+    groups : array(nval * ncond), group of each transition, or -1 for
+        the transitions outside the groups. The group of the valence
+        group i and of the conduction group j is i * nconduction + j.
+    names : list of str, e.g. 'v3-4_c5-5'
+    """
+    if valence is None and conduction is None:
+        valence = [(v, v) for v in range(1, nval + 1)]
+        conduction = [(c, c) for c in range(nval + 1, nval + ncond + 1)]
+    valence = valence or [(1, nval)]
+    conduction = conduction or [(nval + 1, nval + ncond)]
+
+    def labels(ranges, first, nband):
+        band = np.arange(first, first + nband)
+        label = -np.ones(nband, dtype=int)
+        for i, (b1, b2) in enumerate(ranges):
+            inside = (band >= b1) & (band <= b2)
+            if ( b1 > b2 or b1 < first or b2 >= first + nband or
+                 (label[inside] >= 0).any() ):
+                raise Exception('Invalid band group {}-{}.'.format(b1, b2))
+            label[inside] = i
+        return label
+
+    v = labels(valence, 1, nval)
+    c = labels(conduction, nval + 1, ncond)
+    groups = v[:, None] * len(conduction) + c[None, :]
+    groups[(v[:, None] < 0) | (c[None, :] < 0)] = -1
+    names = ['v{}-{}_c{}-{}'.format(v1, v2, c1, c2)
+             for v1, v2 in valence for c1, c2 in conduction]
+    return groups.ravel(), names
+
+
+def _deposit(energies, values, grid, groups=None, ngroup=None):
+    """
+    Accumulate values on the grid, each one shared linearly between
+    the two nearest grid points. Return the density per unit energy,
+    array(nw), or array(ngroup, nw) if the group of each value is given
+    (groups broadcast against energies).
+    """
+    de = grid[1] - grid[0]
+    x = (np.ravel(energies) - grid[0]) / de
+    values = np.ravel(values)
+    inside = (x >= 0) & (x <= len(grid) - 1)
+    x, values = x[inside], values[inside]
+    i = np.minimum(np.floor(x).astype(int), len(grid) - 2)
+    f = x - i
+    if groups is None:
+        hist = np.zeros(len(grid))
+    else:
+        hist = np.zeros((ngroup, len(grid)))
+        groups = np.ravel(np.broadcast_to(groups, np.shape(energies)))
+        # Flat indices in hist.
+        i = i + len(grid) * groups[inside]
+    np.add.at(hist.reshape(-1), i, values * (1. - f))
+    np.add.at(hist.reshape(-1), i + 1, values * f)
+    return hist / de
+
+
+def histogram_spectrum(energies, integrand, weights, grid, sigma,
+                       groups=None, ngroup=None):
+    """
+    Integrate with a Gaussian smearing of width sigma: the weighted
+    integrand is binned on the energy grid and convolved with the
+    Gaussian.
+
+    Arguments
+    ---------
+
+    energies, integrand : array(nk, ntransition)
+    weights : array(nk)
+    grid : array(nw), evenly spaced energies
+    sigma : float, standard deviation of the Gaussian
+    groups : array(ntransition), optional
+        Group of each transition, from 0 to ngroup - 1. The spectra of
+        the groups are then returned, as an array(ngroup, nw).
+    """
+    values = np.asarray(integrand) * np.asarray(weights)[:, None]
+    # Transitions just outside the grid still contribute through the tails.
+    de = grid[1] - grid[0]
+    npad = int(np.ceil(5 * sigma / de))
+    padded = grid[0] + de * np.arange(-npad, len(grid) + npad)
+    hist = _deposit(energies, values, padded, groups, ngroup)
+    x = de * np.arange(-npad, npad + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    kernel /= kernel.sum()
+    if groups is not None:
+        return np.array([np.convolve(h, kernel, mode='same')
+                         for h in hist])[:, npad:npad+len(grid)]
+    return np.convolve(hist, kernel, mode='same')[npad:npad+len(grid)]
+
+
+def _kernel(x, sigma, shape):
+    """Broadening function sampled at x, normalized to unit area."""
+    if ( shape == 'gaussian' ):
+        return np.exp(-0.5 * (x / sigma) ** 2) / (np.sqrt(2 * np.pi) * sigma)
+    elif ( shape == 'lorentzian' ):
+        return sigma / np.pi / (x ** 2 + sigma ** 2)
+    raise Exception('Unknown broadening: {}'.format(shape))
+
+
+def _fft_convolve(a, b):
+    """
+    Linear convolution of two real sequences, same size as a.
+    If a is two-dimensional, each row is convolved with b.
+    """
+    n = np.shape(a)[-1] + len(b) - 1
+    nfft = 1 << int(np.ceil(np.log2(n)))
+    c = np.fft.irfft(np.fft.rfft(a, nfft) * np.fft.rfft(b, nfft), nfft)
+    start = (len(b) - 1) // 2
+    return c[..., start:start+np.shape(a)[-1]]
+
+
+def smearing_spectrum(energies, integrand, weights, grid, sigma,
+                      shape='gaussian', groups=None, ngroup=None):
+    """
+    Integrate with a Gaussian or Lorentzian broadening: the weighted
+    integrand is binned on the energy grid and convolved with the
+    broadening function by FFT, so that the cost is linear in the number
+    of transitions and in the number of energies (up to a logarithm).
+
+    Arguments
+    ---------
+
+    energies, integrand : array(nk, ntransition)
+    weights : array(nk)
+    grid : array(nw), evenly spaced energies
+    sigma : float, standard deviation (gaussian) or half width at half
+        maximum (lorentzian)
+    shape : 'gaussian' | 'lorentzian'
+    groups : array(ntransition), optional, see histogram_spectrum.
+    """
+    values = np.asarray(integrand) * np.asarray(weights)[:, None]
+    de = grid[1] - grid[0]
+    # Transitions outside the grid contribute through the tails;
+    # Lorentzian tails are kept up to one grid width away.
+    if ( shape == 'gaussian' ):
+        npad = int(np.ceil(5 * sigma / de))
+    else:
+        npad = len(grid)
+    padded = grid[0] + de * np.arange(-npad, len(grid) + npad)
+    hist = _deposit(energies, values, padded, groups, ngroup)
+    x = de * np.arange(-npad, npad + 1)
+    kernel = _kernel(x, sigma, shape) * de
+    return _fft_convolve(hist, kernel)[..., npad:npad+len(grid)]
+
+
+def adaptive_widths(velocities, nval, ntransition, dk, factor=0.3,
+                    sigma_min=0.01, sigma_max=None):
+    """
+    Broadening of each transition, proportional to the difference
+    of the band velocities and to the spacing of the k-point grid:
+        sigma = factor * |v_c - v_v| * dk
+
+    Arguments
+    ---------
+
+    velocities : array(nk, nband, 3)
+        Band velocities (pnn), in atomic units.
+    nval : int
+        Number of valence bands; transitions are ordered with the
+        valence band as the slowest index, as in energys.d.
+    ntransition : int
+        Number of transitions per k-point.
+    dk : float
+        Spacing of the k-point grid, in inverse Bohr.
+    factor : float (0.3)
+    sigma_min, sigma_max : float
+        Bounds of the broadening, in eV. The lower bound keeps
+        the broadening finite for parallel bands.
+
+    Returns
+    -------
+
+    sigma : array(nk, ntransition), in eV.
+    """
+    ncond = ntransition // nval
+    if nval * ncond != ntransition or nval + ncond > velocities.shape[1]:
+        raise Exception(
+            '{} transitions do not match {} valence bands and {} bands.'
+            .format(ntransition, nval, velocities.shape[1]))
+    v = velocities[:, :nval, None, :]
+    c = velocities[:, None, nval:nval+ncond, :]
+    dv = np.sqrt(((c - v) ** 2).sum(axis=-1)).reshape(len(velocities), -1)
+    sigma = factor * dv * dk / eV_to_Ha
+    return np.clip(sigma, sigma_min, sigma_max)
+
+
+def adaptive_spectrum(energies, integrand, weights, grid, sigma, ratio=1.1,
+                      groups=None, ngroup=None, sigma_min=None):
+    """
+    Integrate with a Gaussian broadening specific to each transition.
+    Transitions are sorted in classes of broadening, spaced
+    logarithmically by ratio from sigma_min, and each class is
+    convolved with its own Gaussian by FFT.
+
+    Arguments
+    ---------
+
+    energies, integrand, sigma : array(nk, ntransition)
+    weights : array(nk)
+    grid : array(nw), evenly spaced energies
+    ratio : float (1.1), ratio between the widths of successive classes
+    groups : array(ntransition), optional, see histogram_spectrum.
+    sigma_min : float, optional
+        Width of the first class, the smallest width of sigma by default.
+        Give the same value to every call whose spectra are summed,
+        so that a transition is in the same class whatever the block
+        or process. Widths below a tenth of the grid spacing, which the
+        grid cannot resolve, are raised to it.
+    """
+    values = np.asarray(integrand) * np.asarray(weights)[:, None]
+    if groups is not None:
+        groups = np.ravel(np.broadcast_to(groups, np.shape(energies)))
+    energies = np.ravel(energies)
+    values = np.ravel(values)
+    sigma = np.ravel(sigma)
+
+    de = grid[1] - grid[0]
+    if sigma_min is None:
+        sigma_min = sigma.min()
+    sigma_min = max(sigma_min, 0.1 * de)
+    sigma = np.maximum(sigma, sigma_min)
+
+    classes = np.floor(np.log(sigma / sigma_min) / np.log(ratio))
+    classes = classes.astype(int)
+    widths = sigma_min * ratio ** (np.unique(classes) + 0.5)
+    npad = int(np.ceil(5 * widths.max() / de))
+    padded = grid[0] + de * np.arange(-npad, len(grid) + npad)
+    spectrum = 0.
+    for iclass, width in zip(np.unique(classes), widths):
+        members = classes == iclass
+        hist = _deposit(energies[members], values[members], padded,
+                        None if groups is None else groups[members], ngroup)
+        # The kernel depends on the class only, not on the other widths.
+        nx = int(np.ceil(5 * width / de))
+        kernel = _kernel(de * np.arange(-nx, nx + 1), width, 'gaussian')
+        spectrum = spectrum + _fft_convolve(hist, kernel / kernel.sum())
+    return spectrum[..., npad:npad+len(grid)]
+
+
+def read_tetrahedra(fname):
+    """
+    Read the tetrahedra written by ibz (KKflow).
+    Each line holds the indices (counted from 1) of the four irreducible
+    k-points at the corners and the weight of the tetrahedron,
+    possibly preceded by the index of the tetrahedron.
+
+    Returns
+    -------
+
+    corners : array(ntet, 4), indices counted from 0.
+    weights : array(ntet), normalized to one.
+    """
+    data = np.loadtxt(fname, ndmin=2)
+    corners = np.array(data[:, -5:-1], dtype=int) - 1
+    weights = data[:, -1] / data[:, -1].sum()
+    return corners, weights
+
+
+def make_triangles(kpts, symops, kgrid):
+    """
+    Split a two-dimensional k-point grid (kgrid[2] == 1) into triangles,
+    two per cell, with corners mapped to the irreducible k-points.
+    Triangles with the same irreducible corners are merged.
+
+    Arguments
+    ---------
+
+    kpts : array(nk, 3), irreducible k-points of the grid.
+    symops : array(nsym, 3, 3), symmetry operations (sym.d).
+    kgrid : int, array(3), k-point grid.
+
+    Returns
+    -------
+
+    corners : array(ntri, 3), indices counted from 0.
+    weights : array(ntri), number of triangles of the grid merged
+        in each triangle.
+    """
+    kpts = np.asarray(kpts, dtype=float)
+    n1, n2 = int(kgrid[0]), int(kgrid[1])
+    if int(kgrid[2]) != 1:
+        raise Exception('Triangles require a k-point grid with one point '
+                        'along the third direction, not {}.'.format(kgrid))
+
+    # Irreducible k-point of every point of the star.
+    symops = np.asarray(symops, dtype=int)
+    lookup = dict()
+    for M in np.concatenate([symops, -symops]):
+        for ik, key in enumerate(kpoint_keys(np.dot(kpts, M.T))):
+            lookup.setdefault(key, ik)
+
+    # Full grid, with the shift of the irreducible k-points.
+    shift = kpts[0, :2] * [n1, n2]
+    shift -= np.round(shift)
+    i, j = np.meshgrid(np.arange(n1 + 1), np.arange(n2 + 1), indexing='ij')
+    full = np.column_stack([((i + shift[0]) / n1).ravel(),
+                            ((j + shift[1]) / n2).ravel(),
+                            np.full(i.size, kpts[0, 2])])
+    try:
+        ik = np.array([lookup[key] for key in kpoint_keys(full)])
+    except KeyError as e:
+        raise Exception('K-point {} of the grid has no irreducible image.'
+                        .format(e.args[0]))
+    ik = ik.reshape(n1 + 1, n2 + 1)
+
+    a, b = ik[:-1, :-1].ravel(), ik[1:, :-1].ravel()
+    c, d = ik[:-1, 1:].ravel(), ik[1:, 1:].ravel()
+    triangles = np.concatenate([np.column_stack([a, b, d]),
+                                np.column_stack([a, c, d])])
+    triangles = np.sort(triangles, axis=1)
+    corners, weights = _unique_rows(triangles)
+    return corners, weights
+
+
+def _unique_rows(rows):
+    """Unique rows of an integer array and their multiplicities."""
+    counts = dict()
+    for row in map(tuple, rows):
+        counts[row] = counts.get(row, 0) + 1
+    keys = sorted(counts)
+    return (np.array(keys, dtype=int),
+            np.array([counts[k] for k in keys], dtype=float))
+
+
+def read_triangles(fname):
+    """
+    Read the triangles written by make_triangles: each line holds
+    the indices (counted from 1) of the three corners and the weight.
+    Return the corners counted from 0 and the weights normalized to one.
+    """
+    data = np.loadtxt(fname, ndmin=2)
+    corners = np.array(data[:, :3], dtype=int) - 1
+    weights = data[:, 3] / data[:, 3].sum()
+    return corners, weights
+
+
+def write_triangles(fname, corners, weights):
+    """Write triangles in the format of read_triangles."""
+    with open(fname, 'w') as f:
+        for corner, weight in zip(corners, weights):
+            f.write('{} {} {} {:g}\n'.format(corner[0] + 1, corner[1] + 1,
+                                             corner[2] + 1, weight))
+
+
+def triangle_weights(e, E):
+    """
+    Integration weights of the corners of triangles of unit area
+    for the occupation theta(E - e), with linear interpolation.
+
+    Arguments
+    ---------
+
+    e : array(n, 3), corner energies sorted in increasing order,
+        and all distinct.
+    E : array(n), energies.
+    """
+    e1, e2, e3 = e.T
+    w = np.zeros(e.shape)
+
+    a = (E > e1) & (E <= e2)
+    if a.any():
+        t2 = ((E - e1) / (e2 - e1))[a]
+        t3 = ((E - e1) / (e3 - e1))[a]
+        area = t2 * t3
+        w[a, 0] = area * (1 - (t2 + t3) / 3.)
+        w[a, 1] = area * t2 / 3.
+        w[a, 2] = area * t3 / 3.
+
+    # Above e2, subtract the triangle left above E.
+    b = (E > e2) & (E < e3)
+    if b.any():
+        s1 = ((e3 - E) / (e3 - e1))[b]
+        s2 = ((e3 - E) / (e3 - e2))[b]
+        area = s1 * s2
+        w[b, 0] = 1. / 3 - area * s1 / 3.
+        w[b, 1] = 1. / 3 - area * s2 / 3.
+        w[b, 2] = 1. / 3 - area * (1 - (s1 + s2) / 3.)
+
+    w[E >= e3] = 1. / 3
+    return w
+
+
+def _tetrahedron_dos(e, E):
+    """Density of states of tetrahedra of unit volume."""
+    e1, e2, e3, e4 = e.T
+    dos = np.zeros(len(E))
+    a = (E > e1) & (E <= e2)
+    dos[a] = 3 * (E - e1)[a] ** 2 / ((e2 - e1) * (e3 - e1) * (e4 - e1))[a]
+    b = (E > e2) & (E <= e3)
+    x = (E - e2)[b]
+    dos[b] = (3 * (e2 - e1)[b] + 6 * x - 3 * ((e3 - e1) + (e4 - e2))[b] *
+              x ** 2 / ((e3 - e2) * (e4 - e2))[b]) / \
+             ((e3 - e1) * (e4 - e1))[b]
+    c = (E > e3) & (E < e4)
+    dos[c] = 3 * (e4 - E)[c] ** 2 / ((e4 - e1) * (e4 - e2) * (e4 - e3))[c]
+    return dos
+
+
+def blochl_weights(e, E, correction=False):
+    """
+    Integration weights of the corners of tetrahedra of unit volume
+    for the occupation theta(E - e), with linear interpolation
+    [Blochl, Jepsen and Andersen, Phys. Rev. B 49, 16223 (1994)].
+
+    Arguments
+    ---------
+
+    e : array(n, 4), corner energies sorted in increasing order,
+        and all distinct.
+    E : array(n), energies.
+    correction : bool (False)
+        Add the Blochl correction for the curvature of the bands.
+    """
+    e1, e2, e3, e4 = e.T
+    w = np.zeros(e.shape)
+
+    a = (E > e1) & (E <= e2)
+    if a.any():
+        x = (E - e1)[a]
+        d = (e[a, 1:] - e1[a, None])
+        C = 0.25 * x ** 3 / d.prod(axis=1)
+        w[a, 0] = C * (4 - x * (1. / d).sum(axis=1))
+        w[a, 1:] = C[:, None] * x[:, None] / d
+
+    b = (E > e2) & (E <= e3)
+    if b.any():
+        E_, f1, f2, f3, f4 = E[b], e1[b], e2[b], e3[b], e4[b]
+        C1 = 0.25 * (E_ - f1) ** 2 / ((f4 - f1) * (f3 - f1))
+        C2 = 0.25 * (E_ - f1) * (E_ - f2) * (f3 - E_) / \
+             ((f4 - f1) * (f3 - f2) * (f3 - f1))
+        C3 = 0.25 * (E_ - f2) ** 2 * (f4 - E_) / \
+             ((f4 - f2) * (f3 - f2) * (f4 - f1))
+        w[b, 0] = C1 + (C1 + C2) * (f3 - E_) / (f3 - f1) + \
+                  (C1 + C2 + C3) * (f4 - E_) / (f4 - f1)
+        w[b, 1] = C1 + C2 + C3 + (C2 + C3) * (f3 - E_) / (f3 - f2) + \
+                  C3 * (f4 - E_) / (f4 - f2)
+        w[b, 2] = (C1 + C2) * (E_ - f1) / (f3 - f1) + \
+                  (C2 + C3) * (E_ - f2) / (f3 - f2)
+        w[b, 3] = (C1 + C2 + C3) * (E_ - f1) / (f4 - f1) + \
+                  C3 * (E_ - f2) / (f4 - f2)
+
+    c = (E > e3) & (E < e4)
+    if c.any():
+        x = (e4 - E)[c]
+        d = (e4[c, None] - e[c, :3])
+        C = 0.25 * x ** 3 / d.prod(axis=1)
+        w[c, :3] = 0.25 - C[:, None] * x[:, None] / d
+        w[c, 3] = 0.25 - C * (4 - x * (1. / d).sum(axis=1))
+
+    w[E >= e4] = 0.25
+
+    if correction:
+        dos = _tetrahedron_dos(e, E)
+        w += dos[:, None] / 40. * (e.sum(axis=1)[:, None] - 4 * e)
+    return w
+
+
+def tetrahedron_spectrum(energies, integrand, corners, weights, grid,
+                         correction=False, groups=None, ngroup=None):
+    """
+    Integrate with the linear tetrahedron method.
+    The integral of the integrand below each bin edge is computed with
+    the occupation weights of Blochl, and the spectrum is its
+    difference between successive edges, so that no transition is lost
+    however narrow the bins.
+    Two-dimensional grids are integrated in the same way over triangles.
+
+    Arguments
+    ---------
+
+    energies, integrand : array(nk, ntransition)
+    corners : array(ntet, 4), k-point indices of the tetrahedra,
+        or array(ntri, 3) for triangles
+    weights : array(ntet), weights of the tetrahedra
+    grid : array(nw), evenly spaced energies
+    correction : bool (False), use the Blochl correction
+        (tetrahedra only)
+    groups : array(ntransition), optional, see histogram_spectrum.
+    """
+    de = grid[1] - grid[0]
+    edges = grid[0] - 0.5 * de + de * np.arange(len(grid) + 1)
+    shape = (len(edges) + 1,) if groups is None else (ngroup, len(edges) + 1)
+    cumulative_groups = np.zeros(shape)
+    steps_groups = np.zeros(shape)
+    # Lift degeneracies, which only change the weights negligibly.
+    ncorner = corners.shape[1]
+    lift = 1e-8 * de * np.arange(ncorner)
+
+    for t in range(energies.shape[1]):
+        if groups is None:
+            cumulative, steps = cumulative_groups, steps_groups
+        else:
+            cumulative = cumulative_groups[groups[t]]
+            steps = steps_groups[groups[t]]
+        e = energies[corners, t]
+        order = np.argsort(e, axis=1, kind='mergesort')
+        rows = np.arange(len(e))[:, None]
+        e = e[rows, order] + lift
+        values = integrand[corners, t][rows, order]
+
+        # Above the highest corner, the tetrahedron is fully counted.
+        last = np.searchsorted(edges, e[:, -1], 'left')
+        np.add.at(steps, last, weights * values.mean(axis=1))
+
+        # Edges crossing the tetrahedron.
+        first = np.searchsorted(edges, e[:, 0], 'right')
+        counts = np.maximum(last - first, 0)
+        if not counts.any():
+            continue
+        itet = np.repeat(np.arange(len(e)), counts)
+        offsets = np.cumsum(counts) - counts
+        iedge = first[itet] + np.arange(counts.sum()) - offsets[itet]
+        if ( ncorner == 3 ):
+            w = triangle_weights(e[itet], edges[iedge])
+        else:
+            w = blochl_weights(e[itet], edges[iedge], correction)
+        np.add.at(cumulative, iedge,
+                  weights[itet] * (w * values[itet]).sum(axis=1))
+
+    cumulative = cumulative_groups + np.cumsum(steps_groups, axis=-1)
+    return np.diff(cumulative[..., :len(edges)], axis=-1) / de
+
+
+def _erf(x):
+    """
+    Error function, with an absolute error below 1.5e-7
+    [Abramowitz and Stegun, 7.1.26].
+    """
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1. / (1. + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 +
+           t * (-1.453152027 + t * 1.061405429))))
+    return sign * (1. - poly * np.exp(-x * x))
+
+
+def window_fractions(energies, windows, sigma, shape='gaussian'):
+    """
+    Fraction of the broadened delta function of each transition that
+    falls in each energy window.
+
+    Arguments
+    ---------
+
+    energies : array(...), transition energies
+    windows : array(nwindow, 2), lower and upper bounds of the windows
+    sigma : float or array(...), broadening of each transition
+    shape : 'gaussian' | 'lorentzian'
+
+    Returns
+    -------
+
+    fractions : array(..., nwindow)
+    """
+    windows = np.asarray(windows, dtype=float).reshape(-1, 2)
+    e = np.asarray(energies)[..., None]
+    sigma = np.asarray(sigma, dtype=float)[..., None]
+    lower = (windows[:, 0] - e) / sigma
+    upper = (windows[:, 1] - e) / sigma
+    if ( shape == 'gaussian' ):
+        return 0.5 * (_erf(upper / np.sqrt(2)) - _erf(lower / np.sqrt(2)))
+    elif ( shape == 'lorentzian' ):
+        return (np.arctan(upper) - np.arctan(lower)) / np.pi
+    raise Exception('Unknown broadening: {}'.format(shape))
+
+
+def kpoint_contributions(energies, integrand, weights, windows, sigma,
+                         shape='gaussian'):
+    """
+    Contribution of each k-point to the integral of a smeared spectrum
+    over each energy window, so that the sum over k-points is the
+    integral of the spectrum over the window.
+
+    Arguments
+    ---------
+
+    energies, integrand : array(nk, ntransition)
+    weights : array(nk)
+    windows : array(nwindow, 2), energy windows
+    sigma : float or array(nk, ntransition), broadening
+    shape : 'gaussian' | 'lorentzian'
+
+    Returns
+    -------
+
+    contributions : array(nk, nwindow)
+    """
+    values = np.asarray(integrand) * np.asarray(weights)[:, None]
+    windows = np.asarray(windows, dtype=float).reshape(-1, 2)
+    contributions = np.zeros((len(values), len(windows)))
+    # One window at a time, to keep the temporaries of size (nk, nt).
+    for iw, window in enumerate(windows):
+        fractions = window_fractions(energies, window, sigma, shape)
+        contributions[:, iw] = (values * fractions[..., 0]).sum(axis=1)
+    return contributions
+
+
+def tetrahedron_contributions(energies, integrand, corners, weights,
+                              windows, correction=False):
+    """
+    Contribution of each k-point to the integral of the spectrum of the
+    linear tetrahedron method over each energy window. The integral
+    over a tetrahedron is shared between its corners with the weights
+    of Blochl (see tetrahedron_spectrum).
+
+    Arguments
+    ---------
+
+    energies, integrand : array(nk, ntransition)
+    corners : array(ntet, 4) or array(ntri, 3), k-point indices
+    weights : array(ntet), weights of the tetrahedra
+    windows : array(nwindow, 2), energy windows
+    correction : bool (False), use the Blochl correction
+
+    Returns
+    -------
+
+    contributions : array(nk, nwindow)
+    """
+    windows = np.asarray(windows, dtype=float).reshape(-1, 2)
+    contributions = np.zeros((len(energies), len(windows)))
+    ncorner = corners.shape[1]
+    lift = 1e-10 * np.arange(ncorner)
+
+    for t in range(energies.shape[1]):
+        e = energies[corners, t]
+        order = np.argsort(e, axis=1, kind='mergesort')
+        rows = np.arange(len(e))[:, None]
+        e = e[rows, order] + lift
+        values = integrand[corners, t][rows, order]
+        kpts = corners[rows, order]
+
+        for iw, (lower, upper) in enumerate(windows):
+            # Only the tetrahedra crossing the window contribute.
+            cross = (e[:, 0] < upper) & (e[:, -1] > lower)
+            if not cross.any():
+                continue
+            w = 0.
+            for E, sign in ((upper, 1.), (lower, -1.)):
+                E = np.repeat(E, cross.sum())
+                if ( ncorner == 3 ):
+                    w = w + sign * triangle_weights(e[cross], E)
+                else:
+                    w = w + sign * blochl_weights(e[cross], E, correction)
+            np.add.at(contributions[:, iw], kpts[cross],
+                      weights[cross, None] * w * values[cross])
+    return contributions
+
+
+def write_contributions(fname, kpts, contributions, windows):
+    """
+    Write the contribution of each k-point to each energy window,
+    one line per k-point in the order of the k-list:
+        kx ky kz contribution(window 1) ... contribution(window n)
+    """
+    header = 'kx ky kz ' + ' '.join(
+        '{:g}:{:g}'.format(*window) for window in windows)
+    np.savetxt(fname, np.column_stack([kpts, contributions]), fmt='%.8E',
+               header=header)
+
+
+class SharedArrays(object):
+    """
+    Arrays shared between processes through memory-mapped files,
+    written once and mapped read-only by each process, so that
+    they are neither pickled nor copied.
+
+        >>> with SharedArrays() as shared:
+        ...     descriptor = shared.put(array)
+        ...     # in any process:
+        ...     view = SharedArrays.attach(descriptor)
+    """
+
+    def __init__(self, dirname=None):
+        if dirname is None and os.path.isdir('/dev/shm'):
+            dirname = '/dev/shm'
+        self.dirname = tempfile.mkdtemp(prefix='optpy-', dir=dirname)
+        self.count = 0
+
+    def put(self, array):
+        """Copy an array to shared memory and return its descriptor."""
+        array = np.ascontiguousarray(array)
+        fname = os.path.join(self.dirname, '{}.dat'.format(self.count))
+        self.count += 1
+        shared = np.memmap(fname, dtype=array.dtype, mode='w+',
+                           shape=array.shape or (1,))
+        shared[...] = array
+        shared.flush()
+        del shared
+        return (fname, array.dtype.str, array.shape)
+
+    def remove(self, descriptor):
+        """Free the shared memory of an array no longer needed."""
+        os.remove(descriptor[0])
+
+    @staticmethod
+    def attach(descriptor):
+        """Map a shared array read-only."""
+        fname, dtype, shape = descriptor
+        return np.memmap(fname, dtype=dtype, mode='r', shape=shape)
+
+    def close(self):
+        shutil.rmtree(self.dirname, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _spectrum(method, grid, arrays, params):
+    """
+    Spectrum for a set of arrays:
+    energies, integrand and weights of k-points for the smearing
+    methods, with the widths 'sigma' for 'adaptive'; energies,
+    integrand, corners and tweights for the tetrahedron methods.
+    The spectra of groups of transitions are computed instead if
+    params holds 'groups' and 'ngroup' (see histogram_spectrum).
+    """
+    groups = dict(groups=params.get('groups'), ngroup=params.get('ngroup'))
+    if len(arrays['energies']) == 0 or len(arrays.get('corners', [0])) == 0:
+        if groups['groups'] is not None:
+            return np.zeros((groups['ngroup'], len(grid)))
+        return np.zeros(len(grid))
+    if ( method == 'histogram' ):
+        return histogram_spectrum(arrays['energies'], arrays['integrand'],
+                                  arrays['weights'], grid, params['sigma'],
+                                  **groups)
+    elif method in ('gaussian', 'lorentzian'):
+        return smearing_spectrum(arrays['energies'], arrays['integrand'],
+                                 arrays['weights'], grid, params['sigma'],
+                                 method, **groups)
+    elif ( method == 'adaptive' ):
+        return adaptive_spectrum(arrays['energies'], arrays['integrand'],
+                                 arrays['weights'], grid, arrays['sigma'],
+                                 sigma_min=params.get('sigma'), **groups)
+    elif method in ('linear_tetrahedra', 'blochl'):
+        return tetrahedron_spectrum(arrays['energies'], arrays['integrand'],
+                                    arrays['corners'], arrays['tweights'],
+                                    grid, correction=(method == 'blochl'),
+                                    **groups)
+    raise Exception('Unknown integration method: {}'.format(method))
+
+
+def _split(method, arrays, part, nparts):
+    """Share of the work of one process: tetrahedra or k-points."""
+    if method in ('linear_tetrahedra', 'blochl'):
+        keys = ('corners', 'tweights')
+    else:
+        keys = ('energies', 'integrand', 'weights', 'sigma')
+    arrays = dict(arrays)
+    for key in keys:
+        if key in arrays:
+            bounds = np.linspace(0, len(arrays[key]), nparts + 1).astype(int)
+            arrays[key] = arrays[key][bounds[part]:bounds[part+1]]
+    return arrays
+
+
+def _spectrum_worker(args):
+    method, grid, descriptors, params, part, nparts = args
+    arrays = dict((key, SharedArrays.attach(descriptor))
+                  for key, descriptor in descriptors.items())
+    arrays = _split(method, arrays, part, nparts)
+    return _spectrum(method, grid, arrays, params)
+
+
+def parallel_spectrum(method, grid, arrays, params, nproc=1, pool=None,
+                      shared=None):
+    """
+    Compute a spectrum with nproc processes, each integrating a share
+    of the tetrahedra or of the k-points, and sum the partial spectra.
+    The arrays are placed once in shared memory (see SharedArrays).
+
+    Arguments
+    ---------
+
+    method : str, integration method (see integrate_response)
+    grid : array(nw), energies
+    arrays : dict of arrays, see _spectrum, or of the descriptors of
+        arrays already in shared
+    params : dict, {'sigma' : smearing}, and optionally the groups
+        of the transitions {'groups' : array(ntransition), 'ngroup' : int}
+    nproc : int (1), number of processes
+
+    Keyword arguments
+    -----------------
+
+    pool : multiprocessing.Pool, optional
+        Processes reused over the calls, e.g. over blocks of k-points,
+        instead of started for this call (see spectrum_workers).
+    shared : SharedArrays, optional
+        Shared memory of the pool. The arrays given as arrays are
+        placed in it for this call only.
+    """
+    if nproc <= 1:
+        return _spectrum(method, grid, arrays, params)
+
+    if pool is None:
+        with spectrum_workers(nproc) as (pool, shared):
+            return parallel_spectrum(method, grid, arrays, params, nproc,
+                                     pool, shared)
+
+    descriptors = dict()
+    temporary = list()
+    for key, array in arrays.items():
+        if isinstance(array, tuple):
+            descriptors[key] = array
+        else:
+            descriptors[key] = shared.put(array)
+            temporary.append(descriptors[key])
+    try:
+        parts = pool.map(_spectrum_worker,
+                         [(method, grid, descriptors, params, part, nproc)
+                          for part in range(nproc)])
+    finally:
+        for descriptor in temporary:
+            shared.remove(descriptor)
+    return np.sum(parts, axis=0)
+
+
+@contextlib.contextmanager
+def spectrum_workers(nproc):
+    """
+    Start nproc processes and their shared memory, to be reused by
+    parallel_spectrum, and yield (pool, shared), or (None, None) for
+    a single process.
+    """
+    if nproc <= 1:
+        yield None, None
+        return
+    with SharedArrays() as shared:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            yield pool, shared
+        finally:
+            pool.close()
+            pool.join()
+
+
+def write_spectrum(fname, grid, spectrum):
+    """Write a spectrum with two columns: energy and value."""
+    np.savetxt(fname, np.column_stack([grid, spectrum]), fmt='%.8E')
+
+
+def write_group_spectra(fname, grid, spectra, names):
+    """
+    Write the spectra of groups of transitions, array(ngroup, nw),
+    with one column per group after the energy, named in the header.
+    """
+    np.savetxt(fname, np.column_stack([grid, np.transpose(spectra)]),
+               fmt='%.8E', header='energy ' + ' '.join(names))
+
+
+def integrate_response(klist_fname, symd_fname, energies_fname,
+                       integrand_fname, spectrum_fname, energy_min=0.,
+                       energy_max=10., energy_steps=2001, sigma=0.15,
+                       method='histogram', pnn_fname=None,
+                       pvectors_fname=None, nval=None, factor=0.3,
+                       tetrahedra_fname=None, triangles_fname=None,
+                       memory=None, nproc=1, groups_fname=None,
+                       valence_groups=None, conduction_groups=None,
+                       windows=None, contributions_fname=None):
+    """
+    Integrate a response over the Brillouin zone and write its spectrum.
+
+    Arguments
+    ---------
+
+    klist_fname : str
+        Irreducible k-points.
+    symd_fname : str
+        Symmetry operations (sym.d), used for the k-point weights.
+    energies_fname : str
+        Transition energies (energys.d or halfenergys.d).
+    integrand_fname : str
+        Integrand written by set_input_all.
+    spectrum_fname : str
+        Output spectrum.
+    energy_min, energy_max, energy_steps :
+        Energy grid of the spectrum.
+    sigma : float
+        Smearing, or lower bound of the smearing for 'adaptive'.
+    method : 'histogram' | 'gaussian' | 'lorentzian' | 'adaptive'
+             | 'linear_tetrahedra' | 'blochl'
+        'histogram' convolves the binned integrand with a Gaussian
+        directly, 'gaussian' and 'lorentzian' by FFT.
+        'adaptive' sets the width of each transition from the band
+        velocities (see adaptive_widths).
+        'linear_tetrahedra' and 'blochl' use the tetrahedra, without and
+        with the Blochl correction (see tetrahedron_spectrum), or the
+        triangles of a two-dimensional grid if triangles_fname is given.
+    pnn_fname, pvectors_fname, nval :
+        Band velocities, primitive vectors and number of valence bands
+        included in the transitions ('adaptive' and groups only).
+    factor : float
+        Scale of the adaptive broadening.
+    tetrahedra_fname, triangles_fname : str
+        Tetrahedra or triangles ('linear_tetrahedra' and 'blochl' only).
+    memory : float, optional
+        Memory budget in MB. The files are then read by blocks of
+        k-points (smearing) or of transitions (tetrahedra) that fit in
+        the budget, instead of at once.
+    nproc : int (1)
+        Number of processes sharing the tetrahedra (tetrahedron methods)
+        or the k-points (smearing methods) of each block.
+    groups_fname : str, optional
+        Also write the spectra of groups of transitions, computed in the
+        same pass, in this file (see write_group_spectra).
+    valence_groups, conduction_groups : list of (first, last), optional
+        Band groups (see transition_groups); by default each pair of
+        bands is a group.
+    windows : list of (lower, upper), optional
+        Energy windows for which the contribution of each k-point is
+        recorded, in memory proportional to nk * nwindow.
+    contributions_fname : str, optional
+        Output of the contributions (see write_contributions),
+        required with windows.
+
+    Returns
+    -------
+
+    grid, spectrum, and the spectra of the groups, array(ngroup, nw),
+    if groups_fname is given.
+    """
+    kpts = read_klist(klist_fname)
+    nk = len(kpts)
+    stars = kpoint_weights(kpts, read_symd(symd_fname), normalize=False)
+    weights = stars / stars.sum()
+    grid = energy_grid(energy_min, energy_max, energy_steps)
+    ncol = _count_columns(energies_fname, nk)
+    params = dict(sigma=sigma)
+
+    if groups_fname:
+        ntransition = ncol - _has_index(energies_fname, nk)
+        if not nval or ntransition % nval:
+            raise Exception('{} transitions do not match {} valence bands.'
+                            .format(ntransition, nval))
+        groups, names = transition_groups(nval, ntransition // nval,
+                                          valence_groups, conduction_groups)
+        # Transitions outside the groups are gathered in a last group,
+        # so that the spectrum is the sum of all groups.
+        ngroup = len(names) + 1
+        groups = np.where(groups < 0, ngroup - 1, groups)
+        spectrum = np.zeros((ngroup, len(grid)))
+        params.update(groups=groups, ngroup=ngroup)
+    else:
+        spectrum = np.zeros(len(grid))
+
+    if windows is not None:
+        windows = np.asarray(windows, dtype=float).reshape(-1, 2)
+        contributions = np.zeros((nk, len(windows)))
+
+    def finish():
+        if windows is not None:
+            write_contributions(contributions_fname, kpts, contributions,
+                                windows)
+        if groups_fname:
+            write_group_spectra(groups_fname, grid, spectrum[:-1], names)
+            write_spectrum(spectrum_fname, grid, spectrum.sum(axis=0))
+            return grid, spectrum.sum(axis=0), spectrum[:-1]
+        write_spectrum(spectrum_fname, grid, spectrum)
+        return grid, spectrum
+
+    if method not in ('histogram', 'gaussian', 'lorentzian', 'adaptive',
+                      'linear_tetrahedra', 'blochl'):
+        raise Exception('Unknown integration method: {}'.format(method))
+
+    # The processes are started once for all the blocks.
+    with spectrum_workers(nproc) as (pool, shared):
+        if method in ('linear_tetrahedra', 'blochl'):
+            # Tetrahedra join any k-points: split the transitions instead.
+            if triangles_fname:
+                corners, tweights = read_triangles(triangles_fname)
+            else:
+                corners, tweights = read_tetrahedra(tetrahedra_fname)
+            block = block_size(memory, nk + 4 * len(corners)) or ncol
+            kblock = block_size(memory, ncol)
+            # The tetrahedra are shared once for all the blocks.
+            tetrahedra = dict(corners=corners, tweights=tweights)
+            if shared is not None:
+                tetrahedra = dict((key, shared.put(array))
+                                  for key, array in tetrahedra.items())
+            for t, energies, integrand in iter_transition_blocks(
+                    energies_fname, integrand_fname, nk, block, kblock):
+                arrays = dict(tetrahedra, energies=energies,
+                              integrand=integrand)
+                if groups_fname:
+                    params['groups'] = groups[t]
+                spectrum += parallel_spectrum(method, grid, arrays, params,
+                                              nproc, pool, shared)
+                if windows is not None:
+                    contributions += tetrahedron_contributions(
+                        energies, integrand, corners, tweights, windows,
+                        correction=(method == 'blochl'))
+            return finish()
+
+        if ( method == 'adaptive' ):
+            # Spacing of the grid from the volume of the Brillouin zone.
+            lattice = read_pvectors(pvectors_fname)
+            volume = (2 * np.pi) ** 3 / abs(np.linalg.det(lattice))
+            dk = (volume / stars.sum()) ** (1. / 3)
+            ncol += _count_columns(pnn_fname, nk)
+
+        # Smearing is additive in k-points: accumulate the blocks.
+        block = block_size(memory, ncol) or nk
+        if ( method == 'adaptive' ):
+            velocity_blocks = iter_rows(pnn_fname, nk, block)
+        for ks, energies, integrand in iter_kpoint_blocks(
+                energies_fname, integrand_fname, nk, block):
+            arrays = dict(energies=energies, integrand=integrand,
+                          weights=weights[ks])
+            if ( method == 'adaptive' ):
+                velocities = next(velocity_blocks).reshape(len(energies),
+                                                           -1, 3)
+                arrays['sigma'] = adaptive_widths(velocities, nval,
+                                                  energies.shape[1], dk,
+                                                  factor, sigma_min=sigma)
+            spectrum += parallel_spectrum(method, grid, arrays, params,
+                                          nproc, pool, shared)
+            if windows is not None:
+                contributions[ks] = kpoint_contributions(
+                    energies, integrand, weights[ks], windows,
+                    arrays.get('sigma', sigma),
+                    'lorentzian' if method == 'lorentzian' else 'gaussian')
+
+        return finish()
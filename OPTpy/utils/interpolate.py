@@ -0,0 +1,331 @@
+"""
+Fourier interpolation of band energies and matrix elements
+with symmetrized star functions.
+
+The method follows Shankland, Koelling and Wood, with the roughness
+functional of Pickett, Krakauer and Allen [Phys. Rev. B 38, 2721 (1988)]:
+the interpolated function passes through the data points and minimizes
+the roughness among all the star-function expansions doing so.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+from ..core import Workflow, Task
+from .units import eV_to_Ha
+from .kdata import (read_klist, read_rows, write_rows, kpoint_keys,
+                    read_symd, read_pvectors, pmn_to_complex,
+                    KDataFiles)
+
+__all__ = ['StarInterpolator', 'unfold_kpoints', 'interpolate_kdata',
+           'INTERPflow']
+
+
+def _with_time_reversal(symops):
+    """Group of operations including time reversal (k -> -k)."""
+    symops = np.asarray(symops, dtype=int)
+    return np.concatenate([symops, -symops])
+
+
+def _star_keys(kpts, symops):
+    """Key shared by all the k-points of a star."""
+    keys = [kpoint_keys(np.dot(kpts, M.T)) for M in symops]
+    return [min(k) for k in zip(*keys)]
+
+
+def _lattice_stars(lattice, symops, nstar):
+    """
+    Return the stars of real-space lattice vectors, ordered by length,
+    as a flat array of integer vectors, the star index of each vector,
+    and the length of each star.
+    """
+    # Star functions are sums of cos(2 pi k . M^T n) over the operations M.
+    ops = np.transpose(symops, (0, 2, 1))
+    inv = np.linalg.inv(lattice)
+    nmax = 1
+    while True:
+        # Largest radius of a sphere contained in the box |n_i| <= nmax.
+        radius = nmax / np.sqrt((inv ** 2).sum(axis=0)).max()
+        r = np.arange(-nmax, nmax + 1)
+        n = np.array(np.meshgrid(r, r, r, indexing='ij')).reshape(3, -1).T
+        length = np.sqrt((np.dot(n, lattice) ** 2).sum(axis=1))
+        inside = length <= radius
+        n, length = n[inside], length[inside]
+        order = np.argsort(length, kind='mergesort')
+        n, length = n[order], length[order]
+
+        seen = set()
+        members, star, star_length = list(), list(), list()
+        for vector, norm in zip(n, length):
+            if tuple(vector) in seen:
+                continue
+            images = set(tuple(v) for v in np.dot(ops, vector))
+            seen.update(images)
+            members.extend(sorted(images))
+            star.extend(len(images) * [len(star_length)])
+            star_length.append(norm)
+
+        # The last star may be truncated by the sphere; drop it.
+        if len(star_length) > nstar + 1:
+            break
+        nmax *= 2
+
+    star = np.array(star)
+    keep = star < nstar
+    return (np.array(members, dtype=float)[keep], star[keep],
+            np.array(star_length[:nstar]))
+
+
+class StarInterpolator(object):
+    """
+    Interpolate functions of k that are invariant under a group of
+    symmetry operations, from their values on a set of k-points.
+
+        >>> interp = StarInterpolator(kpts, eigen, symops, lattice)
+        >>> dense_eigen = interp(dense_kpts)
+    """
+
+    _C1 = 0.75
+    _C2 = 0.75
+
+    def __init__(self, kpts, values, symops, lattice, ratio=5):
+        """
+        Arguments
+        ---------
+
+        kpts : array(nk, 3)
+            K-points in reduced coordinates.
+        values : array(nk, ...)
+            Values of the functions to interpolate at each k-point,
+            e.g. eigenvalues of shape (nk, nband).
+        symops : array(nsym, 3, 3)
+            Symmetry operations acting on reduced k-points (sym.d).
+            Time reversal is always added.
+        lattice : array(3, 3)
+            Primitive vectors, as rows, in Bohr.
+        ratio : float (5)
+            Number of star functions per independent k-point.
+        """
+        kpts = np.asarray(kpts, dtype=float)
+        values = np.asarray(values, dtype=float)
+        self.value_shape = values.shape[1:]
+        values = values.reshape(len(kpts), -1)
+        self.lattice = np.asarray(lattice, dtype=float)
+        self.symops = _with_time_reversal(symops)
+
+        # Equivalent k-points would make the fit singular.
+        keys = _star_keys(kpts, self.symops)
+        unique = dict()
+        for ik, key in enumerate(keys):
+            unique.setdefault(key, list()).append(ik)
+        groups = list(unique.values())
+        kpts = kpts[[g[0] for g in groups]]
+        values = np.array([values[g].mean(axis=0) for g in groups])
+        nk = len(kpts)
+
+        self.members, self.star, length = _lattice_stars(
+            self.lattice, self.symops, max(int(ratio * nk), nk + 1))
+        self.nstar = len(length)
+
+        # Roughness of each star function (the first one is constant).
+        x = (length[1:] / length[1]) ** 2
+        rho = (1. - self._C1 * x) ** 2 + self._C2 * x ** 3
+
+        S = self._stars(kpts)
+        dS = S[:-1, 1:] - S[-1, 1:]
+        dE = values[:-1] - values[-1]
+        H = np.dot(dS / rho, dS.T)
+        lam = np.linalg.solve(H, dE)
+
+        coefs = np.empty((self.nstar, values.shape[1]))
+        coefs[1:] = np.dot(dS.T, lam) / rho[:, None]
+        coefs[0] = values[-1] - np.dot(S[-1, 1:], coefs[1:])
+        self.coefs = coefs
+
+    def _phases(self, kpts):
+        return 2 * np.pi * np.dot(np.asarray(kpts, dtype=float).reshape(-1, 3),
+                                  self.members.T)
+
+    def _reduce(self, terms):
+        """Average the terms of shape (nk, nmember, ...) over each star."""
+        counts = np.bincount(self.star, minlength=self.nstar)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.add.reduceat(terms, starts, axis=1)
+        return sums / counts.reshape((1, -1) + (1,) * (terms.ndim - 2))
+
+    def _stars(self, kpts):
+        return self._reduce(np.cos(self._phases(kpts)))
+
+    def __call__(self, kpts, block=1000):
+        """Interpolated values at a set of k-points."""
+        kpts = np.asarray(kpts, dtype=float).reshape(-1, 3)
+        values = np.empty((len(kpts), self.coefs.shape[1]))
+        for i in range(0, len(kpts), block):
+            values[i:i+block] = np.dot(self._stars(kpts[i:i+block]),
+                                       self.coefs)
+        return values.reshape((len(kpts),) + self.value_shape)
+
+    def gradient(self, kpts, block=1000):
+        """
+        Cartesian gradient of the interpolated values at a set of k-points,
+        of shape (nk, 3, ...), in units of value times Bohr.
+        """
+        kpts = np.asarray(kpts, dtype=float).reshape(-1, 3)
+        rvec = np.dot(self.members, self.lattice)
+        grad = np.empty((len(kpts), 3, self.coefs.shape[1]))
+        for i in range(0, len(kpts), block):
+            sines = -np.sin(self._phases(kpts[i:i+block]))
+            dS = self._reduce(sines[:, :, None] * rvec[None, :, :])
+            grad[i:i+block] = np.einsum('kmx,mv->kxv', dS, self.coefs)
+        return grad.reshape((len(kpts), 3) + self.value_shape)
+
+
+def unfold_kpoints(kpts, symops, lattice, vectors=None):
+    """
+    Unfold k-points of the irreducible zone into the full zone.
+
+    Arguments
+    ---------
+
+    kpts : array(nk, 3)
+        K-points in reduced coordinates.
+    symops : array(nsym, 3, 3)
+        Symmetry operations acting on reduced k-points (sym.d).
+    lattice : array(3, 3)
+        Primitive vectors, as rows.
+    vectors : array(nk, ..., 3), optional
+        Cartesian vectors attached to each k-point, e.g. momentum
+        matrix elements, which are rotated along with the k-point.
+
+    Returns
+    -------
+
+    kpts : array(nkfull, 3)
+    index : array(nkfull), index of the irreducible k-point.
+    vectors : array(nkfull, ..., 3), if vectors is given.
+    """
+    kpts = np.asarray(kpts, dtype=float)
+    # Cartesian k = B^T k_red, with B the reciprocal vectors as rows.
+    B = np.linalg.inv(lattice).T
+    seen = set()
+    full, index, rotated = list(), list(), list()
+    for M in np.asarray(symops, dtype=int):
+        keys = kpoint_keys(np.dot(kpts, M.T))
+        g = np.dot(B.T, np.dot(M, np.linalg.inv(B.T)))
+        for ik, key in enumerate(keys):
+            if key in seen:
+                continue
+            seen.add(key)
+            full.append(np.dot(M, kpts[ik]))
+            index.append(ik)
+            if vectors is not None:
+                rotated.append(np.dot(vectors[ik], g.T))
+
+    result = (np.array(full), np.array(index, dtype=int))
+    if vectors is not None:
+        result += (np.array(rotated),)
+    return result
+
+
+def interpolate_kdata(klist_fname, eigen_fname, dense_klist_fname,
+                      symd_fname, pvectors_fname, dense_eigen_fname,
+                      pmn_fname=None, dense_pmn_fname=None,
+                      dense_pnn_fname=None, ratio=5, ratio_pmn=2):
+    """
+    Interpolate eigenvalues (and optionally |p_mn|^2) computed on a coarse
+    k-point list onto a dense one, and write them as Tiniba files.
+
+    Eigenvalues are fitted with star functions of the crystal symmetry.
+    The squared Cartesian components |p^a_mn|^2 are unfolded into the
+    full zone and fitted component by component; the dense pmn file holds
+    their square root with no phase, which is sufficient for the diagonal
+    components of the linear response but not for non-linear responses.
+    The dense pnn file holds the band velocities obtained from the
+    gradient of the interpolated bands, assuming eigenvalues in eV.
+
+    Arguments
+    ---------
+
+    klist_fname, eigen_fname : str
+        Coarse k-points and eigenvalues.
+    dense_klist_fname : str
+        Dense k-points.
+    symd_fname, pvectors_fname : str
+        Symmetry operations and primitive vectors (from KKflow).
+    dense_eigen_fname : str
+        Output eigenvalues.
+    pmn_fname, dense_pmn_fname : str, optional
+        Coarse and output momentum matrix elements.
+    dense_pnn_fname : str, optional
+        Output band velocities.
+    ratio, ratio_pmn : float
+        Number of star functions per independent k-point,
+        for the eigenvalues and for the matrix elements.
+    """
+    kpts = read_klist(klist_fname)
+    eigen = read_rows(eigen_fname, len(kpts), index=True)
+    dense_kpts = read_klist(dense_klist_fname)
+    symops = read_symd(symd_fname)
+    lattice = read_pvectors(pvectors_fname)
+
+    bands = StarInterpolator(kpts, eigen, symops, lattice, ratio)
+    write_rows(dense_eigen_fname, bands(dense_kpts), index=True)
+
+    if dense_pnn_fname:
+        velocities = bands.gradient(dense_kpts) * eV_to_Ha
+        write_rows(dense_pnn_fname,
+                   np.transpose(velocities, (0, 2, 1)).reshape(
+                   len(dense_kpts), -1))
+
+    if pmn_fname and dense_pmn_fname:
+        nband = eigen.shape[1]
+        pmn = pmn_to_complex(read_rows(pmn_fname, len(kpts)), nband)
+        full_kpts, index, pmn = unfold_kpoints(kpts, symops, lattice, pmn)
+        identity = np.eye(3, dtype=int)[None]
+        squares = StarInterpolator(full_kpts, np.abs(pmn) ** 2, identity,
+                                   lattice, ratio_pmn)
+        dense = np.sqrt(np.clip(squares(dense_kpts), 0., None))
+        rows = np.zeros(dense.shape + (2,))
+        rows[..., 0] = dense
+        write_rows(dense_pmn_fname, rows.reshape(len(dense_kpts), -1))
+
+
+class INTERPflow(Workflow, Task, KDataFiles):
+    def __init__(self, **kwargs):
+        """
+        Interpolate the eigenvalues and matrix elements computed
+        on kgrid_response onto the denser kgrid_interpolation.
+
+        Keyword arguments
+        -----------------
+        dirname : str, directory from which the script is executed.
+        kgrid_response : int, array(3), k-point grid of the calculation
+        kgrid_interpolation : int, array(3), dense k-point grid
+        kreciprocal_fname : list of k-points of kgrid_response
+        dense_kreciprocal_fname : list of k-points of kgrid_interpolation
+        symd_fname, pvectors_fname : symmetries and lattice (from KKflow)
+        eigen_fname, pmn_fname : eigenvalues and matrix elements
+        ecut : Kinetic energy cutoff
+        nspinor=1 : Number of spinorial components
+        ratio : number of star functions per k-point (default 5)
+        OPTPY : command to call the OPTpy tools
+        """
+        super(INTERPflow, self).__init__(**kwargs)
+        self.kgrid_interpolation = kwargs['kgrid_interpolation']
+        self.kgrid="{}x{}x{}".format(self.kgrid_interpolation[0],self.kgrid_interpolation[1],self.kgrid_interpolation[2])
+        self.ecut = kwargs['ecut']
+        self.nspinor = kwargs.get('nspinor', 1)
+        self.ratio = kwargs.pop('ratio', 5)
+        self.optpy = kwargs.pop('OPTPY', 'python -m OPTpy')
+
+        self.runscript.variables={
+            'OPTPY' : self.optpy}
+        self.runscript.append("# Interpolate onto the {0} grid".format(
+                              self.kgrid))
+        self.runscript.append(
+            "$OPTPY interpolate {0} {1} {2} {3} {4} {5} --pmn {6} {7} --pnn {8} --ratio {9}"
+            .format(kwargs['kreciprocal_fname'], kwargs['eigen_fname'],
+                    kwargs['dense_kreciprocal_fname'], kwargs['symd_fname'],
+                    kwargs['pvectors_fname'], self.eigen_fname,
+                    kwargs['pmn_fname'], self.pmn_fname, self.pnn_fname,
+                    self.ratio))
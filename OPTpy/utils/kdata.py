@@ -0,0 +1,260 @@
+"""Readers and writers for the k-point resolved files used by Tiniba."""
+from __future__ import print_function, division
+import os
+
+import numpy as np
+
+from .units import angstrom_to_bohr
+
+__all__ = ['read_klist', 'read_rows', 'iter_rows', 'write_rows',
+           'kpoint_keys',
+           'match_kpoints', 'is_nested_kgrid', 'kdata_suffix', 'KDataFiles',
+           'tiniba_fnames',
+           'read_symd', 'read_pvectors', 'band_pairs', 'pmn_to_complex',
+           'complex_to_pmn']
+
+
+def read_klist(fname):
+    """
+    Read a list of k-points in reduced coordinates, one per line.
+    An empty file is an empty list, array(0, 3).
+    """
+    if os.path.getsize(fname) == 0:
+        return np.zeros((0, 3))
+    return np.loadtxt(fname, ndmin=2)[:, :3]
+
+
+def read_rows(fname, nrows, index=False):
+    """
+    Read a file holding one record per k-point.
+
+    The file is read as a flat sequence of numbers, so that records
+    wrapped over several lines by Fortran list-directed output are
+    handled as well.
+
+    Arguments
+    ---------
+
+    fname : str
+        File name, e.g. eigen_*, pmn_* or pnn_*.
+    nrows : int
+        Number of k-points in the file.
+    index : bool (False)
+        The first column holds the k-point index and is dropped.
+    """
+    data = np.fromfile(fname, sep=' ')
+    if nrows < 1 or data.size % nrows:
+        raise Exception(
+            'Cannot split {} values of {} into {} k-points.'.format(
+            data.size, fname, nrows))
+    rows = data.reshape(nrows, -1)
+    if index:
+        rows = rows[:, 1:]
+    return rows
+
+
+def iter_rows(fname, nrows, block, index=False):
+    """
+    Read a file holding one record per k-point by blocks of at most
+    block records, so that only one block is held in memory.
+    The file is read twice: first to count its values, then to
+    split them into records as in read_rows.
+
+    Arguments
+    ---------
+
+    fname : str
+        File name.
+    nrows : int
+        Number of k-points in the file.
+    block : int
+        Number of records per block.
+    index : bool (False)
+        The first column holds the k-point index and is dropped.
+    """
+    with open(fname, 'r') as f:
+        nvalues = sum(len(line.split()) for line in f)
+    if nrows < 1 or nvalues % nrows:
+        raise Exception(
+            'Cannot split {} values of {} into {} k-points.'.format(
+            nvalues, fname, nrows))
+    ncol = nvalues // nrows
+    size = max(1, int(block)) * ncol
+
+    def rows(data):
+        data = data.reshape(-1, ncol)
+        return data[:, 1:] if index else data
+
+    with open(fname, 'r') as f:
+        pending, npending = list(), 0
+        for line in f:
+            values = np.array(line.split(), dtype=float)
+            pending.append(values)
+            npending += len(values)
+            if npending >= size:
+                data = np.concatenate(pending)
+                nout = (len(data) // size) * size
+                for i in range(0, nout, size):
+                    yield rows(data[i:i+size])
+                pending, npending = [data[nout:]], len(data) - nout
+        if npending:
+            yield rows(np.concatenate(pending))
+
+
+def write_rows(fname, rows, index=False):
+    """
+    Write one record per k-point and per line.
+
+    Arguments
+    ---------
+
+    fname : str
+        File name.
+    rows : array(nk, ncol)
+        Records.
+    index : bool (False)
+        Prepend the k-point index (starting at 1), as in eigen files.
+    """
+    rows = np.asarray(rows, dtype=float)
+    with open(fname, 'w') as f:
+        for ik, row in enumerate(rows):
+            line = ' '.join('{:.12E}'.format(x) for x in row)
+            if index:
+                line = '{} {}'.format(ik + 1, line)
+            f.write(line + '\n')
+
+
+def kpoint_keys(kpts, decimals=6):
+    """
+    Return hashable keys for k-points in reduced coordinates.
+    K-points differing by a reciprocal lattice vector share the same key.
+    """
+    kpts = np.round(np.asarray(kpts, dtype=float), decimals)
+    kpts = np.round(kpts - np.floor(kpts), decimals) % 1.
+    # Get rid of negative zeros.
+    kpts = kpts + 0.
+    return [tuple(k) for k in kpts.tolist()]
+
+
+def match_kpoints(kpts, reference, decimals=6):
+    """
+    Return, for each k-point, its index in the reference list,
+    or -1 if it is not found.
+    """
+    lookup = dict()
+    for i, key in enumerate(kpoint_keys(reference, decimals)):
+        lookup.setdefault(key, i)
+    return np.array([lookup.get(key, -1)
+                     for key in kpoint_keys(kpts, decimals)], dtype=int)
+
+
+def is_nested_kgrid(kgrid, coarse_kgrid):
+    """True if the unshifted coarse grid is a subset of kgrid."""
+    return all(int(n) % int(m) == 0 and int(n) >= int(m)
+               for n, m in zip(kgrid, coarse_kgrid))
+
+
+def kdata_suffix(kgrid, ecut, nspinor=1, tag=''):
+    """
+    Suffix of the files of eigenvalues and matrix elements,
+    e.g. '_8x8x8_15-spin' for kgrid='8x8x8' (or [8, 8, 8]), ecut=15
+    and nspinor=2.
+    """
+    if not isinstance(kgrid, str):
+        kgrid = '{}x{}x{}'.format(*kgrid)
+    return '_{0}_{1}{2}{3}'.format(kgrid, int(ecut),
+                                   '-spin' if nspinor > 1 else '', tag)
+
+
+class KDataFiles(object):
+    """
+    Names of the eigen, pmn and pnn files written by a flow
+    in the current directory, from its kgrid, ecut, nspinor and tag.
+    """
+
+    tag = ''
+
+    @property
+    def suffix(self):
+        return kdata_suffix(self.kgrid, self.ecut, self.nspinor, self.tag)
+
+    @property
+    def eigen_fname(self):
+        return os.path.join(os.path.realpath(os.curdir),
+                            'eigen{0}'.format(self.suffix))
+
+    @property
+    def pmn_fname(self):
+        return os.path.join(os.path.realpath(os.curdir),
+                            'pmn{0}'.format(self.suffix))
+
+    @property
+    def pnn_fname(self):
+        return os.path.join(os.path.realpath(os.curdir),
+                            'pnn{0}'.format(self.suffix))
+
+
+def tiniba_fnames(dirname, prefix, kgrid, ecut, nspinor=1):
+    """
+    Return the file names (klist, eigen, pmn, pnn) written by OPTflow
+    in dirname for a given k-point grid.
+    """
+    suffix = kdata_suffix(kgrid, ecut, nspinor)
+    kgrid = '{}x{}x{}'.format(*kgrid)
+    return dict(
+        klist = os.path.join(dirname, '{0}.klist_{1}'.format(prefix, kgrid)),
+        eigen = os.path.join(dirname, 'eigen' + suffix),
+        pmn = os.path.join(dirname, 'pmn' + suffix),
+        pnn = os.path.join(dirname, 'pnn' + suffix),
+        )
+
+
+def read_symd(fname):
+    """
+    Read the symmetry operations written by KKflow in sym.d.
+    Each operation acts on k-points in reduced coordinates: k' = M k.
+    """
+    data = np.fromfile(fname, sep=' ')
+    nsym = int(data[0])
+    return np.array(data[1:1+9*nsym], dtype=int).reshape(nsym, 3, 3)
+
+
+def read_pvectors(fname):
+    """
+    Read the primitive vectors written by KKflow in pvectors,
+    and return them as rows, in Bohr.
+    """
+    data = np.fromfile(fname, sep=' ')
+    return data[:9].reshape(3, 3) * angstrom_to_bohr
+
+
+def band_pairs(nband, diagonal=True):
+    """
+    Return the band indices (n, m), counted from 0, of the pairs n <= m
+    in the order of the pmn files (n is the slowest index).
+    """
+    n, m = np.triu_indices(nband, 0 if diagonal else 1)
+    return n, m
+
+
+def pmn_to_complex(rows, nband):
+    """
+    Convert pmn records into an array of shape (nk, npair, 3) of complex
+    numbers. Each pair of bands holds the real and imaginary parts of the
+    x, y and z components. Whether the diagonal pairs are included is
+    deduced from the length of the records.
+    """
+    rows = np.asarray(rows, dtype=float)
+    npair = rows.shape[1] // 6
+    if npair not in (nband * (nband + 1) // 2, nband * (nband - 1) // 2):
+        raise Exception(
+            'Records of {} values do not match {} bands.'.format(
+            rows.shape[1], nband))
+    values = rows.reshape(len(rows), npair, 3, 2)
+    return values[..., 0] + 1j * values[..., 1]
+
+
+def complex_to_pmn(pmn):
+    """Inverse of pmn_to_complex."""
+    pmn = np.asarray(pmn)
+    return np.stack([pmn.real, pmn.imag], axis=-1).reshape(len(pmn), -1)
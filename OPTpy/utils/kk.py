@@ -18,6 +18,9 @@ class KKflow(Workflow,IOTask):
         prefix : str, prefix for calculation
         dirname : str, directory name
         kgrid_response : int, array(3), k-point grid for response 
+            With a single k-point along the third direction (layers),
+            the triangles of the two-dimensional grid are also written.
+        OPTPY : command to call the OPTpy tools
         """
         super(KKflow, self).__init__(**kwargs)
         self.structure = kwargs['structure']
@@ -26,12 +29,15 @@ class KKflow(Workflow,IOTask):
         self.kgrid_response = kwargs['kgrid_response']
         self.kgrid="{}x{}x{}".format(self.kgrid_response[0],self.kgrid_response[1],self.kgrid_response[2])
         self.ibz=kwargs.pop('IBZ','ibz')
+        self.optpy=kwargs.pop('OPTPY','python -m OPTpy')
 
         # --- Write run.sh file ---
 
         # Define variables:
         self.runscript.variables={
             'IBZ' : self.ibz}
+        if ( self.is_2d ):
+            self.runscript.variables['OPTPY'] = self.optpy
         #
         # Copy files:
         #
@@ -52,6 +58,11 @@ class KKflow(Workflow,IOTask):
    	self.runscript.append("mv kpoints.cartesian {0}".format(self.kcartesian_fname))
    	self.runscript.append("mv tetrahedra {0}".format(self.tetrahedra_fname))
    	self.runscript.append("mv Symmetries.Cartesian {0}".format(self.symmetries_fname))
+        if ( self.is_2d ):
+            self.runscript.append("#Triangles of the 2D grid:")
+            self.runscript.append("$OPTPY triangles {0} {1} {2} {3} {4} {5}".format(
+                self.kreciprocal_fname,self.symd_fname,self.triangles_fname,
+                self.kgrid_response[0],self.kgrid_response[1],self.kgrid_response[2]))
 #   	self.runscript.append("cd ..")
 #   	self.runscript.append("rm -rf TMP/")
 
@@ -73,6 +84,16 @@ class KKflow(Workflow,IOTask):
         tetrahedra_fname='symmetries/tetrahedra_{0}'.format(self.kgrid)
         return path.join(original, tetrahedra_fname) 
 
+    @property
+    def is_2d(self):
+        return int(self.kgrid_response[2]) == 1
+
+    @property
+    def triangles_fname(self):
+        original = path.realpath(curdir)
+        triangles_fname='symmetries/triangles_{0}'.format(self.kgrid)
+        return path.join(original, triangles_fname) 
+
     @property
     def symmetries_fname(self):
         original = path.realpath(curdir)
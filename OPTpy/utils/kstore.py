@@ -0,0 +1,337 @@
+from __future__ import print_function, division
+from os import path, curdir
+import struct
+import fcntl
+import contextlib
+
+import numpy as np
+
+from ..core import Workflow, Task
+from .kdata import (read_klist, read_rows, write_rows, kpoint_keys,
+                    tiniba_fnames, KDataFiles)
+
+__all__ = ['KStore', 'KSTOREflow', 'chunk_range', 'empty_chunk_test']
+
+
+def chunk_range(nkpt, ntask, task):
+    """
+    Return the slice of k-points computed by a task (counted from 1)
+    when nkpt k-points are split in ntask tasks.
+    This follows the arithmetic of the scripts written by AbinitWfnTask.
+    """
+    nk_task = nkpt // ntask
+    if task == ntask:
+        me_nk = nkpt - nk_task * (ntask - 1)
+    else:
+        me_nk = nk_task
+    start = nk_task * (task - 1)
+    return slice(start, start + me_nk)
+
+
+def empty_chunk_test(klist_fname, ntask=1, task=1):
+    """
+    Shell test, true when the chunk of a task (see chunk_range) has no
+    k-point: the list is empty (e.g. when all the k-points are found in
+    the store), or it has fewer k-points than tasks and the task is not
+    the last one.
+    """
+    nkpt = '$(cat {0} | wc -l)'.format(klist_fname)
+    if task == ntask:
+        return '[ {0} -eq 0 ]'.format(nkpt)
+    return '[ $(({0}/{1})) -eq 0 ]'.format(nkpt, ntask)
+
+
+class KStore(object):
+    """
+    K-point indexed store of eigenvalues and momentum matrix elements.
+
+    The records are kept in a binary file made of a header followed by
+    one record of float64 per k-point:
+        k-point (3), eigen (neigen), pmn (npmn), pnn (npnn)
+    The k-points of the records are cached in a text file
+    (fname + '.idx') with one line per record, so that the keys of
+    the store are known without reading the whole binary file.
+
+    Records are appended by chunks, possibly from several processes.
+    A record is valid once it is complete in the binary file: an
+    interrupted append leaves at most an incomplete record, dropped by
+    the next append, and an index behind the records, completed from
+    the k-points of the records.
+    """
+
+    _MAGIC = b'OPTPYKST'
+    _VERSION = 1
+    _HEADER = struct.Struct('<8s4q')
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._keys = None
+        self._shape = None
+
+    @property
+    def index_fname(self):
+        return self.fname + '.idx'
+
+    @property
+    def exists(self):
+        return path.exists(self.fname)
+
+    @property
+    def shape(self):
+        """Number of values (neigen, npmn, npnn) in each record."""
+        if self._shape is None and self.exists:
+            with open(self.fname, 'rb') as f:
+                magic, version, neigen, npmn, npnn = self._HEADER.unpack(
+                    f.read(self._HEADER.size))
+            if magic != self._MAGIC:
+                raise Exception('{} is not a k-point store.'.format(
+                                self.fname))
+            self._shape = (neigen, npmn, npnn)
+        return self._shape
+
+    @property
+    def record_size(self):
+        return 3 + sum(self.shape)
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Lock the store against concurrent appends."""
+        with open(self.fname + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _count_records(self):
+        """Number of complete records in the binary file."""
+        size = path.getsize(self.fname) - self._HEADER.size
+        return max(size, 0) // (8 * self.record_size)
+
+    def _read_index(self):
+        """
+        Return the k-points of the complete lines of the index,
+        and the size of the index up to the end of each line.
+        """
+        kpts = list()
+        ends = list()
+        if not path.exists(self.index_fname):
+            return kpts, ends
+        with open(self.index_fname, 'r') as f:
+            size = 0
+            for line in f:
+                values = line.split()
+                # Stop at a line left incomplete by an interrupted append.
+                if not line.endswith('\n') or len(values) != 3:
+                    break
+                kpts.append([float(v) for v in values])
+                size += len(line)
+                ends.append(size)
+        return kpts, ends
+
+    def _read_kpoints(self):
+        """K-points of the records, from the index and the records."""
+        nrec = self._count_records()
+        kpts = self._read_index()[0][:nrec]
+        if len(kpts) < nrec:
+            kpts.extend(self._records(nrec)[len(kpts):, :3].tolist())
+        return kpts
+
+    def keys(self):
+        """Keys of the stored k-points, in the order of the records."""
+        if self._keys is None:
+            self._keys = kpoint_keys(self._read_kpoints()) \
+                         if self.exists else list()
+        return self._keys
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, kpt):
+        return kpoint_keys([kpt])[0] in set(self.keys())
+
+    def missing(self, kpts):
+        """Boolean mask of the k-points not found in the store."""
+        stored = set(self.keys())
+        return np.array([key not in stored for key in kpoint_keys(kpts)],
+                        dtype=bool)
+
+    def append(self, kpts, eigen, pmn, pnn):
+        """
+        Append the records of a set of k-points.
+        K-points already in the store are skipped.
+        Return the number of records added.
+        """
+        kpts = np.asarray(kpts, dtype=float).reshape(-1, 3)
+        nk = len(kpts)
+        eigen, pmn, pnn = [np.asarray(a, dtype=float).reshape(nk, -1)
+                           for a in (eigen, pmn, pnn)]
+        shape = (eigen.shape[1], pmn.shape[1], pnn.shape[1])
+
+        with self.lock():
+            # Other processes may have appended since the last read.
+            self._keys = None
+            self._shape = None
+
+            if not self.exists:
+                with open(self.fname, 'wb') as f:
+                    f.write(self._HEADER.pack(self._MAGIC, self._VERSION,
+                                              *shape))
+                open(self.index_fname, 'w').close()
+            elif self.shape != shape:
+                raise Exception(
+                    'Records of shape {} cannot be added to {} of shape {}.'
+                    .format(shape, self.fname, self.shape))
+
+            stored = set(self.keys())
+            keys = kpoint_keys(kpts)
+            new = list()
+            for ik, key in enumerate(keys):
+                if key not in stored:
+                    stored.add(key)
+                    new.append(ik)
+            if not new:
+                return 0
+
+            records = np.hstack([kpts, eigen, pmn, pnn])[new]
+
+            # Drop any record written by an interrupted append.
+            nrec = len(self)
+            offset = self._HEADER.size + 8 * self.record_size * nrec
+            with open(self.fname, 'r+b') as f:
+                f.truncate(offset)
+                f.seek(offset)
+                f.write(records.astype('<f8').tobytes())
+                f.flush()
+
+            # Drop any incomplete line of the index, and index the
+            # records written after it before the new ones.
+            indexed, ends = self._read_index()
+            nindexed = min(len(indexed), nrec)
+            with open(self.index_fname, 'a') as f:
+                f.truncate(ends[nindexed-1] if nindexed else 0)
+                if nindexed < nrec:
+                    for kpt in self._records(nrec)[nindexed:, :3]:
+                        f.write('{:.10f} {:.10f} {:.10f}\n'.format(*kpt))
+                for ik in new:
+                    f.write('{:.10f} {:.10f} {:.10f}\n'.format(*kpts[ik]))
+
+            self._keys = None
+
+        return len(new)
+
+    def _records(self, nrec=None):
+        if nrec is None:
+            nrec = len(self)
+        return np.memmap(self.fname, dtype='<f8', mode='r',
+                         offset=self._HEADER.size,
+                         shape=(nrec, self.record_size))
+
+    def read(self, kpts):
+        """
+        Return the eigenvalues, pmn and pnn records for a set of k-points,
+        in the order given.
+        """
+        lookup = dict((key, i) for i, key in enumerate(self.keys()))
+        try:
+            irec = [lookup[key] for key in kpoint_keys(kpts)]
+        except KeyError as e:
+            raise KeyError('K-point {} not found in {}'.format(
+                           e.args[0], self.fname))
+
+        records = np.array(self._records()[irec])
+        neigen, npmn, npnn = self.shape
+        return (records[:, 3:3+neigen],
+                records[:, 3+neigen:3+neigen+npmn],
+                records[:, 3+neigen+npmn:])
+
+    def import_files(self, klist_fname, eigen_fname, pmn_fname, pnn_fname,
+                     kslice=slice(None)):
+        """
+        Append the records of Tiniba text files (eigen files have
+        a leading index column), optionally restricted to a slice
+        of the k-point list.
+        """
+        kpts = read_klist(klist_fname)[kslice]
+        nk = len(kpts)
+        if nk == 0:
+            return 0
+        return self.append(kpts,
+                           read_rows(eigen_fname, nk, index=True),
+                           read_rows(pmn_fname, nk),
+                           read_rows(pnn_fname, nk))
+
+    def export_files(self, klist_fname, eigen_fname, pmn_fname, pnn_fname):
+        """Write Tiniba text files following the order of a k-point list."""
+        eigen, pmn, pnn = self.read(read_klist(klist_fname))
+        write_rows(eigen_fname, eigen, index=True)
+        write_rows(pmn_fname, pmn)
+        write_rows(pnn_fname, pnn)
+
+
+class KSTOREflow(Workflow, Task, KDataFiles):
+    def __init__(self, step='split', **kwargs):
+        """
+        Compute only the k-points missing from a k-point store.
+        The 'split' step writes the list of k-points that are not
+        in the store yet, the 'export' step writes the eigen, pmn and pnn
+        files of the full k-point list from the store.
+
+        Arguments
+        ---------
+        step : 'split' | 'export'
+
+        Keyword arguments
+        -----------------
+        dirname : str, directory from which the script is executed.
+        runscript_fname : str, name of the script (default: kstore.sh)
+        kstore_fname : str, k-point store
+        kreciprocal_fname : full list of k-points (from KKflow)
+        kgrid_response : int, array(3), k-point grid for response
+        ecut : Kinetic energy cutoff
+        nspinor=1 : Number of spinorial components
+        prefix : str, prefix for calculation
+        reuse_kgrid : int, array(3), optional, k-point grid of a previous
+            calculation whose files are imported in the store (split step).
+        reuse_dirname : str, directory holding the previous files
+        OPTPY : command to call the OPTpy tools
+        """
+        kwargs.setdefault('runscript_fname', 'kstore.sh')
+        super(KSTOREflow, self).__init__(**kwargs)
+        self.step = step
+        self.kstore_fname = path.realpath(kwargs['kstore_fname'])
+        self.kreciprocal_fname = kwargs['kreciprocal_fname']
+        self.kgrid_response = kwargs['kgrid_response']
+        self.kgrid="{}x{}x{}".format(self.kgrid_response[0],self.kgrid_response[1],self.kgrid_response[2])
+        self.ecut = kwargs['ecut']
+        self.nspinor = kwargs.get('nspinor', 1)
+        self.optpy = kwargs.pop('OPTPY', 'python -m OPTpy')
+
+        self.runscript.variables={
+            'OPTPY' : self.optpy}
+
+        if ( step == 'split' ):
+            if kwargs.get('reuse_kgrid'):
+                previous = tiniba_fnames(
+                    kwargs.get('reuse_dirname', curdir), kwargs['prefix'],
+                    kwargs['reuse_kgrid'], self.ecut, self.nspinor)
+                self.runscript.append("# Import a previous calculation")
+                self.runscript.append(
+                    "$OPTPY kstore-import {0} {1} {2} {3} {4}".format(
+                    self.kstore_fname, previous['klist'], previous['eigen'],
+                    previous['pmn'], previous['pnn']))
+            self.runscript.append("# Find the k-points missing in the store")
+            self.runscript.append(
+                "$OPTPY kstore-missing {0} {1} {2}".format(
+                self.kstore_fname, self.kreciprocal_fname,
+                self.new_kreciprocal_fname))
+        else:
+            self.runscript.append("# Write the files of the full k-list")
+            self.runscript.append(
+                "$OPTPY kstore-export {0} {1} {2} {3} {4}".format(
+                self.kstore_fname, self.kreciprocal_fname,
+                self.eigen_fname, self.pmn_fname, self.pnn_fname))
+
+    @property
+    def new_kreciprocal_fname(self):
+        return self.kreciprocal_fname + '_new'
@@ -68,6 +68,37 @@ class RESPONSEflow(Workflow,MPITask):
         SET_INPUT_ALL : executable
         TETRA_METHOD_ALL : executable 
         RKRAMER : executable 
+        integrator : 'tetrahedra' | 'histogram' | 'gaussian' | 'lorentzian'
+                     | 'adaptive' | 'linear_tetrahedra' | 'blochl'
+            Brillouin zone integration, either with tetra_method_all
+            (default) or computed by OPTpy (see utils.integrate):
+            with a smearing of width smearvalue, which needs no tetrahedra;
+            'adaptive' sets the smearing of each transition from the band
+            velocities in pnn, smearvalue is then its lower bound;
+            'linear_tetrahedra' and 'blochl' use the tetrahedra of KKflow,
+            the latter with the Blochl correction.
+        symd_fname : symmetry operations (sym.d), required by the
+            integrators other than 'tetrahedra'.
+        pvectors_fname : primitive vectors, required by 'adaptive'.
+        triangles_fname : triangles of a two-dimensional grid
+            (kgrid_response[2] == 1), used instead of the tetrahedra by
+            'linear_tetrahedra' and 'blochl'.
+        integration_memory : memory budget (MB) of the integrators other
+            than 'tetrahedra', which then read the integrand by blocks.
+        integration_nproc : number of processes of the integrators other
+            than 'tetrahedra' (default 1).
+        band_groups : None | 'pairs' | (valence, conduction)
+            Also write the spectra of groups of transitions, computed
+            by the integrators other than 'tetrahedra' in the same pass
+            as the total spectrum, in <response>.<component>.groups_ab_*:
+            'pairs' for each pair of bands, or lists of (first, last)
+            ranges of valence and conduction bands (see
+            utils.transition_groups); either list may be None.
+        contribution_windows : list of (emin, emax), optional
+            Energy windows for which the integrators other than
+            'tetrahedra' write the contribution of each k-point,
+            in <response>.<component>.kmap_*.
+        OPTPY : command to call the OPTpy tools
         response : Response to calculate:
         ---------  choose a response ---------
         1  chi1----linear response           24 calChi1-layer linear response     
@@ -107,6 +138,24 @@ class RESPONSEflow(Workflow,MPITask):
         self.tetra_method_all = kwargs.pop('TETRA_METHOD_ALL','tetra_method_all')
         self.rkramer = kwargs.pop('RKRAMER','rkramer')
         self.modules = kwargs.pop('modules','')
+        self.integrator = kwargs.pop('integrator','tetrahedra')
+        self.symd_fname = kwargs.pop('symd_fname',None)
+        self.pvectors_fname = kwargs.pop('pvectors_fname',None)
+        self.triangles_fname = kwargs.pop('triangles_fname',None)
+        self.integration_memory = kwargs.pop('integration_memory',None)
+        self.integration_nproc = kwargs.pop('integration_nproc',1)
+        self.band_groups = kwargs.pop('band_groups',None)
+        self.contribution_windows = kwargs.pop('contribution_windows',None)
+        self.optpy = kwargs.pop('OPTPY','python -m OPTpy')
+        if ( self.integrator != 'tetrahedra' and self.symd_fname is None ):
+            raise Exception(
+                "symd_fname is required by the '{0}' integrator".format(
+                self.integrator))
+        if ( self.integrator == 'tetrahedra' and
+             (self.band_groups or self.contribution_windows) ):
+            raise Exception(
+                "band_groups and contribution_windows are not available "
+                "with the 'tetrahedra' integrator")
 
         # Get case name:
         self.case=str(self.kgrid)+"_"+str(int(self.ecut))
@@ -133,9 +182,18 @@ class RESPONSEflow(Workflow,MPITask):
             'TETRA_METHOD_ALL' : self.tetra_method_all,
             'RKRAMER' : self.rkramer
         } 
+        if ( self.integrator != 'tetrahedra' ):
+            self.runscript.variables['OPTPY'] = self.optpy
+            self.update_link(self.symd_fname,'sym.d')
+        if ( self.integrator == 'adaptive' ):
+            self.update_link(self.pvectors_fname,'pvectors')
         # Symbolic links: 
-        dest='tetrahedra_{0}'.format(self.kgrid)
-        self.update_link(self.tetrahedra_fname,dest)
+        if ( self.use_triangles ):
+            dest='triangles_{0}'.format(self.kgrid)
+            self.update_link(self.triangles_fname,dest)
+        elif self.integrator in ('tetrahedra','linear_tetrahedra','blochl'):
+            dest='tetrahedra_{0}'.format(self.kgrid)
+            self.update_link(self.tetrahedra_fname,dest)
         #
         dest='{0}.klist_{1}'.format(self.prefix,self.kgrid)
         self.update_link(self.kreciprocal_fname,dest)
@@ -183,8 +241,12 @@ class RESPONSEflow(Workflow,MPITask):
             % (self.case,resp_name,component,self.case,self.case,self.case))
             self.runscript.append("sed s/Spectrum_%s/%s.%s.spectrum_ab_%s/ tmp1_%s > int_%s_%s"
             % (self.case,resp_name,component,self.case,self.case,component,self.case))
-            self.runscript.append("# Call to tetra_method")
-            self.runscript.append("$TETRA_METHOD_ALL int_{0}_{1}".format(component,self.case))
+            if ( self.integrator == 'tetrahedra' ):
+                self.runscript.append("# Call to tetra_method")
+                self.runscript.append("$TETRA_METHOD_ALL int_{0}_{1}".format(component,self.case))
+            else:
+                self.runscript.append("# Integrate with OPTpy")
+                self.runscript.append(self.integrate_line(resp_name,component))
 
         if ( lKK ) :
             # do Kramers-Kronig transformation
@@ -225,6 +287,56 @@ class RESPONSEflow(Workflow,MPITask):
              
 #        self.runscript.append("rm -f tmp*\n")
 
+    def integrate_line(self,resp_name,component):
+        """ Command integrating a component with the OPTpy integrators """
+        # The 2w terms of SHG resonate at half the transition energies:
+        if ( self.response == 22 ):
+            energies_fname="halfenergys.d_"+self.case
+        else:
+            energies_fname="energys.d_"+self.case
+        line = ("$OPTPY integrate {0}.klist_{1} sym.d {2} {3}.{4}.dat_{5} "
+                "{3}.{4}.spectrum_ab_{5} --energy-min {6} --energy-max {7} "
+                "--energy-steps {8} --sigma {9} --method {10}".format(
+                self.prefix,self.kgrid,energies_fname,resp_name,component,
+                self.case,self.energy_min,self.energy_max,self.energy_steps,
+                self.smearvalue,self.integrator))
+        if ( self.integrator == 'adaptive' ):
+            line += " --pnn pnn_{0} --pvectors pvectors --nval {1}".format(
+                self.case,self.nval_total)
+        elif ( self.use_triangles ):
+            line += " --triangles triangles_{0}".format(self.kgrid)
+        elif self.integrator in ('linear_tetrahedra','blochl'):
+            line += " --tetrahedra tetrahedra_{0}".format(self.kgrid)
+        if ( self.integration_memory ):
+            line += " --memory {0}".format(self.integration_memory)
+        if ( self.integration_nproc > 1 ):
+            line += " --nproc {0}".format(self.integration_nproc)
+        if ( self.band_groups ):
+            if ( self.integrator != 'adaptive' ):
+                line += " --nval {0}".format(self.nval_total)
+            line += " --groups {0}.{1}.groups_ab_{2}".format(
+                resp_name,component,self.case)
+            if ( self.band_groups != 'pairs' ):
+                valence, conduction = self.band_groups
+                for flag, ranges in (('--valence-groups', valence),
+                                     ('--conduction-groups', conduction)):
+                    if ranges:
+                        line += " {0} {1}".format(flag, " ".join(
+                            "{0}-{1}".format(*r) for r in ranges))
+        if ( self.contribution_windows ):
+            for window in self.contribution_windows:
+                line += " --window {0} {1}".format(*window)
+            line += " --contributions {0}.{1}.kmap_{2}".format(
+                resp_name,component,self.case)
+        return line
+
+    @property
+    def use_triangles(self):
+        """ Integrate a two-dimensional grid over triangles """
+        return ( self.integrator in ('linear_tetrahedra','blochl') and
+                 self.triangles_fname is not None and
+                 int(self.kgrid_response[2]) == 1 )
+
 #       Write other files:
     def write_latm_input(self):
         """ Write input files for RESP"""
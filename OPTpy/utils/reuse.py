@@ -0,0 +1,176 @@
+from __future__ import print_function
+from os import path, curdir, listdir
+import re
+
+import numpy as np
+
+from ..core import Workflow, Task
+from .kdata import (read_klist, read_rows, write_rows, match_kpoints,
+                    is_nested_kgrid, tiniba_fnames, KDataFiles)
+
+__all__ = ['REUSEflow', 'find_reusable_kgrid', 'split_kpoints',
+           'assemble_kdata']
+
+
+class REUSEflow(Workflow, Task, KDataFiles):
+    def __init__(self, step='split', **kwargs):
+        """
+        Reuse the k-points of a previous calculation done on a coarser,
+        nested k-point grid. The 'split' step writes the list of k-points
+        that remain to be computed, the 'assemble' step gathers the
+        previous and the new eigenvalues and matrix elements following
+        the order of the full k-point list.
+
+        Arguments
+        ---------
+        step : 'split' | 'assemble'
+
+        Keyword arguments
+        -----------------
+        dirname : str, directory from which the script is executed.
+        runscript_fname : str, name of the script (default: reuse.sh)
+        prefix : str, prefix for calculation
+        kgrid_response : int, array(3), k-point grid for response
+        reuse_kgrid : int, array(3), k-point grid of the previous calculation
+        reuse_dirname : str, directory holding the previous files
+        ecut : Kinetic energy cutoff
+        nspinor=1 : Number of spinorial components
+        kreciprocal_fname : full list of k-points (from KKflow)
+        eigen_fname, pmn_fname, pnn_fname : files for the new k-points
+            (assemble step only).
+        OPTPY : command to call the OPTpy tools
+        """
+        kwargs.setdefault('runscript_fname', 'reuse.sh')
+        super(REUSEflow, self).__init__(**kwargs)
+        self.step = step
+        self.prefix = kwargs['prefix']
+        self.kgrid_response = kwargs['kgrid_response']
+        self.kgrid="{}x{}x{}".format(self.kgrid_response[0],self.kgrid_response[1],self.kgrid_response[2])
+        self.ecut = kwargs['ecut']
+        self.nspinor = kwargs.get('nspinor', 1)
+        self.kreciprocal_fname = kwargs['kreciprocal_fname']
+        self.optpy = kwargs.pop('OPTPY', 'python -m OPTpy')
+
+        self.previous = tiniba_fnames(
+            kwargs.get('reuse_dirname', curdir), self.prefix,
+            kwargs['reuse_kgrid'], self.ecut, self.nspinor)
+
+        self.runscript.variables={
+            'OPTPY' : self.optpy}
+
+        if ( step == 'split' ):
+            self.runscript.append("# Find the k-points missing in {0}".format(
+                                  self.previous['klist']))
+            self.runscript.append(
+                "$OPTPY reuse-split {0} {1} {2}".format(
+                self.kreciprocal_fname, self.previous['klist'],
+                self.new_kreciprocal_fname))
+        else:
+            self.runscript.append("# Gather previous and new k-points")
+            self.runscript.append(
+                "$OPTPY reuse-assemble {0} {1} {2} {3} {4} {5}".format(
+                self.kreciprocal_fname, self.previous['klist'],
+                self.new_kreciprocal_fname, self.previous['eigen'],
+                kwargs['eigen_fname'], self.eigen_fname))
+            for name in ('pmn', 'pnn'):
+                self.runscript.append(
+                    "$OPTPY reuse-assemble {0} {1} {2} {3} {4} {5} --no-index"
+                    .format(self.kreciprocal_fname, self.previous['klist'],
+                            self.new_kreciprocal_fname, self.previous[name],
+                            kwargs[name + '_fname'],
+                            getattr(self, name + '_fname')))
+
+    @property
+    def new_kreciprocal_fname(self):
+        return self.kreciprocal_fname + '_new'
+
+
+def find_reusable_kgrid(dirname, prefix, kgrid, ecut, nspinor=1):
+    """
+    Look in dirname for the finest k-point grid nested in kgrid for which
+    the k-point list, eigenvalues and matrix elements are all available.
+    Return None if there is none.
+    """
+    pattern = re.compile(r'^{0}\.klist_(\d+)x(\d+)x(\d+)$'.format(
+                         re.escape(prefix)))
+    best = None
+    for fname in listdir(dirname):
+        match = pattern.match(fname)
+        if not match:
+            continue
+        coarse = [int(n) for n in match.groups()]
+        if list(coarse) == [int(n) for n in kgrid]:
+            continue
+        if not is_nested_kgrid(kgrid, coarse):
+            continue
+        fnames = tiniba_fnames(dirname, prefix, coarse, ecut, nspinor)
+        if not all(path.exists(f) for f in fnames.values()):
+            continue
+        if best is None or np.prod(coarse) > np.prod(best):
+            best = coarse
+    return best
+
+
+def split_kpoints(klist_fname, previous_klist_fname, output_fname):
+    """
+    Write the k-points of klist_fname that are not found in
+    previous_klist_fname. Return the number of new k-points.
+    """
+    kpts = read_klist(klist_fname)
+    index = match_kpoints(kpts, read_klist(previous_klist_fname))
+    new = kpts[index < 0]
+    np.savetxt(output_fname, new, fmt='%.10f')
+    print('{} k-points reused, {} to compute.'.format(
+          np.count_nonzero(index >= 0), len(new)))
+    return len(new)
+
+
+def assemble_kdata(klist_fname, previous_klist_fname, new_klist_fname,
+                   previous_fname, new_fname, output_fname, index=True):
+    """
+    Write the records of the full k-point list, taken either from the
+    previous calculation or from the calculation on the new k-points.
+
+    Arguments
+    ---------
+
+    klist_fname : str
+        Full list of k-points, which sets the order of the output.
+    previous_klist_fname, previous_fname : str
+        K-points and records of the previous calculation.
+    new_klist_fname, new_fname : str
+        K-points and records computed for the missing k-points.
+        new_fname is not read when there are none.
+    output_fname : str
+        Output file.
+    index : bool (True)
+        The first column holds the k-point index (eigen files).
+    """
+    kpts = read_klist(klist_fname)
+    previous_kpts = read_klist(previous_klist_fname)
+    new_kpts = read_klist(new_klist_fname)
+
+    previous = read_rows(previous_fname, len(previous_kpts), index)
+    if len(new_kpts) == 0:
+        new = np.zeros((0, previous.shape[1]))
+    else:
+        new = read_rows(new_fname, len(new_kpts), index)
+    if previous.shape[1] != new.shape[1]:
+        raise Exception(
+            'Records of {} and {} have different lengths ({} and {}).\n'
+            .format(previous_fname, new_fname,
+                    previous.shape[1], new.shape[1]) +
+            'Both calculations must use the same number of bands.')
+
+    inew = match_kpoints(kpts, new_kpts)
+    iprevious = match_kpoints(kpts, previous_kpts)
+    if np.any((inew < 0) & (iprevious < 0)):
+        raise Exception('Some k-points of {} were not computed.'.format(
+                        klist_fname))
+
+    if len(new) == 0:
+        rows = previous[iprevious]
+    else:
+        rows = np.where((inew >= 0)[:, None], new[inew],
+                        previous[iprevious])
+    write_rows(output_fname, rows, index)
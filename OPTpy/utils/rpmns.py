@@ -1,10 +1,12 @@
 from os import path, mkdir,curdir
 from ..core import Workflow,MPITask 
+from .kdata import KDataFiles
+from .kstore import empty_chunk_test
 
 __all__ = ['RPMNSflow']
 
-class RPMNSflow(Workflow,MPITask):
-    def __init__(self,ntask=1,task=1,rename=True,**kwargs):
+class RPMNSflow(Workflow,MPITask,KDataFiles):
+    def __init__(self,ntask=1,task=1,rename=True,tag='',**kwargs):
         """ 
         Arguments
         ---------
@@ -12,6 +14,8 @@ class RPMNSflow(Workflow,MPITask):
             task is the task index and ntask is the total of tasks.
         rename : logical, optional, flag to rename files at output.
             Default: True
+        tag : str, optional, appended to the output file names.
+            Default: ''
 
         keyword arguments:
         nval_total : Number of valence bands
@@ -19,7 +23,12 @@ class RPMNSflow(Workflow,MPITask):
         nspinor=1 : Number of spinorial components
         kgrid_response : k-points for Tetrahedral integration
         wfn_fname : Name of wavefunction file (Abinit WFK file)
+        kstore_fname : k-point store in which the results are appended
+            (optional)
+        kreciprocal_fname : list of k-points of the WFK file(s)
+            (mandatory with kstore_fname)
         RPMNS : executable
+        OPTPY : command to call the OPTpy tools
         """
         super(RPMNSflow, self).__init__(**kwargs)
 
@@ -32,6 +41,9 @@ class RPMNSflow(Workflow,MPITask):
         self.dirname = kwargs.pop('dirname','RPMNS')
         self.wfn_fname=kwargs['wfn_fname'][task-1]
         self.rpmns=kwargs.pop('RPMNS','rpmns')
+        self.tag=tag
+        self.kstore_fname=kwargs.get('kstore_fname')
+        self.optpy=kwargs.pop('OPTPY','python -m OPTpy')
 
         # --- Write run.sh file ---
         # Define variables
@@ -60,6 +72,20 @@ class RPMNSflow(Workflow,MPITask):
 
         # Add other lines:
         self.runscript.append("echo $NVAL >.fnval\n")
+        # Nothing to compute when the chunk has no k-point, e.g. when
+        # all the k-points are in the store: empty output files.
+        if ( kwargs.get('kreciprocal_fname') ):
+            outputs = ['eigen.d','pmnhalf.d','pnn.d']
+            if ( rename ):
+                outputs += [self.eigen_fname,self.pmn_fname,self.pnn_fname]
+            self.runscript.append(
+                "#Nothing to compute without k-points:\n"
+                "if {0}\nthen\n"
+                "   echo No k-point for this task\n"
+                "{1}"
+                "   exit 0\nfi\n".format(
+                empty_chunk_test(kwargs['kreciprocal_fname'],ntask,task),
+                ''.join('   : > {0}\n'.format(f) for f in outputs)))
         # Executable
         self.runscript.append("#Executable")
         self.runscript.append("$MPIRUN $RPMNS $WFK $RHO $EM $PMN $RHOMM $LPMN $LPMM $SCCP $lSCCP")
@@ -68,30 +94,11 @@ class RPMNSflow(Workflow,MPITask):
             self.runscript.append("cp eigen.d {0}\n".format(self.eigen_fname))
             self.runscript.append("cp pmnhalf.d {0}\n".format(self.pmn_fname))
             self.runscript.append("cp pnn.d {0}\n".format(self.pnn_fname))
-
-    @property
-    def eigen_fname(self):
-        original = path.realpath(curdir)
-        eigen_fname='eigen{0}'.format(self.suffix)
-        return path.join(original, eigen_fname) 
-
-    @property
-    def pmn_fname(self):
-        original = path.realpath(curdir)
-        pmn_fname='pmn{0}'.format(self.suffix)
-        return path.join(original, pmn_fname) 
-
-    @property
-    def pnn_fname(self):
-        original = path.realpath(curdir)
-        pnn_fname='pnn{0}'.format(self.suffix)
-        return path.join(original, pnn_fname) 
-
-    @property
-    def suffix(self):
-        if ( self.nspinor > 1):
-           spin="-spin"
-        else:
-           spin=""
-        suffix="_{0}_{1}{2}".format(self.kgrid,int(self.ecut),spin)
-        return suffix
+        # Append the k-points of this task to the store:
+        if ( self.kstore_fname ):
+            self.runscript['OPTPY'] = self.optpy
+            self.runscript.append("#Append to the k-point store")
+            self.runscript.append(
+                "$OPTPY kstore-import {0} {1} eigen.d pmnhalf.d pnn.d --task {2} --ntask {3}"
+                .format(path.realpath(self.kstore_fname),
+                        kwargs['kreciprocal_fname'],task,ntask))
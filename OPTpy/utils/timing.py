@@ -0,0 +1,212 @@
+"""
+Timing of the commands executed by the run scripts.
+
+Instrumented run scripts (see RunScript) call each command through
+
+    python -m OPTpy timeit timing_run.jsonl -- <command>
+
+which appends one JSON record per command to the timing file of the
+script, timing_run.jsonl for run.sh (see get_timing_fname):
+
+    command : the command line
+    start, end : time stamps (s since the epoch)
+    elapsed : wall time (s)
+    user, system : CPU time of the command and of its children (s)
+    maxrss : peak resident memory of the largest process (kB)
+    returncode : exit code of the command
+    host : name of the machine
+
+The records of a whole workflow can be written as a trace (write_trace),
+showing which commands ran concurrently and where the cores were idle.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import fnmatch
+import subprocess
+from collections import OrderedDict
+
+__all__ = ['TIMING_FNAME', 'get_timing_fname', 'timeit', 'read_timings',
+           'summarize_timings', 'find_timings', 'assign_slots',
+           'trace_events', 'write_trace']
+
+TIMING_FNAME = 'timing.jsonl'
+
+
+def get_timing_fname(runscript_fname):
+    """
+    Timing file of a run script, e.g. timing_run.jsonl for run.sh,
+    so that the scripts executed in the same directory keep their
+    records apart.
+    """
+    name = os.path.splitext(os.path.basename(runscript_fname))[0]
+    return 'timing_{}.jsonl'.format(name)
+
+
+def timeit(command, fname=TIMING_FNAME):
+    """
+    Run a command, given as a list of arguments, and append its timing
+    to fname. Return the exit code of the command.
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    try:
+        returncode = subprocess.call(command)
+    except OSError as e:
+        print('{}: {}'.format(command[0], e), file=sys.stderr)
+        returncode = 127
+    end = time.time()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # Killed by a signal: report it as the shell does.
+    if returncode < 0:
+        returncode = 128 - returncode
+
+    record = dict(
+        command = ' '.join(command),
+        start = start,
+        end = end,
+        elapsed = end - start,
+        user = after.ru_utime - before.ru_utime,
+        system = after.ru_stime - before.ru_stime,
+        maxrss = after.ru_maxrss,
+        returncode = returncode,
+        host = socket.gethostname(),
+        )
+    # A single write of a short line, so that the records of commands
+    # run in the background are not interleaved.
+    with open(fname, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+    return returncode
+
+
+def read_timings(fname):
+    """
+    Read the timing records of a file, skipping a line left incomplete
+    by a command still running. Return an empty list if there is no file.
+    """
+    records = list()
+    if not os.path.exists(fname):
+        return records
+    with open(fname, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def summarize_timings(records):
+    """
+    Return the totals of a list of timing records, as a dict:
+        ncommand, elapsed (from the first start to the last end),
+        user, system, maxrss (largest), failed (number of non-zero exits)
+    """
+    if not records:
+        return dict(ncommand=0, elapsed=0., user=0., system=0., maxrss=0,
+                    failed=0)
+    return dict(
+        ncommand = len(records),
+        elapsed = (max(r['end'] for r in records) -
+                   min(r['start'] for r in records)),
+        user = sum(r['user'] for r in records),
+        system = sum(r['system'] for r in records),
+        maxrss = max(r['maxrss'] for r in records),
+        failed = sum(1 for r in records if r['returncode'] != 0),
+        )
+
+
+def find_timings(dirname):
+    """
+    Return the timing records of all the task directories under dirname,
+    as an OrderedDict {relative path of the directory : records}.
+    The records of the run scripts of a directory are put together.
+    """
+    timings = OrderedDict()
+    for root, dirs, files in os.walk(dirname):
+        dirs.sort()
+        for fname in sorted(fnmatch.filter(files, 'timing*.jsonl')):
+            records = read_timings(os.path.join(root, fname))
+            if records:
+                name = os.path.relpath(root, dirname)
+                timings.setdefault(name, list()).extend(records)
+    return timings
+
+
+def assign_slots(spans):
+    """
+    Assign each (start, end) span to the lowest slot that is free when
+    the span starts, so that the spans of a slot do not overlap.
+    The number of slots is the largest number of concurrent spans.
+    Return the list of slots, in the order of the spans.
+    """
+    slots = [None] * len(spans)
+    ends = list()
+    for i in sorted(range(len(spans)), key=lambda i: spans[i]):
+        start, end = spans[i]
+        for slot, slot_end in enumerate(ends):
+            if slot_end <= start:
+                break
+        else:
+            slot = len(ends)
+            ends.append(None)
+        ends[slot] = end
+        slots[i] = slot
+    return slots
+
+
+def trace_events(timings):
+    """
+    Convert timing records into trace events (Chrome / Perfetto format),
+    with one track per worker slot, and one span per command named after
+    its task directory. The category of a span is its stage, the top
+    directory of the task.
+
+    Arguments
+    ---------
+
+    timings : dict {task name : records}, e.g. from find_timings
+    """
+    spans = list()
+    for name, records in timings.items():
+        stage = name.split(os.sep)[0]
+        for record in records:
+            spans.append((name, stage, record))
+
+    slots = assign_slots([(r['start'], r['end']) for _, _, r in spans])
+    t0 = min(r['start'] for _, _, r in spans) if spans else 0.
+
+    events = list()
+    for slot in range(max(slots) + 1 if slots else 0):
+        events.append(dict(name='thread_name', ph='M', pid=0, tid=slot,
+                           args=dict(name='slot {}'.format(slot))))
+    for (name, stage, record), slot in zip(spans, slots):
+        program = os.path.basename(record['command'].split()[0])
+        events.append(dict(
+            name = '{} {}'.format(name, program),
+            cat = stage,
+            ph = 'X',
+            pid = 0,
+            tid = slot,
+            ts = 1e6 * (record['start'] - t0),
+            dur = 1e6 * record['elapsed'],
+            args = dict((key, record[key]) for key in
+                        ('command', 'user', 'system', 'maxrss',
+                         'returncode', 'host')),
+            ))
+    return events
+
+
+def write_trace(fname, timings):
+    """
+    Write the trace of timing records (see trace_events), to be opened
+    with chrome://tracing or https://ui.perfetto.dev.
+    """
+    with open(fname, 'w') as f:
+        json.dump(dict(traceEvents=trace_events(timings),
+                       displayTimeUnit='ms'), f)
@@ -1,4 +1,5 @@
 
 angstrom_to_bohr = 1.8897261328856432
 eV_to_Ha = 0.03674932539796232
+Ha_to_eV = 27.211386245988
 
@@ -10,20 +10,36 @@ def exec_from_dir(dirname):
     finally:
         os.chdir(original)
 
-def last_lines_contain(fname, tag, nlines=60):
-    """True if the last nlines of fname contain tag."""
+def last_lines_contain(fname, tag, nlines=60, blocksize=8192):
+    """
+    True if the last nlines of fname contain tag.
+    The file is read backwards from its end, by blocks,
+    so that only its last lines are read.
+    """
     nlines = int(nlines)
-    with open(fname, 'r') as f:
-        lines = f.readlines()
-        lines.reverse()
-
-        for i in range(nlines):
-            try:
-                line = lines[i]
-            except:
-                return False
-
-            if tag in line:
-                return True
+    if nlines < 1:
+        return False
+    if not isinstance(tag, bytes):
+        tag = tag.encode()
+    with open(fname, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        # One more line break than lines, so that the first line is whole.
+        while position > 0 and data.count(b'\n') <= nlines:
+            size = min(blocksize, position)
+            position -= size
+            f.seek(position)
+            data = f.read(size) + data
+    for line in data.splitlines()[-nlines:]:
+        if tag in line:
+            return True
     return False
 
+
+def file_stat(fname):
+    """Return os.stat(fname), or None if the file does not exist."""
+    try:
+        return os.stat(fname)
+    except OSError:
+        return None
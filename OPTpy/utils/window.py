@@ -0,0 +1,226 @@
+"""
+Band windows of the eigenvalues and momentum matrix elements.
+
+A calculation of the matrix elements over many bands can be reused
+for a smaller set of valence and conduction bands, e.g. to study the
+contribution of a group of bands, without running RPMNS again.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+from ..core import Workflow, Task
+from .kdata import read_klist, iter_rows, band_pairs, KDataFiles
+from .kstore import KStore
+
+__all__ = ['window_bands', 'window_columns', 'slice_band_window',
+           'WINDOWflow']
+
+
+def window_bands(nval_total, valence, conduction):
+    """
+    Return the indices (counted from 0) of the bands in a window.
+
+    Arguments
+    ---------
+
+    nval_total : int
+        Number of valence bands.
+    valence : (first, last)
+        Range of valence bands, counted from 1 as in Tiniba,
+        first <= last <= nval_total.
+    conduction : (first, last)
+        Range of conduction bands, counted from 1,
+        nval_total < first <= last.
+    """
+    v1, v2 = [int(i) for i in valence]
+    c1, c2 = [int(i) for i in conduction]
+    if not 1 <= v1 <= v2 <= nval_total:
+        raise Exception('Valence bands {}-{} are not within 1-{}.'.format(
+                        v1, v2, nval_total))
+    if not nval_total < c1 <= c2:
+        raise Exception('Conduction bands {}-{} must be above band {}.'
+                        .format(c1, c2, nval_total))
+    return np.concatenate([np.arange(v1 - 1, v2), np.arange(c1 - 1, c2)])
+
+
+def window_columns(nband, bands, diagonal=True):
+    """
+    Return the columns of the eigen (without index), pmn and pnn records
+    that hold the bands of a window, in the order of the files written
+    for the window alone.
+
+    Arguments
+    ---------
+
+    nband : int
+        Number of bands in the records.
+    bands : array of int
+        Increasing band indices, counted from 0.
+    diagonal : bool (True)
+        The pmn records include the diagonal pairs n = m.
+    """
+    bands = np.asarray(bands, dtype=int)
+    if len(bands) == 0 or np.any(np.diff(bands) <= 0) or \
+       bands[0] < 0 or bands[-1] >= nband:
+        raise Exception('Invalid band window for {} bands.'.format(nband))
+
+    n, m = band_pairs(nband, diagonal)
+    pairs = -np.ones((nband, nband), dtype=int)
+    pairs[n, m] = np.arange(len(n))
+    i, j = band_pairs(len(bands), diagonal)
+    # Windows are increasing, so that pairs n <= m remain in order.
+    ipair = pairs[bands[i], bands[j]]
+
+    eigen = bands
+    pmn = (6 * ipair[:, None] + np.arange(6)).ravel()
+    pnn = (3 * bands[:, None] + np.arange(3)).ravel()
+    return eigen, pmn, pnn
+
+
+def _write_block(f, rows, start=None):
+    for ik, row in enumerate(rows):
+        line = ' '.join('{:.12E}'.format(x) for x in row)
+        if start is not None:
+            line = '{} {}'.format(start + ik + 1, line)
+        f.write(line + '\n')
+
+
+def _file_blocks(source, nk, block):
+    """Blocks of (eigen, pmn, pnn) records read from Tiniba files."""
+    others = [iter_rows(source[key], nk, block) if source.get(key) else None
+              for key in ('pmn', 'pnn')]
+    for eigen in iter_rows(source['eigen'], nk, block, index=True):
+        yield [eigen] + [next(rows) if rows else None for rows in others]
+
+
+def _kstore_blocks(source, block):
+    """Blocks of (eigen, pmn, pnn) records read from a k-point store."""
+    store = KStore(source['kstore'])
+    kpts = read_klist(source['klist'])
+    for start in range(0, len(kpts), block):
+        yield store.read(kpts[start:start+block])
+
+
+def slice_band_window(source, target, bands, block=64):
+    """
+    Write the eigenvalues and matrix elements of a band window,
+    reading the source records by blocks of k-points.
+
+    Arguments
+    ---------
+
+    source : dict
+        Files holding all the bands, with keys
+            klist : list of k-points
+            eigen : eigenvalues, with a k-point index
+            pmn, pnn : matrix elements (optional)
+        as returned by tiniba_fnames, or with keys
+            klist, kstore : k-point store, read in the order of klist
+    target : dict
+        Output files, with keys eigen, pmn, pnn. Keys that are missing
+        or set to None are not written.
+    bands : array of int
+        Increasing band indices of the window, counted from 0
+        (see window_bands).
+    block : int (64)
+        Number of k-points per block.
+    """
+    nk = len(read_klist(source['klist']))
+    block = max(1, int(block))
+    if source.get('kstore'):
+        blocks = _kstore_blocks(source, block)
+    else:
+        blocks = _file_blocks(source, nk, block)
+
+    keys = ('eigen', 'pmn', 'pnn')
+    files = dict()
+    try:
+        for key in keys:
+            if target.get(key):
+                files[key] = open(target[key], 'w')
+
+        start = 0
+        columns = None
+        for records in blocks:
+            eigen = records[0]
+            if columns is None:
+                nband = eigen.shape[1]
+                diagonal = records[1] is None or \
+                    records[1].shape[1] == 6 * nband * (nband + 1) // 2
+                columns = window_columns(nband, bands, diagonal)
+            for key, rows, cols in zip(keys, records, columns):
+                if key not in files:
+                    continue
+                if rows is None:
+                    raise Exception('No {} records to slice.'.format(key))
+                _write_block(files[key], rows[:, cols],
+                             start if key == 'eigen' else None)
+            start += len(eigen)
+    finally:
+        for f in files.values():
+            f.close()
+
+    if start != nk:
+        raise Exception('Found {} k-points instead of {}.'.format(start, nk))
+
+
+class WINDOWflow(Workflow, Task, KDataFiles):
+    def __init__(self, **kwargs):
+        """
+        Write the eigenvalues and matrix elements of a window of
+        valence and conduction bands from a calculation including
+        more bands, so that the response can be computed for the
+        window without running RPMNS again.
+
+        Keyword arguments
+        -----------------
+        dirname : str, directory from which the script is executed.
+        runscript_fname : str, name of the script (default: window.sh)
+        kgrid_response : int, array(3), k-point grid for response
+        kreciprocal_fname : list of k-points (from KKflow)
+        eigen_fname, pmn_fname, pnn_fname : files holding all the bands
+        kstore_fname : str, optional, k-point store read instead of
+            the eigen, pmn and pnn files.
+        nval_total : Number of valence bands
+        valence : (first, last), valence bands of the window (from 1)
+        conduction : (first, last), conduction bands of the window
+        ecut : Kinetic energy cutoff
+        nspinor=1 : Number of spinorial components
+        OPTPY : command to call the OPTpy tools
+        """
+        kwargs.setdefault('runscript_fname', 'window.sh')
+        super(WINDOWflow, self).__init__(**kwargs)
+        self.kgrid_response = kwargs['kgrid_response']
+        self.kgrid="{}x{}x{}".format(self.kgrid_response[0],self.kgrid_response[1],self.kgrid_response[2])
+        self.ecut = kwargs['ecut']
+        self.nspinor = kwargs.get('nspinor', 1)
+        self.nval_total = kwargs['nval_total']
+        self.valence = kwargs['valence']
+        self.conduction = kwargs['conduction']
+        self.optpy = kwargs.pop('OPTPY', 'python -m OPTpy')
+
+        # Check the window now rather than when the script runs.
+        bands = window_bands(self.nval_total, self.valence, self.conduction)
+        self.nval = self.valence[1] - self.valence[0] + 1
+        self.nband = len(bands)
+
+        if kwargs.get('kstore_fname'):
+            source = "--kstore {0}".format(kwargs['kstore_fname'])
+        else:
+            source = "--eigen {0} --pmn {1} --pnn {2}".format(
+                kwargs['eigen_fname'], kwargs['pmn_fname'],
+                kwargs['pnn_fname'])
+
+        self.runscript.variables={
+            'OPTPY' : self.optpy}
+        self.runscript.append(
+            "# Bands {0}-{1} and {2}-{3}".format(
+            self.valence[0], self.valence[1],
+            self.conduction[0], self.conduction[1]))
+        self.runscript.append(
+            "$OPTPY window {0} {1} {2} {3} {4} {5} {6} {7} {8} {9}".format(
+            kwargs['kreciprocal_fname'], self.nval_total,
+            self.valence[0], self.valence[1],
+            self.conduction[0], self.conduction[1],
+            self.eigen_fname, self.pmn_fname, self.pnn_fname, source))
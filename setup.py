@@ -31,7 +31,7 @@ __version__ = '4.2.2'
 
 # Requirements
 install_requires = [
-    'numpy >=1.6',
+    'numpy >=1.10',
     'pymatgen >=4.0',
     ]
 